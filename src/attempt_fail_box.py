@@ -44,6 +44,7 @@ class AttemptFailBox(Gtk.Box):
         vid_fps: float,
         compressed_size_bytes: int,
         target_size_bytes: int,
+        is_size_projected: bool = False,
         **kwargs
     ) -> None:
         super().__init__(**kwargs)
@@ -85,7 +86,26 @@ class AttemptFailBox(Gtk.Box):
 
         compressed_size_mb = round(compressed_size_bytes / 1024 / 1024, 1)
 
-        if compressed_size_bytes >= target_size_bytes:
+        if is_size_projected:
+            # The attempt was abandoned early, so its size is only a
+            # projection. See compress().
+            if compressed_size_bytes >= target_size_bytes:
+                self.failure_icon.set_from_icon_name('arrow2-up-symbolic')
+                # TRANSLATORS: {size} represents an integer. {unit} represents
+                # a file size unit like 'MiB'.
+                fail_msg = _('Stopped early, as the compressed file size was projected to be too large (about {size} {unit})')
+            else:
+                self.failure_icon.set_from_icon_name('arrow2-down-symbolic')
+                # TRANSLATORS: {size} represents an integer. {unit} represents
+                # a file size unit like 'MiB'.
+                fail_msg = _('Stopped early, as the compressed file size was projected to be too small (about {size} {unit})')
+
+            self.failure_details_label.set_label(fail_msg.format(
+                size = f'{compressed_size_mb}',
+                # TRANSLATORS: this is the SI unit for 'mebibyte'.
+                unit = _('MiB')
+            ))
+        elif compressed_size_bytes >= target_size_bytes:
             self.failure_icon.set_from_icon_name('arrow2-up-symbolic')
             # TRANSLATORS: {size} represents an integer. {unit} represents a
             # file size unit like 'MiB'.
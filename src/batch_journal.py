@@ -0,0 +1,361 @@
+#!/usr/bin/python3
+
+# batch_journal.py
+#
+# Copyright 2025 Wartybix
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import os
+import json
+import fcntl
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+try:
+    from constrict.enums import SourceState
+except ModuleNotFoundError:
+    from enums import SourceState
+
+
+# Module responsible for journaling batches of videos as they're compressed,
+# so that a batch interrupted by a crash, a reboot or its window being closed
+# can be resumed later (by the GUI or the CLI). A journal holds the settings
+# the batch was started with, and the state and attempts of each video.
+# Journals are rewritten atomically after every change, so a crash can never
+# leave one half-written.
+
+# Bump whenever the format of journals changes, to ignore old journals.
+JOURNAL_VERSION = 1
+
+# Unfinished journals older than this many seconds are deleted rather than
+# offered for resuming.
+MAX_JOURNAL_AGE = 30 * 24 * 60 * 60
+
+
+def get_journal_dir() -> Optional[Path]:
+    """ Return the path of Constrict's journal directory in the user's state
+    directory, creating it if needed. Returns None if it cannot be created.
+    """
+    xdg_state_home = os.environ.get('XDG_STATE_HOME')
+    state_home = Path(xdg_state_home) if xdg_state_home else (
+        Path.home() / '.local' / 'state'
+    )
+    journal_dir = state_home / 'constrict' / 'journals'
+
+    try:
+        journal_dir.mkdir(mode=0o755, parents=True, exist_ok=True)
+    except OSError:
+        print('Warning: could not get journal directory')
+        return None
+
+    return journal_dir
+
+
+class BatchJournal:
+    """ The journal of one batch of videos. Videos are identified by their
+    source path. Safe to use from several threads at once.
+
+    While a batch is running, its journal is locked, so that it isn't
+    offered for resuming by another instance. See lock().
+    """
+    def __init__(self, path: Path, data: Dict[str, Any]) -> None:
+        self.path = path
+        self.data = data
+        self.lock_file = None
+        self.write_lock = threading.Lock()
+
+    def lock(self) -> bool:
+        """ Lock the journal for this process until unlock() is called.
+        Returns whether the lock was taken (i.e. whether the journal isn't
+        already in use).
+        """
+        if self.lock_file is not None:
+            return True
+
+        try:
+            lock_file = open(self.path.with_suffix('.lock'), 'w')
+        except OSError:
+            return False
+
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+
+        self.lock_file = lock_file
+        return True
+
+    def unlock(self) -> None:
+        """ Release the lock taken by lock() """
+        if self.lock_file is None:
+            return
+
+        self.lock_file.close()
+        self.lock_file = None
+
+    def get_destination_dir(self) -> str:
+        """ Return the directory the batch exports videos to """
+        return self.data['destination_dir']
+
+    def get_settings(self) -> Dict[str, Any]:
+        """ Return the compression settings the batch was started with """
+        return self.data['settings']
+
+    def get_video_paths(self) -> List[str]:
+        """ Return the source paths of every video in the batch, in order """
+        return [x['path'] for x in self.data['videos']]
+
+    def get_video(self, video_path: str) -> Optional[Dict[str, Any]]:
+        """ Return the journal entry of a video, as a dictionary with the
+        keys 'path', 'state' (a SourceState), 'output' (the path being
+        exported to, if started), 'size' (the size of the output in bytes,
+        if complete), 'attempts' and 'factor' (see get_resume_factor()).
+        Returns None if the video isn't in the batch.
+        """
+        return next(
+            (x for x in self.data['videos'] if x['path'] == video_path),
+            None
+        )
+
+    def get_attempts(self, video_path: str) -> List[Tuple[float, float]]:
+        """ Return the (bitrate factor, percent of target size) results of
+        the finished attempts of a video, oldest first. See compress().
+        """
+        video = self.get_video(video_path)
+
+        if video is None:
+            return []
+
+        return [(x[0], x[1]) for x in video['attempts']]
+
+    def get_resume_factor(self, video_path: str) -> Optional[float]:
+        """ Return the bitrate factor of the attempt at compressing a video
+        that was interrupted, if any. See compress().
+        """
+        video = self.get_video(video_path)
+
+        return video.get('factor') if video else None
+
+    def add_video(self, video_path: str) -> None:
+        """ Add a video to the batch, if it's not in it already """
+        with self.write_lock:
+            if self.get_video(video_path) is not None:
+                return
+
+            self.data['videos'].append({
+                'path': video_path,
+                'state': SourceState.PENDING,
+                'output': None,
+                'size': None,
+                'attempts': [],
+                'factor': None
+            })
+            self.save()
+
+    def start_video(self, video_path: str, output_path: str) -> None:
+        """ Record that a video started being compressed to the passed path
+        """
+        self.update_video(
+            video_path,
+            state=SourceState.COMPRESSING,
+            output=output_path
+        )
+
+    def start_attempt(self, video_path: str, factor: float) -> None:
+        """ Record that an attempt at compressing a video started with the
+        passed bitrate factor. Matches the on_attempt_start callback of
+        compress().
+        """
+        self.update_video(video_path, factor=factor)
+
+    def add_attempt(
+        self,
+        video_path: str,
+        factor: float,
+        percent_of_target: float,
+        video_bitrate: int
+    ) -> None:
+        """ Record the result of a finished attempt at compressing a video.
+        Matches the on_attempt_done callback of compress().
+        """
+        with self.write_lock:
+            video = self.get_video(video_path)
+
+            if video is None:
+                return
+
+            video['attempts'].append(
+                [factor, percent_of_target, video_bitrate]
+            )
+            video['factor'] = None
+            self.save()
+
+    def finish_video(
+        self,
+        video_path: str,
+        state: int,
+        size: Optional[int] = None
+    ) -> None:
+        """ Record that compressing a video ended, in the passed SourceState.
+        Videos that didn't complete forget their output, which isn't theirs
+        to clean up anymore.
+        """
+        if state == SourceState.COMPLETE:
+            self.update_video(video_path, state=state, size=size)
+        else:
+            self.update_video(video_path, state=state, output=None)
+
+    def update_video(self, video_path: str, **changes: Any) -> None:
+        """ Change the passed keys of a video's entry """
+        with self.write_lock:
+            video = self.get_video(video_path)
+
+            if video is None:
+                return
+
+            video.update(changes)
+            self.save()
+
+    def is_finished(self) -> bool:
+        """ Whether every video in the batch is complete """
+        return all(
+            x['state'] == SourceState.COMPLETE for x in self.data['videos']
+        )
+
+    def save(self) -> None:
+        """ Write the journal to disk atomically. Must be called with
+        write_lock held.
+        """
+        self.data['modified'] = time.time()
+
+        try:
+            fd, part_path = tempfile.mkstemp(
+                dir=self.path.parent,
+                prefix='.',
+                suffix='.part'
+            )
+
+            with os.fdopen(fd, 'w') as part_file:
+                json.dump(self.data, part_file)
+                part_file.flush()
+                # The rename must not reach the disk before the contents.
+                os.fsync(part_file.fileno())
+
+            os.replace(part_path, self.path)
+        except OSError as e:
+            print(f'Warning: could not write batch journal: {e}')
+
+    def remove(self) -> None:
+        """ Delete the journal, once its batch is over """
+        try:
+            self.path.unlink(missing_ok=True)
+            self.path.with_suffix('.lock').unlink(missing_ok=True)
+        except OSError as e:
+            print(f'Warning: could not delete batch journal: {e}')
+
+        self.unlock()
+
+
+def create_journal(
+    destination_dir: str,
+    settings: Dict[str, Any],
+    video_paths: Sequence[str]
+) -> Optional[BatchJournal]:
+    """ Start the journal of a new batch, exporting to destination_dir with
+    the passed (JSON-serializable) settings. The journal is returned locked.
+    Returns None if journals are unavailable.
+    """
+    journal_dir = get_journal_dir()
+
+    if not journal_dir:
+        return None
+
+    journal = BatchJournal(journal_dir / f'batch-{uuid.uuid4().hex}.json', {
+        'version': JOURNAL_VERSION,
+        'created': time.time(),
+        'destination_dir': destination_dir,
+        'settings': dict(settings),
+        'videos': []
+    })
+
+    # Locked before it's first written, so it's never seen unlocked while
+    # in use.
+    if not journal.lock():
+        print('Warning: could not create batch journal')
+        return None
+
+    for video_path in video_paths:
+        journal.add_video(video_path)
+
+    return journal
+
+
+def load_journal(path: Path) -> Optional[BatchJournal]:
+    """ Read the journal at the passed path. Returns None if it can't be
+    read, or is from another version of Constrict.
+    """
+    try:
+        data = json.loads(path.read_text())
+    except (OSError, ValueError):
+        return None
+
+    if not isinstance(data, dict) or data.get('version') != JOURNAL_VERSION:
+        return None
+
+    return BatchJournal(path, data)
+
+
+def get_unfinished_journals() -> List[BatchJournal]:
+    """ Return the journals of interrupted batches that aren't in use, most
+    recently changed first. Journals too old to be worth resuming, or that
+    can't be read, are deleted.
+    """
+    journal_dir = get_journal_dir()
+
+    if not journal_dir:
+        return []
+
+    journals = []
+
+    for path in journal_dir.glob('batch-*.json'):
+        journal = load_journal(path) or BatchJournal(path, {})
+
+        if not journal.lock():
+            # Still running somewhere.
+            continue
+
+        if not journal.data:
+            # Unreadable.
+            journal.remove()
+            continue
+
+        age = time.time() - journal.data.get('modified', 0)
+
+        if journal.is_finished() or age > MAX_JOURNAL_AGE:
+            journal.remove()
+            continue
+
+        journal.unlock()
+        journals.append(journal)
+
+    journals.sort(key=lambda x: x.data.get('modified', 0), reverse=True)
+
+    return journals
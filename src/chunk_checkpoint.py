@@ -0,0 +1,195 @@
+#!/usr/bin/python3
+
+# chunk_checkpoint.py
+#
+# Copyright 2025 Wartybix
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import os
+import json
+import hashlib
+import shutil
+import time
+import threading
+from pathlib import Path
+from typing import Any, Dict, Optional
+try:
+    from constrict import probe_cache
+except ModuleNotFoundError:
+    import probe_cache
+
+
+# Module responsible for keeping the finished chunks of chunked transcodes
+# (see transcode_chunked()) between sessions. An interrupted transcode of the
+# same source with the same settings picks up from the chunks already
+# finished, rather than starting over. Each transcode gets its own directory,
+# holding its chunks and a manifest of which of them are finished.
+
+# Bump whenever the format of manifests changes, to discard old checkpoints.
+MANIFEST_VERSION = 1
+
+# Checkpoints left unused for longer than this many seconds are deleted.
+MAX_CHECKPOINT_AGE = 7 * 24 * 60 * 60
+
+
+def get_checkpoint_root() -> Optional[Path]:
+    """ Return the directory holding every checkpoint, creating it if
+    needed. Returns None if it cannot be created.
+    """
+    cache_dir = probe_cache.get_cache_dir()
+
+    if not cache_dir:
+        return None
+
+    checkpoint_root = cache_dir / 'checkpoints'
+
+    try:
+        checkpoint_root.mkdir(mode=0o755, exist_ok=True)
+    except OSError:
+        print('Warning: could not get checkpoint directory')
+        return None
+
+    return checkpoint_root
+
+
+class ChunkManifest:
+    """ The finished chunks of one chunked transcode, identified by its
+    source file and the settings of the transcode. Safe to use from several
+    threads at once.
+    """
+    def __init__(self, checkpoint_dir: Path, params: Dict[str, Any]) -> None:
+        self.checkpoint_dir = checkpoint_dir
+        self.params = params
+        self.finished = set()
+        self.lock = threading.Lock()
+
+        manifest_path = checkpoint_dir / 'manifest.json'
+
+        try:
+            data = json.loads(manifest_path.read_text())
+        except (OSError, ValueError):
+            return
+
+        valid = (
+            isinstance(data, dict)
+            and data.get('version') == MANIFEST_VERSION
+            and data.get('params') == params
+        )
+
+        if not valid:
+            return
+
+        # Chunks are only listed once fully written, but may have been
+        # deleted since.
+        self.finished = {
+            x for x in data.get('finished', [])
+            if self.get_chunk_path(x).is_file()
+        }
+
+    def get_chunk_path(self, index: int) -> Path:
+        """ Return where the chunk at the passed index is written """
+        return self.checkpoint_dir / f'chunk-{index}.mp4'
+
+    def is_finished(self, index: int) -> bool:
+        """ Whether the chunk at the passed index was already encoded """
+        with self.lock:
+            return index in self.finished
+
+    def mark_finished(self, index: int) -> None:
+        """ Record that the chunk at the passed index is fully written """
+        with self.lock:
+            self.finished.add(index)
+            self.save()
+
+    def save(self) -> None:
+        """ Write the manifest to disk atomically. Must be called with the
+        lock held.
+        """
+        manifest_path = self.checkpoint_dir / 'manifest.json'
+        part_path = self.checkpoint_dir / 'manifest.json.part'
+
+        try:
+            with open(part_path, 'w') as part_file:
+                json.dump({
+                    'version': MANIFEST_VERSION,
+                    'params': self.params,
+                    'finished': sorted(self.finished)
+                }, part_file)
+                part_file.flush()
+                os.fsync(part_file.fileno())
+
+            os.replace(part_path, manifest_path)
+        except OSError as e:
+            print(f'Warning: could not write chunk manifest: {e}')
+
+    def remove(self) -> None:
+        """ Delete the checkpoint, once the transcode is over """
+        shutil.rmtree(self.checkpoint_dir, ignore_errors=True)
+
+
+def open_manifest(
+    file_input: str,
+    params: Dict[str, Any]
+) -> Optional[ChunkManifest]:
+    """ Return the manifest of the chunked transcode of the passed source
+    with the passed (JSON-serializable) settings, creating its checkpoint
+    directory if needed. Old checkpoints are deleted on the way. Returns None
+    if checkpoints are unavailable.
+    """
+    checkpoint_root = get_checkpoint_root()
+
+    if not checkpoint_root:
+        return None
+
+    prune_checkpoints(checkpoint_root)
+
+    try:
+        file_key = probe_cache.get_file_key(file_input)
+    except OSError:
+        return None
+
+    key = json.dumps([file_key, params], sort_keys=True)
+    checkpoint_dir = checkpoint_root / hashlib.sha256(
+        key.encode('utf-8')
+    ).hexdigest()[:32]
+
+    try:
+        checkpoint_dir.mkdir(mode=0o755, exist_ok=True)
+        # Marks the checkpoint as recently used. See prune_checkpoints().
+        os.utime(checkpoint_dir)
+    except OSError as e:
+        print(f'Warning: could not create checkpoint: {e}')
+        return None
+
+    return ChunkManifest(checkpoint_dir, params)
+
+
+def prune_checkpoints(checkpoint_root: Path) -> None:
+    """ Delete checkpoints unused for longer than MAX_CHECKPOINT_AGE """
+    try:
+        checkpoint_dirs = list(checkpoint_root.iterdir())
+    except OSError:
+        return
+
+    for checkpoint_dir in checkpoint_dirs:
+        try:
+            age = time.time() - checkpoint_dir.stat().st_mtime
+        except OSError:
+            continue
+
+        if age > MAX_CHECKPOINT_AGE:
+            shutil.rmtree(checkpoint_dir, ignore_errors=True)
@@ -0,0 +1,221 @@
+#!/usr/bin/python3
+
+# constrict_benchmark.py
+#
+# Copyright 2025 Wartybix
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Measures how quickly this machine encodes video when its CPU cores are
+# split between different numbers of simultaneous jobs, from one job using
+# every core (1xN) to one job per core (Nx1). Each job encodes the same
+# sample of a video, using the first pass of Constrict's usual transcode.
+
+import argparse
+from constrict_utils import MediaInfo, probe_media, run_first_pass
+from encode_scheduler import CorePartitioner, get_usable_cpus
+from enums import VideoCodec
+import ffmpeg_supervisor
+import contextvars
+import tempfile
+import threading
+import time
+import subprocess
+import os
+from typing import FrozenSet, List, Optional, Tuple
+
+CODECS = {
+    'h264': VideoCodec.H264,
+    'hevc': VideoCodec.HEVC,
+    'av1': VideoCodec.AV1,
+    'vp9': VideoCodec.VP9,
+}
+
+
+def get_job_counts(cpu_count: int) -> List[int]:
+    """ Return the numbers of simultaneous jobs to measure: powers of 2 up
+    to the number of CPUs, and the number of CPUs itself
+    """
+    job_counts = []
+    job_count = 1
+
+    while job_count < cpu_count:
+        job_counts.append(job_count)
+        job_count *= 2
+
+    job_counts.append(cpu_count)
+
+    return job_counts
+
+
+def run_configuration(
+    args: argparse.Namespace,
+    media_info: MediaInfo,
+    job_count: int,
+    threads: int,
+    log_dir: str
+) -> Tuple[float, Optional[str]]:
+    """ Encode the sample in job_count jobs at once, each limited to the
+    passed number of threads. Returns the wall-clock time taken in seconds,
+    and the details of the first error, if any.
+    """
+    partitioner = CorePartitioner() if args.pin else None
+    errors = []
+    framerate = media_info.fps if media_info.fps > 0 else 30
+
+    def run_job(job_id: int, cpus: Optional[FrozenSet[int]]) -> None:
+        ffmpeg_supervisor.set_cpu_affinity(cpus)
+
+        pass_avg_fps, error = run_first_pass(
+            args.file_path,
+            args.bitrate * 1000,
+            media_info.width,
+            media_info.height,
+            media_info.rotation,
+            framerate,
+            CODECS[args.codec],
+            False,
+            False,
+            lambda fraction, seconds_left: None,
+            lambda: int(args.duration * framerate) or 1,
+            os.path.join(log_dir, f'benchmark-{job_count}-{job_id}'),
+            lambda: False,
+            args.start,
+            args.duration,
+            threads
+        )
+
+        if error:
+            errors.append(error)
+
+    job_threads = []
+
+    start = time.monotonic()
+
+    for job_id in range(job_count):
+        cpus = partitioner.allocate(threads) if partitioner else None
+
+        job_thread = threading.Thread(
+            target=contextvars.copy_context().run,
+            args=[run_job, job_id, cpus]
+        )
+        job_thread.daemon = True
+        job_thread.start()
+        job_threads.append(job_thread)
+
+    for job_thread in job_threads:
+        job_thread.join()
+
+    return (time.monotonic() - start, errors[0] if errors else None)
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser("constrict-benchmark")
+    arg_parser.add_argument(
+        '-i',
+        dest='file_path',
+        help='Location of the video file to encode samples of',
+        type=str,
+        required=True
+    )
+    arg_parser.add_argument(
+        '--codec',
+        dest='codec',
+        choices=list(CODECS),
+        default='h264',
+        help='The codec to encode samples with (default h264)'
+    )
+    arg_parser.add_argument(
+        '--bitrate',
+        dest='bitrate',
+        type=int,
+        default=2000,
+        help='Video bitrate of the samples in kbps (default 2000)'
+    )
+    arg_parser.add_argument(
+        '--start',
+        dest='start',
+        type=float,
+        default=0,
+        help='Where the sample starts in the video, in seconds (default 0)'
+    )
+    arg_parser.add_argument(
+        '--duration',
+        dest='duration',
+        type=float,
+        default=10,
+        help='Length of the sample in seconds (default 10)'
+    )
+    arg_parser.add_argument(
+        '--pin',
+        action='store_true',
+        help='Confine each job to its own CPU cores'
+    )
+    args = arg_parser.parse_args()
+
+    try:
+        media_info = probe_media(args.file_path)
+    except (subprocess.CalledProcessError, ValueError) as e:
+        print(f'Could not read {args.file_path}: {e}')
+        raise SystemExit(1)
+
+    # Samples past the end of the video would encode nothing.
+    args.duration = min(args.duration, media_info.duration - args.start)
+
+    if args.duration <= 0:
+        print('The sample starts after the end of the video')
+        raise SystemExit(1)
+
+    cpu_count = len(get_usable_cpus())
+
+    print(
+        f'Encoding {args.duration:.1f}s samples with {args.codec} on '
+        f'{cpu_count} CPUs...'
+    )
+    print(f'{"Jobs":>6} {"Threads":>8} {"Time":>8} {"Throughput":>12}')
+
+    results = []
+
+    with tempfile.TemporaryDirectory(prefix='constrict-benchmark-') as log_dir:
+        for job_count in get_job_counts(cpu_count):
+            threads = max(cpu_count // job_count, 1)
+
+            elapsed, error = run_configuration(
+                args,
+                media_info,
+                job_count,
+                threads,
+                log_dir
+            )
+
+            if error:
+                print(f'\n*** ENCODING ERROR ***\n{error}')
+                raise SystemExit(1)
+
+            # Seconds of video encoded per second.
+            throughput = job_count * args.duration / elapsed
+            results.append((throughput, job_count, threads))
+
+            print(
+                f'{job_count:>6} {threads:>8} {elapsed:>7.1f}s '
+                f'{throughput:>11.2f}x'
+            )
+
+    best_throughput, best_job_count, best_threads = max(results)
+
+    print(
+        f'\nFastest: {best_job_count} job(s) of {best_threads} thread(s) each'
+    )
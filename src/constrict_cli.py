@@ -20,12 +20,17 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 import argparse
-from constrict_utils import compress
-from enums import FpsMode, VideoCodec
+from constrict_utils import compress, probe_media, EARLY_ABORT_MARGIN
+from enums import FpsMode, VideoCodec, RateSearch, SourceState
+import ffmpeg_supervisor
+import batch_journal
 import datetime
+from functools import partial
+from pathlib import Path
 from typing import Optional
 import mimetypes
 import tempfile
+import subprocess
 import os
 
 if __name__ == '__main__':
@@ -35,14 +40,14 @@ if __name__ == '__main__':
         dest='file_path',
         help='Location of the video file to be compressed',
         type=str,
-        required=True
+        required=False
     )
     arg_parser.add_argument(
         '-s',
         dest='target_size',
         help='Desired size of the compressed video in MiB',
         type=int,
-        required=True
+        required=False
     )
     arg_parser.add_argument(
         '-t',
@@ -56,7 +61,7 @@ if __name__ == '__main__':
         dest='output',
         type=str,
         help='Destination path of the compressed video file',
-        required=True
+        required=False
     )
     arg_parser.add_argument(
         '--framerate',
@@ -107,8 +112,123 @@ if __name__ == '__main__':
         action='store_true',
         help='Do not use GPU encoding when available'
     )
+    arg_parser.add_argument(
+        '--exact-frame-count',
+        action='store_true',
+        help=(
+            'Count every frame of the video before compressing, rather than '
+            'estimating the frame count and refining it in the background. '
+            'Can take a long time on large files'
+        )
+    )
+    arg_parser.add_argument(
+        '--rate-search',
+        dest='rate_search',
+        choices=['secant', 'proportional'],
+        default='secant',
+        help=(
+            'How the bitrate of each attempt after the first is chosen.\n'
+            'secant: fit a line through the results of all previous '
+            'attempts. Usually needs fewer attempts.\n'
+            'proportional: scale the bitrate by how far the last attempt '
+            'was from the target.'
+        )
+    )
+    arg_parser.add_argument(
+        '--calibrate',
+        action='store_true',
+        help=(
+            'Encode short samples of long videos before compressing them, '
+            'to correct the bitrate of the first attempt'
+        )
+    )
+    arg_parser.add_argument(
+        '--no-early-abort',
+        action='store_true',
+        help=(
+            'Always finish every attempt, rather than abandoning attempts '
+            'that are projected to miss the target size by a wide margin'
+        )
+    )
+    arg_parser.add_argument(
+        '--parallel-chunks',
+        dest='parallel_chunks',
+        type=int,
+        default=1,
+        help=(
+            'Split long videos into up to this many chunks that are encoded '
+            'at the same time (default 1, i.e. no chunking)'
+        )
+    )
+    arg_parser.add_argument(
+        '--intermediate-budget',
+        dest='intermediate_budget',
+        type=int,
+        default=0,
+        help=(
+            'Retry attempts from a downscaled copy of the video, using up to '
+            'this much scratch space in MiB (default 0, i.e. disabled)'
+        )
+    )
+    arg_parser.add_argument(
+        '--background',
+        action='store_true',
+        help=(
+            'Compress with a lower CPU and disk priority, to keep other '
+            'programs responsive'
+        )
+    )
+    arg_parser.add_argument(
+        '--cpu-quota',
+        dest='cpu_quota',
+        type=int,
+        default=100,
+        help=(
+            'With --background, the share of CPU time in percent that '
+            'compression may use (default 100, i.e. no limit)'
+        )
+    )
+    arg_parser.add_argument(
+        '--threads',
+        dest='threads',
+        type=int,
+        help=(
+            'Limit encoding to this many threads (default: let the encoder '
+            'decide)'
+        )
+    )
+    arg_parser.add_argument(
+        '--resumable',
+        action='store_true',
+        help=(
+            'Encode long videos in chunks that are kept if compression is '
+            'interrupted, so that --resume carries on from the last finished '
+            'chunk'
+        )
+    )
+    arg_parser.add_argument(
+        '--resume',
+        dest='resume',
+        nargs='?',
+        const='',
+        metavar='JOURNAL',
+        help=(
+            'Resume an interrupted batch from its journal (by default, the '
+            'most recently interrupted one), skipping videos that were '
+            'already compressed. Compression settings are taken from the '
+            'journal'
+        )
+    )
     args = arg_parser.parse_args()
 
+    if args.resume is None and not (
+        args.file_path and args.target_size and args.output
+    ):
+        arg_parser.error('-i, -s and -o are required unless resuming')
+
+    if args.background:
+        ffmpeg_supervisor.get_supervisor().set_background(True, args.cpu_quota)
+
     def get_fps_mode() -> int:
         match args.framerate_option:
             case 'auto':
@@ -184,43 +304,188 @@ if __name__ == '__main__':
         height: int,
         fps: float,
         after_size_bytes: int,
-        target_size_bytes: int
+        target_size_bytes: int,
+        size_projected: bool
     ) -> None:
-        print(f'\n   Attempt fail: compressed size is {round(after_size_bytes / 1024 / 1024, 1)}MiB')
+        if size_projected:
+            print(f'\n   Attempt abandoned: compressed size was projected to be {round(after_size_bytes / 1024 / 1024, 1)}MiB')
+        else:
+            print(f'\n   Attempt fail: compressed size is {round(after_size_bytes / 1024 / 1024, 1)}MiB')
+
+    def get_unique_path(file_path: str) -> str:
+        final_path = file_path
+        root_ext = os.path.splitext(file_path)
 
-    mime_type, encoder = mimetypes.guess_type(args.file_path)
-    mime_type = mime_type or ""
+        counter = 0
+        while os.path.exists(final_path):
+            counter += 1
+            final_path = f'{root_ext[0]}-{counter}{root_ext[1]}'
 
-    compression_result = None
+        return final_path
 
-    print(f"Compressing {args.file_path} to {args.target_size} MiB...")
+    def compress_file(
+        file_path: str,
+        output: str,
+        settings: dict,
+        journal: Optional[batch_journal.BatchJournal]
+    ) -> bool:
+        """ Compress one video with the passed journal settings. Returns
+        False if compression was cancelled.
+        """
+        mime_type, encoder = mimetypes.guess_type(file_path)
+        mime_type = mime_type or ""
+
+        compression_result = None
+        cancelled = False
 
-    with tempfile.NamedTemporaryFile() as log_file:
         try:
-            compression_result = compress(
-                args.file_path,
-                mime_type,
-                args.output,
-                args.target_size,
-                get_fps_mode(),
-                args.extra_quality,
-                get_video_codec(),
-                not args.software_encode,
-                args.tolerance,
-                print_progress,
-                log_file.name,
-                lambda: False,
-                show_attempt_details,
-                show_attempt_fail
+            media_info = probe_media(file_path)
+        except (subprocess.CalledProcessError, ValueError):
+            # Let compress() report the error in its usual format.
+            media_info = None
+
+        print(f"Compressing {file_path} to {settings['target_size']} MiB...")
+
+        if media_info is not None:
+            source_fps = int(round(media_info.fps, 0)) if media_info.fps != -1 else '?'
+            source_height = min(media_info.width, media_info.height)
+            print(f":: Source -- {source_height}p@{source_fps}, {round(media_info.duration, 1)}s")
+
+        if journal:
+            journal.start_video(file_path, output)
+
+        with tempfile.NamedTemporaryFile() as log_file:
+            try:
+                compression_result = compress(
+                    file_path,
+                    mime_type,
+                    output,
+                    settings['target_size'],
+                    settings['fps_mode'],
+                    settings['extra_quality'],
+                    settings['codec'],
+                    settings['use_ha'],
+                    settings['tolerance'],
+                    print_progress,
+                    log_file.name,
+                    lambda: False,
+                    show_attempt_details,
+                    show_attempt_fail,
+                    media_info,
+                    args.exact_frame_count,
+                    RateSearch.PROPORTIONAL if (
+                        args.rate_search == 'proportional'
+                    ) else RateSearch.SECANT,
+                    settings['calibrate'],
+                    None if args.no_early_abort else EARLY_ABORT_MARGIN,
+                    chunk_workers=args.parallel_chunks,
+                    intermediate_budget_MiB=args.intermediate_budget,
+                    threads=args.threads,
+                    resume_attempts=journal.get_attempts(file_path) if (
+                        journal
+                    ) else (),
+                    on_attempt_done=partial(
+                        journal.add_attempt,
+                        file_path
+                    ) if journal else None,
+                    resume_factor=journal.get_resume_factor(file_path) if (
+                        journal
+                    ) else None,
+                    on_attempt_start=partial(
+                        journal.start_attempt,
+                        file_path
+                    ) if journal else None,
+                    checkpoint=args.resumable
+                )
+            except KeyboardInterrupt as e:
+                print("\n\n*** Compression Cancelled ***")
+                cancelled = True
+
+        if type(compression_result) is str:
+            print('\n\n*** COMPRESSION ERROR ***')
+            print(compression_result)
+        elif type(compression_result) is int:
+            end_size_bytes = compression_result
+            end_size_mb = round(end_size_bytes / 1024 / 1024, 1)
+            print(f'\n\nVideo compressed to {end_size_mb} MiB.')
+
+        if journal and not cancelled:
+            # Cancelled videos stay in progress, so that resuming replaces
+            # their partial output.
+            journal.finish_video(
+                file_path,
+                SourceState.COMPLETE if (
+                    type(compression_result) is int
+                ) else SourceState.ERROR,
+                compression_result if (
+                    type(compression_result) is int
+                ) else None
             )
-        except KeyboardInterrupt as e:
-            print("\n\n*** Compression Cancelled ***")
 
-    if type(compression_result) is str:
-        print('\n\n*** COMPRESSION ERROR ***')
-        print(compression_result)
-    elif type(compression_result) is int:
-        end_size_bytes = compression_result
-        end_size_mb = round(end_size_bytes / 1024 / 1024, 1)
-        print(f'\n\nVideo compressed to {end_size_mb} MiB.')
+        return not cancelled
+
+    if args.resume is not None:
+        if args.resume:
+            journal = batch_journal.load_journal(Path(args.resume))
+        else:
+            unfinished_journals = batch_journal.get_unfinished_journals()
+            journal = unfinished_journals[0] if unfinished_journals else None
+
+        if journal is None or not journal.lock():
+            print('No interrupted batch to resume')
+            raise SystemExit(1)
+
+        settings = journal.get_settings()
+        jobs = []
+
+        for video_path in journal.get_video_paths():
+            entry = journal.get_video(video_path)
+
+            if entry['state'] == SourceState.COMPLETE:
+                print(f'Skipping {video_path} (already compressed)')
+                continue
+
+            if entry['state'] == SourceState.COMPRESSING and entry['output']:
+                # Left behind by a compression that was interrupted.
+                try:
+                    os.remove(entry['output'])
+                except OSError:
+                    pass
+
+            output = entry['output'] or get_unique_path(os.path.join(
+                journal.get_destination_dir(),
+                f"{Path(video_path).stem}{settings['suffix']}.mp4"
+            ))
+
+            jobs.append((video_path, output))
+    else:
+        settings = {
+            'target_size': args.target_size,
+            'fps_mode': get_fps_mode(),
+            'codec': get_video_codec(),
+            'extra_quality': args.extra_quality,
+            'tolerance': args.tolerance,
+            'use_ha': not args.software_encode,
+            'calibrate': args.calibrate,
+            'suffix': ' (compressed)'
+        }
+        # Absolute, so the batch can be resumed from any directory.
+        file_path = os.path.abspath(args.file_path)
+        output = os.path.abspath(args.output)
+
+        journal = batch_journal.create_journal(
+            os.path.dirname(output),
+            settings,
+            [file_path]
+        )
+        jobs = [(file_path, output)]
 
+    for file_path, output in jobs:
+        if not compress_file(file_path, output, settings, journal):
+            if journal:
+                print(f'\nResume with: constrict-cli --resume {journal.path}')
+                journal.unlock()
+            break
+    else:
+        if journal:
+            journal.remove()
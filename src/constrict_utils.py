@@ -23,14 +23,24 @@ import sys
 import subprocess
 import os
 import argparse
-import re
+import json
+import math
+import contextvars
+import shutil
+import threading
 from pathlib import Path
-from tempfile import TemporaryFile
-from typing import List, Optional, Tuple, Callable
+from tempfile import TemporaryFile, TemporaryDirectory
+from typing import List, Optional, Tuple, Callable, NamedTuple, Sequence
 try:
-    from constrict.enums import FpsMode, VideoCodec
+    from constrict.enums import FpsMode, VideoCodec, RateSearch
+    from constrict import probe_cache, rate_history, ffmpeg_supervisor
+    from constrict import chunk_checkpoint
 except ModuleNotFoundError:
-    from enums import FpsMode, VideoCodec
+    from enums import FpsMode, VideoCodec, RateSearch
+    import probe_cache
+    import rate_history
+    import ffmpeg_supervisor
+    import chunk_checkpoint
 from gettext import gettext as _
 
 
@@ -40,18 +50,317 @@ from gettext import gettext as _
 MAX_VIDEO_BITRATE = 100000000
 MAX_FRAMERATE = 240
 
-def get_duration(file_input: str) -> float:
-    """ Gets the duration of a video passed in seconds. """
-    return float(
-        subprocess.check_output([
-            "ffprobe",
-            "-v", "error",
-            "-show_entries", "format=duration",
-            "-of", "default=noprint_wrappers=1:nokey=1",
-            file_input
-        ])[:-1]
+# Calibration encodes this many samples of this many seconds each, for source
+# videos at least CALIBRATION_MIN_DURATION seconds long.
+CALIBRATION_SAMPLES = 5
+CALIBRATION_SAMPLE_SECONDS = 10
+CALIBRATION_MIN_DURATION = 300
+
+# Attempts are abandoned if their projected size is this many percent of the
+# target size outside of the tolerance window, once at least
+# EARLY_ABORT_MIN_PROGRESS of the video has been encoded.
+EARLY_ABORT_MARGIN = 15.0
+EARLY_ABORT_MIN_PROGRESS = 0.2
+
+# The ffprobe codec names of the streams that can be copied into the output,
+# rather than re-encoded, for each VideoCodec.
+REMUX_VIDEO_CODECS = {
+    VideoCodec.H264: 'h264',
+    VideoCodec.HEVC: 'hevc',
+    VideoCodec.AV1: 'av1',
+    VideoCodec.VP9: 'vp9'
+}
+
+# Profiles of each codec (as named by ffprobe) that transcoding would also
+# produce, given it always outputs 8-bit 4:2:0 video, and H.264 in the Main
+# profile. Sources in any other profile are transcoded rather than remuxed,
+# so remuxed videos play wherever transcoded ones do.
+REMUX_VIDEO_PROFILES = {
+    VideoCodec.H264: ('Constrained Baseline', 'Main'),
+    VideoCodec.HEVC: ('Main',),
+    VideoCodec.AV1: ('Main',),
+    VideoCodec.VP9: ('Profile 0',)
+}
+
+# Chunked encoding splits videos into chunks no shorter than this, in seconds.
+MIN_CHUNK_SECONDS = 120
+
+# Resumable transcodes are split into chunks no longer than this, in seconds,
+# so no more than this much encoding is lost when one is interrupted.
+CHECKPOINT_CHUNK_SECONDS = 300
+
+# Default number of chunks encoded at once in chunked mode. Each encoder
+# already uses several threads, so one chunk per core would oversubscribe.
+DEFAULT_CHUNK_WORKERS = max((os.cpu_count() or 1) // 4, 2)
+
+# Source audio in these codecs is copied into compressed videos as-is, if its
+# bitrate is already low enough.
+PASSTHROUGH_AUDIO_CODECS = ['opus', 'aac']
+
+# Encoders whose first pass statistics stay valid for a second pass at a
+# different bitrate, as long as the resolution, framerate and preset match.
+REUSABLE_PASS_ENCODERS = ['libx264', 'libx265', 'libvpx-vp9']
+
+# Retries at a resolution and framerate this many times cheaper to decode than
+# the source read from a downscaled intermediate, if enabled. See
+# make_intermediate().
+INTERMEDIATE_MIN_SCALE = 2.0
+
+# Quality and expected bits per pixel of intermediates, and space left free
+# on their disk when making them.
+INTERMEDIATE_CRF = 10
+INTERMEDIATE_BITS_PER_PIXEL = 1.5
+INTERMEDIATE_FREE_SPACE_MARGIN = 512 * 1024 * 1024
+
+# Roughly how many cores a single software encode of each codec keeps busy.
+# Encoders that scale poorly across threads leave room for more videos to be
+# compressed at the same time.
+CODEC_THREAD_SCALING = {
+    VideoCodec.H264: 8,
+    VideoCodec.HEVC: 6,
+    VideoCodec.AV1: 12,
+    VideoCodec.VP9: 4
+}
+
+# Rough encoding time per pixel of each codec, relative to H.264, used to
+# compare the cost of compressing different videos.
+CODEC_SPEED_FACTORS = {
+    VideoCodec.H264: 1.0,
+    VideoCodec.HEVC: 2.5,
+    VideoCodec.AV1: 4.0,
+    VideoCodec.VP9: 3.0
+}
+
+# Extra Quality uses slower presets, taking roughly this much longer.
+EXTRA_QUALITY_SPEED_FACTOR = 1.5
+
+class MediaInfo(NamedTuple):
+    """ Properties of a source video, as read by a single ffprobe call """
+    duration: float
+    width: int
+    height: int
+    fps: float  # -1 if no valid framerate is found
+    frame_count: int
+    frame_count_estimated: bool  # True if not read from container metadata
+    rotation: int
+    subtitle_streams: Tuple[int, ...]
+    audio_bitrate: int  # 0 if there is no audio stream
+    audio_channel_count: int
+    audio_codec: Optional[str]
+    video_codec: Optional[str]
+    video_pix_fmt: Optional[str]
+    video_profile: Optional[str]
+
+
+def parse_fraction(fraction: Optional[str]) -> float:
+    """ Converts an ffprobe fraction string (e.g. '30000/1001') to a float.
+    Returns -1 if the fraction is missing or has a denominator of 0.
+    """
+    try:
+        numerator, denominator = (fraction or '').split('/')
+        numerator, denominator = int(numerator), int(denominator)
+    except ValueError:
+        return -1
+
+    if denominator == 0:
+        return -1
+
+    return numerator / denominator
+
+
+def estimate_frame_count(
+    video_stream: dict,
+    duration: float,
+    fps: float
+) -> Tuple[int, bool]:
+    """ Gets the number of frames in a video stream without reading through
+    the whole file, for sizing progress bars.
+
+    The frame count stored in the container (e.g. an MP4's sample table) is
+    used if there is one. Otherwise, it's estimated from the video's duration
+    and average framerate. Returns the frame count, and whether it was
+    estimated. An exact count can be made with count_frames().
+    """
+    try:
+        nb_frames = int(video_stream.get('nb_frames', ''))
+    except ValueError:
+        nb_frames = 0
+
+    if nb_frames > 0:
+        return (nb_frames, False)
+
+    if fps > 0 and duration > 0:
+        return (max(int(round(duration * fps)), 1), True)
+
+    return (1, True)
+
+
+def count_frames(
+    file_input: str,
+    cancel_event: Callable[[], bool] = lambda: False
+) -> Optional[int]:
+    """ Gets the exact number of frames in a video at the passed file path, by
+    counting every packet of the video stream. This can take a long time on
+    large files, so is best run in the background.
+
+    ffprobe is run by the ffmpeg_supervisor module, so it's paused, pinned
+    and deprioritized along with the rest of a compression. Returns None if
+    cancelled. Raises subprocess.CalledProcessError if ffprobe fails.
+    """
+    cmd = [
+        'ffprobe',
+        '-v', 'error',
+        '-select_streams', 'v:0',
+        '-count_packets',
+        '-show_entries', 'stream=nb_read_packets',
+        '-of', 'default=noprint_wrappers=1:nokey=1',
+        file_input
+    ]
+
+    lines = []
+
+    returncode, stopped = ffmpeg_supervisor.get_supervisor().run(
+        cmd,
+        lambda line: lines.append(line) and False,
+        cancel_event
+    )
+
+    if stopped:
+        return None
+
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+    try:
+        frame_count = int(''.join(lines))
+    except ValueError:
+        frame_count = 1
+
+    return frame_count
+
+
+def get_cached_media_info(file_input: str) -> Optional[MediaInfo]:
+    """ Gets the properties of a video at the passed file path from the
+    persistent probe cache, if the file hasn't changed since it was cached.
+    """
+    data = probe_cache.lookup(file_input)
+
+    if not isinstance(data, dict):
+        return None
+
+    try:
+        data['subtitle_streams'] = tuple(data['subtitle_streams'])
+        return MediaInfo(**data)
+    except (KeyError, TypeError):
+        return None
+
+
+def cache_media_info(file_input: str, media_info: MediaInfo) -> None:
+    """ Stores the properties of a video at the passed file path in the
+    persistent probe cache.
+    """
+    probe_cache.store(file_input, media_info._asdict())
+
+
+def probe_media(file_input: str, use_cache: bool = True) -> MediaInfo:
+    """ Gets all properties of a video at the passed file path needed for
+    compression, with a single ffprobe call. Results are kept in a persistent
+    cache, so a file is only probed again if it has changed.
+
+    Raises subprocess.CalledProcessError if ffprobe can't read the file, or
+    ValueError if properties needed for compression are missing or invalid.
+    """
+    if use_cache:
+        cached = get_cached_media_info(file_input)
+        if cached is not None:
+            return cached
+
+    cmd = [
+        'ffprobe',
+        '-v', 'error',
+        '-show_streams',
+        '-show_format',
+        '-of', 'json',
+        file_input
+    ]
+
+    probe = json.loads(subprocess.check_output(cmd).decode('utf-8'))
+    streams = probe.get('streams', [])
+    container = probe.get('format', {})
+
+    video = next(
+        (x for x in streams if x.get('codec_type') == 'video'),
+        None
+    )
+    audio = next(
+        (x for x in streams if x.get('codec_type') == 'audio'),
+        None
+    )
+
+    if video is None:
+        raise subprocess.CalledProcessError(1, cmd, b'', b'No video stream')
+
+    duration = float(container.get('duration', video.get('duration', 'N/A')))
+    fps = parse_fraction(video.get('avg_frame_rate'))
+
+    frame_count, frame_count_estimated = estimate_frame_count(
+        video,
+        duration,
+        fps
+    )
+
+    rotation = 0
+    for side_data in video.get('side_data_list', []):
+        if 'rotation' in side_data:
+            try:
+                rotation = int(side_data['rotation'])
+            except ValueError:
+                rotation = 0
+
+    compatible_codecs = ['subrip', 'webvtt', 'ass', 'mov_text']
+    subtitle_streams = tuple(
+        int(x.get('index', '')) for x in streams
+        if x.get('codec_type') == 'subtitle'
+        and x.get('codec_name') in compatible_codecs
+    )
+
+    if audio is None:
+        audio_bitrate = 0
+    else:
+        try:
+            audio_bitrate = int(audio.get('bit_rate', ''))
+        except ValueError:
+            # Audio stream is using variable bitrate, or the bitrate couldn't
+            # be read. Use a high bitrate to be safe.
+            audio_bitrate = 128000
+
+    try:
+        audio_channel_count = int(audio.get('channels', '')) if audio else 1
+    except ValueError:
+        audio_channel_count = 1
+
+    media_info = MediaInfo(
+        duration=duration,
+        width=int(video.get('width', '')),
+        height=int(video.get('height', '')),
+        fps=fps,
+        frame_count=frame_count,
+        frame_count_estimated=frame_count_estimated,
+        rotation=rotation,
+        subtitle_streams=subtitle_streams,
+        audio_bitrate=audio_bitrate,
+        audio_channel_count=audio_channel_count,
+        audio_codec=audio.get('codec_name') if audio else None,
+        video_codec=video.get('codec_name'),
+        video_pix_fmt=video.get('pix_fmt'),
+        video_profile=video.get('profile')
     )
 
+    if use_cache:
+        cache_media_info(file_input, media_info)
+
+    return media_info
+
 def get_res_preset(
     bitrate: int,
     source_width: int,
@@ -157,27 +466,91 @@ def get_encoding_speed(
         case _:
             sys.exit('Error: unknown codec passed to get_encoding_speed')
 
+class ProgressSample(NamedTuple):
+    """ One block of progress reported by ffmpeg's -progress option """
+    frame: int
+    fps: float
+    out_time_us: int
+    total_size: int
+    bitrate: Optional[float]  # In kbit/s. None if not known yet
+    speed: Optional[float]  # Multiple of real time. None if not known yet
+    dup_frames: int
+    drop_frames: int
+    end: bool  # Whether this is the last block before ffmpeg exits
+
+class ProgressParser:
+    """ Groups the key=value lines written by ffmpeg's -progress option into
+    a ProgressSample for every block, passing each to a subscriber.
+    """
+    def __init__(self, on_sample: Callable[[ProgressSample], bool]) -> None:
+        self.on_sample = on_sample
+        self.fields = {}
+
+    def feed(self, line: str) -> bool:
+        """ Parse a line of ffmpeg output. Returns what the subscriber
+        returned, if the line completed a block, otherwise False.
+        """
+        key, separator, value = line.strip().partition('=')
+
+        if not separator:
+            return False
+
+        if key != 'progress':
+            self.fields[key] = value
+            return False
+
+        sample = self.get_sample(value == 'end')
+        self.fields = {}
+
+        return self.on_sample(sample)
+
+    def get_number(self, key: str, suffix: str = '') -> Optional[float]:
+        """ Return the numeric value of a field in the current block, or None
+        if it's missing or unknown (N/A)
+        """
+        try:
+            return float(self.fields[key].removesuffix(suffix))
+        except (KeyError, ValueError):
+            return None
+
+    def get_sample(self, end: bool) -> ProgressSample:
+        """ Return the current block as a ProgressSample """
+        return ProgressSample(
+            frame=int(self.get_number('frame') or 0),
+            fps=self.get_number('fps') or 0.0,
+            out_time_us=int(self.get_number('out_time_us') or 0),
+            total_size=int(self.get_number('total_size') or 0),
+            bitrate=self.get_number('bitrate', 'kbits/s'),
+            speed=self.get_number('speed', 'x'),
+            dup_frames=int(self.get_number('dup_frames') or 0),
+            drop_frames=int(self.get_number('drop_frames') or 0),
+            end=end
+        )
+
 def get_progress(
     file_input: str,
     ffmpeg_cmd: List[str],
     output_fn: Callable[[float, Optional[int]], None],
-    frame_count: int,
+    frame_count_getter: Callable[[], int],
     pass_num: Optional[int],
     last_pass_avg_fps: Optional[float],
-    cancel_event: Callable
+    cancel_event: Callable,
+    size_monitor: Optional[Callable[[int, float], bool]] = None,
+    on_sample: Optional[Callable[[ProgressSample], None]] = None
 ) -> Tuple[Optional[float], Optional[str]]:
     """ Continuously output transcoding progress from an ffmpeg command to a
     passed function.
 
     Needs the total number of frames of the video to calculate an accurate
     percentage of completion based on the current frame being processed by
-    ffmpeg. We also need a pass number to represent 2-pass encoding as one
-    continuous progress state (so, 100% of pass 1 means 50% is passed to the
-    output function). If no pass number is passed, then the progress of the
-    transcode will just be output as the progress overall -- useful for VP9,
-    where pass 1 just has a progress bar in activity mode because ffmpeg
-    doesn't report VP9 pass 1 progress, so the progress bar can go from 0-100%
-    in pass 2 only.
+    ffmpeg. This is passed as a getter, so that an estimated frame count can
+    be replaced by a more accurate one mid-transcode. We also need a pass
+    number to represent 2-pass encoding as one continuous progress state (so,
+    100% of pass 1 means 50% is passed to the output function). If no pass
+    number is passed, then the progress of the transcode will just be output
+    as the progress overall -- useful for VP9, where pass 1 just has a
+    progress bar in activity mode because ffmpeg doesn't report VP9 pass 1
+    progress, so the progress bar can go from 0-100% in pass 2 only.
 
     If pass 2 of an ffmpeg transcode is being passed to this function, it's
     worth also passing pass 1's average FPS (frames per second) value, to
@@ -185,90 +558,102 @@ def get_progress(
     anomalous values at the start.
 
     Finally, function that gets a 'cancelled' state should be passed, so the
-    subprocess can be killed and we can return to the rest of the progress as
-    soon as possible.
+    subprocess can be stopped and we can return to the rest of the progress as
+    soon as possible. The subprocess is run by the ffmpeg_supervisor module.
+
+    Optionally, a size monitor can be passed. It's called with the number of
+    bytes written so far and the seconds of media encoded so far, and if it
+    returns True, the subprocess is stopped as if cancelled.
+
+    Every block of progress ffmpeg reports is also passed to on_sample as a
+    ProgressSample, if passed, for anything beyond the progress fraction and
+    time remaining (e.g. encoding speed).
 
     Returns None if there's no problem while getting progress of an ffmpeg
     operation. If there's an error, the error details will be returned.
     """
     with TemporaryFile() as err_file:
-        proc = subprocess.Popen(
-            ffmpeg_cmd,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=err_file
-        )
-
-        frame = 0
         fps_sum = 0.0
         pulse_counter = 0
         avg_counter = 0
 
-        if proc.stdout is not None:
-            for line in proc.stdout:
-                line_string = line.decode('utf-8')
-
-                if re.search('^frame=.*$', line_string):
-                    frame_match = re.search('[0-9]+', line_string)
-                    if frame_match:
-                        frame = int(frame_match.group())
-                elif re.search('^fps=.*$', line_string):
-                    total_frames = frame_count * (1 if pass_num is None else 2)
-                    current_frame = frame_count * (pass_num or 0) + frame
-                    progress_fraction = current_frame / total_frames
-                    pulse_counter += 1
-
-                    if pulse_counter < 10 or (pass_num == 1 and pulse_counter < 20):
-                        # The first few frames of a pass are kind of
-                        # unpredictable. The average FPS is anomalously low
-                        # compared before it starts to 'warm up' to a
-                        # relatively consistent value. Therefore, we don't
-                        # display the time remaining on the first few frames of
-                        # the first pass, and we just use the last pass'
-                        # average FPS to calculate time remaining on the first
-                        # few frames of the second pass.
-
-                        # We are slightly more lenient on the first pass, since
-                        # it's more important the user can see the estimated
-                        # time earlier on. We are more careful with pass 2,
-                        # because it suddenly makes the estimated time look
-                        # jumpy and inconsistent once progress reaches 50%, if
-                        # using anomalous FPS values.
-                        fps = last_pass_avg_fps
-                    else:
-                        fps_match = re.search('[0-9]+[.]?[0-9]*', line_string)
-                        if fps_match:
-                            fps = float(fps_match.group())
-
-                            avg_counter += 1
-                            fps_sum += fps
-
-                    frames_left = total_frames - current_frame
-
-                    seconds_left = None
-
-                    if fps:
-                        seconds_left = int(frames_left // fps)
-                        if seconds_left < 0:
-                            seconds_left = 0
-
-                    if frame > frame_count:
-                        if pass_num == 0:
-                            output_fn(0.5, seconds_left)
-                        else:
-                            seconds_left = -1
-                            output_fn(1.0, seconds_left)
-                    else:
-                        output_fn(progress_fraction, seconds_left)
-
-                if cancel_event() == True:
-                    proc.kill()
-                    return (None, None)
+        def handle_sample(sample: ProgressSample) -> bool:
+            nonlocal fps_sum, pulse_counter, avg_counter
+
+            if on_sample is not None:
+                on_sample(sample)
+
+            frame = sample.frame
+
+            frame_count = frame_count_getter()
+            total_frames = frame_count * (1 if pass_num is None else 2)
+            current_frame = frame_count * (pass_num or 0) + frame
+            progress_fraction = current_frame / total_frames
+            pulse_counter += 1
+
+            if pulse_counter < 10 or (pass_num == 1 and pulse_counter < 20):
+                # The first few frames of a pass are kind of
+                # unpredictable. The average FPS is anomalously low
+                # compared before it starts to 'warm up' to a
+                # relatively consistent value. Therefore, we don't
+                # display the time remaining on the first few frames of
+                # the first pass, and we just use the last pass'
+                # average FPS to calculate time remaining on the first
+                # few frames of the second pass.
+
+                # We are slightly more lenient on the first pass, since
+                # it's more important the user can see the estimated
+                # time earlier on. We are more careful with pass 2,
+                # because it suddenly makes the estimated time look
+                # jumpy and inconsistent once progress reaches 50%, if
+                # using anomalous FPS values.
+                fps = last_pass_avg_fps
+            else:
+                fps = sample.fps
 
-        avg = fps_sum / avg_counter if avg_counter else None
+                avg_counter += 1
+                fps_sum += fps
+
+            frames_left = total_frames - current_frame
+
+            seconds_left = None
+
+            if fps:
+                seconds_left = int(frames_left // fps)
+                if seconds_left < 0:
+                    seconds_left = 0
+
+            if frame > frame_count:
+                if pass_num == 0:
+                    output_fn(0.5, seconds_left)
+                else:
+                    seconds_left = -1
+                    output_fn(1.0, seconds_left)
+            else:
+                output_fn(progress_fraction, seconds_left)
+
+            out_time = sample.out_time_us / 1000000
+
+            if size_monitor and out_time > 0:
+                return size_monitor(sample.total_size, out_time)
+
+            return False
 
-        proc.wait()
-        returncode = proc.poll()
+        parser = ProgressParser(handle_sample)
+
+        # The process is stopped as soon as it's cancelled, not just when it
+        # next outputs a line.
+        returncode, stopped = ffmpeg_supervisor.get_supervisor().run(
+            ffmpeg_cmd,
+            parser.feed,
+            cancel_event,
+            err_file
+        )
+
+        if stopped:
+            return (None, None)
+
+        avg = fps_sum / avg_counter if avg_counter else None
 
         if returncode != 0:
             err_file.flush()
@@ -281,6 +666,42 @@ def get_progress(
 
         return (avg, None)
 
+def get_job_threads(codec: int, use_ha: bool, chunked: bool) -> int:
+    """ Return roughly how many CPU cores compressing one video with the
+    passed settings keeps busy.
+    """
+    cores = os.cpu_count() or 1
+
+    # Chunked encoding is meant to use every core on its own. The GPU only
+    # has so many encoding sessions, so don't let them compete either.
+    if chunked or use_ha:
+        return cores
+
+    return min(CODEC_THREAD_SCALING.get(codec, cores), cores)
+
+def estimate_job_cost(
+    media_info: Optional[MediaInfo],
+    codec: int,
+    extra_quality: bool
+) -> float:
+    """ Return a number proportional to how long compressing a video with the
+    passed properties should take, for comparing videos with each other.
+    Returns 0 if the video's properties are unknown.
+    """
+    if media_info is None:
+        return 0
+
+    # Videos with an unknown framerate are assumed to be 30 FPS.
+    fps = media_info.fps if media_info.fps > 0 else 30
+
+    cost = media_info.duration * media_info.width * media_info.height * fps
+    cost *= CODEC_SPEED_FACTORS.get(codec, 1.0)
+
+    if extra_quality:
+        cost *= EXTRA_QUALITY_SPEED_FACTOR
+
+    return cost
+
 def get_video_encoder(codec, use_ha):
     cv_params = {
         VideoCodec.H264: 'h264_vaapi' if use_ha else 'libx264',
@@ -291,46 +712,139 @@ def get_video_encoder(codec, use_ha):
 
     return cv_params[codec]
 
-def transcode(
+def get_thread_args(
+    video_encoder: str,
+    threads: Optional[int]
+) -> List[str]:
+    """ Returns ffmpeg output arguments limiting the passed video encoder to
+    the passed number of threads. Returns no arguments if threads is None,
+    which lets the encoder assume it has every core to itself.
+    """
+    if threads is None:
+        return []
+
+    thread_args = ['-threads', f'{threads}']
+
+    match video_encoder:
+        case 'libx265':
+            # x265 sizes its own thread pool, ignoring -threads.
+            thread_args.extend(['-x265-params', f'pools={threads}'])
+        case 'libsvtav1':
+            thread_args.extend(['-svtav1-params', f'lp={threads}'])
+        case 'libvpx-vp9':
+            # Each tile column can be encoded by its own thread.
+            tile_columns = min(max(threads.bit_length() - 1, 0), 4)
+            thread_args.extend(['-tile-columns', f'{tile_columns}'])
+
+    return thread_args
+
+def get_segment_args(
+    start_time: Optional[float],
+    segment_duration: Optional[float]
+) -> List[str]:
+    """ Returns ffmpeg input arguments to only read a segment of a video """
+    args = []
+
+    if start_time is not None:
+        args.extend(['-ss', f'{start_time:.3f}'])
+
+    if segment_duration is not None:
+        args.extend(['-t', f'{segment_duration:.3f}'])
+
+    return args
+
+def get_encoder_settings(
+    video_bitrate: int,
+    width: int,
+    height: int,
+    codec: int,
+    use_ha: bool,
+    extra_quality: bool
+) -> Tuple[str, str, bool]:
+    """ Returns the ffmpeg video encoder, encoding speed preset, and whether
+    hardware acceleration will actually be used, for a transcode with the
+    passed settings.
+    """
+    portrait = height > width
+    frame_height = width if portrait else height
+
+    low_bitrate = True if video_bitrate < 276000 else False
+
+    preset = get_encoding_speed(frame_height, low_bitrate, codec, extra_quality)
+
+    if low_bitrate:
+        use_ha = False
+
+    return (get_video_encoder(codec, use_ha), preset, use_ha)
+
+def get_first_pass_key(
+    video_bitrate: int,
+    width: int,
+    height: int,
+    framerate: float,
+    codec: int,
+    use_ha: bool,
+    extra_quality: bool
+) -> Optional[Tuple]:
+    """ Returns a key identifying the first pass statistics a transcode with
+    the passed settings would produce. A later transcode with the same key can
+    reuse those statistics, skipping its first pass, even if its bitrate is
+    different.
+
+    Returns None if the statistics can't be reused with this encoder.
+    """
+    video_encoder, preset, use_ha = get_encoder_settings(
+        video_bitrate,
+        width,
+        height,
+        codec,
+        use_ha,
+        extra_quality
+    )
+
+    if video_encoder not in REUSABLE_PASS_ENCODERS:
+        return None
+
+    return (video_encoder, preset, width, height, framerate)
+
+def run_first_pass(
     file_input: str,
-    file_output: str,
     video_bitrate: int,
-    audio_bitrate: int,
     width: int,
     height: int,
     rotation: int,
-    subtitle_streams: List[int],
     framerate: float,
     codec: int,
     use_ha: bool,
     extra_quality: bool,
     output_fn: Callable[[float, Optional[int]], None],
-    frame_count: int,
+    frame_count_getter: Callable[[], int],
     log_path: Optional[str],
-    cancel_event: Callable[[], bool]
-) -> Optional[str]:
+    cancel_event: Callable[[], bool],
+    start_time: Optional[float] = None,
+    segment_duration: Optional[float] = None,
+    threads: Optional[int] = None
+) -> Tuple[Optional[float], Optional[str]]:
     """
-    Transcode a video to a passed destination with the passed settings.
+    Run the first pass of a two-pass transcode with the passed settings,
+    writing its statistics to log_path. See transcode().
 
-    Returns None if there's no problem with transcoding.
-    If there's an error while transcoding, it'll return with the details of the
-    error.
+    Returns the average encoding speed of the pass (if known), and the error
+    details if there was an error.
     """
-    portrait = height > width
-    frame_height = width if portrait else height
-
-    low_bitrate = True if video_bitrate < 276000 else False
+    video_encoder, preset, use_ha = get_encoder_settings(
+        video_bitrate,
+        width,
+        height,
+        codec,
+        use_ha,
+        extra_quality
+    )
 
     preset_name = '-cpu-used' if codec == VideoCodec.VP9 else '-preset'
-    preset = get_encoding_speed(frame_height, low_bitrate, codec, extra_quality)
-
-    if low_bitrate:
-        use_ha = False
 
     gpu_filters = ',format=nv12,hwupload' if use_ha else ''
 
-    video_encoder = get_video_encoder(codec, use_ha)
-
     pass1_cmd = [
         'ffmpeg',
         '-y',
@@ -340,6 +854,12 @@ def transcode(
     if use_ha:
         pass1_cmd.extend(['-vaapi_device', '/dev/dri/renderD128'])
 
+    pass1_cmd.extend(get_segment_args(start_time, segment_duration))
+
+    if threads is not None:
+        # Limits decoding threads too.
+        pass1_cmd.extend(['-threads', f'{threads}'])
+
     pass1_cmd.extend([
         '-display_rotation', f'{rotation}',
         '-noautorotate',
@@ -369,6 +889,11 @@ def transcode(
         '-b:v', str(video_bitrate) + '',
         '-pix_fmt', 'yuv420p',
         '-pass', '1',
+    ])
+
+    pass1_cmd.extend(get_thread_args(video_encoder, threads))
+
+    pass1_cmd.extend([
         '-an',
         '-sn',
         '-f', 'null',
@@ -376,22 +901,114 @@ def transcode(
     ])
 
     if cancel_event():
-        return None
+        return (None, None)
 
-    avg_fps, progress_error = get_progress(
+    return get_progress(
         file_input,
         pass1_cmd,
         output_fn,
-        frame_count,
+        frame_count_getter,
         None if codec == VideoCodec.VP9 and not use_ha else 0,
         None,
         cancel_event
     )
 
-    if progress_error != None:
-        return progress_error
+def transcode(
+    file_input: str,
+    file_output: str,
+    video_bitrate: int,
+    audio_bitrate: int,
+    width: int,
+    height: int,
+    rotation: int,
+    subtitle_streams: Sequence[int],
+    audio_channel_count: int,
+    framerate: float,
+    codec: int,
+    use_ha: bool,
+    extra_quality: bool,
+    output_fn: Callable[[float, Optional[int]], None],
+    frame_count_getter: Callable[[], int],
+    log_path: Optional[str],
+    cancel_event: Callable[[], bool],
+    start_time: Optional[float] = None,
+    segment_duration: Optional[float] = None,
+    skip_first_pass: bool = False,
+    size_monitor: Optional[Callable[[int, float], bool]] = None,
+    audio_source: Optional[str] = None,
+    video_only: bool = False,
+    on_second_pass: Optional[Callable[[], None]] = None,
+    video_source: Optional[str] = None,
+    threads: Optional[int] = None
+) -> Optional[str]:
+    """
+    Transcode a video to a passed destination with the passed settings.
+
+    Optionally, only a segment of the video can be transcoded, beginning at
+    start_time and lasting segment_duration (both in seconds).
+
+    If skip_first_pass is set, the first pass statistics already at log_path
+    are reused. This is only valid if they were made by an earlier transcode
+    with the same get_first_pass_key().
+
+    A size monitor can be passed to abort the second pass early. See
+    get_progress().
+
+    If an audio source is passed (see prepare_audio()), its first audio stream
+    is copied into the output instead of encoding the input's audio. If
+    video_only is set, the output has no audio or subtitles at all.
 
-    audio_channels = min(get_audio_channel_count(file_input), 2)
+    on_second_pass is called just before the second pass starts, if passed.
+
+    If a video source is passed (see make_intermediate()), video is read from
+    it instead of the input, which is then only used for audio and subtitles.
+
+    If threads is passed, the encoder is limited to that many threads. See
+    get_thread_args().
+
+    Returns None if there's no problem with transcoding.
+    If there's an error while transcoding, it'll return with the details of the
+    error.
+    """
+    video_encoder, preset, use_ha = get_encoder_settings(
+        video_bitrate,
+        width,
+        height,
+        codec,
+        use_ha,
+        extra_quality
+    )
+
+    preset_name = '-cpu-used' if codec == VideoCodec.VP9 else '-preset'
+
+    gpu_filters = ',format=nv12,hwupload' if use_ha else ''
+
+    avg_fps = None
+
+    if not skip_first_pass:
+        avg_fps, progress_error = run_first_pass(
+            video_source or file_input,
+            video_bitrate,
+            width,
+            height,
+            rotation,
+            framerate,
+            codec,
+            use_ha,
+            extra_quality,
+            output_fn,
+            frame_count_getter,
+            log_path,
+            cancel_event,
+            start_time,
+            segment_duration,
+            threads
+        )
+
+        if progress_error != None:
+            return progress_error
+
+    audio_channels = min(audio_channel_count, 2)
 
     pass2_cmd = [
         'ffmpeg',
@@ -402,18 +1019,46 @@ def transcode(
     if use_ha:
         pass2_cmd.extend(['-vaapi_device', '/dev/dri/renderD128'])
 
+    pass2_cmd.extend(get_segment_args(start_time, segment_duration))
+
+    if threads is not None:
+        # Limits decoding threads too.
+        pass2_cmd.extend(['-threads', f'{threads}'])
+
     pass2_cmd.extend([
         '-display_rotation', f'{rotation}',
         '-noautorotate',
-        '-i', f'{file_input}',
-        f'{preset_name}', f'{preset}',
-        '-vf', f'scale={width}:{height}{gpu_filters}',
+        '-i', f'{video_source or file_input}',
     ])
 
-    if log_path is not None:
-        pass2_cmd.extend(['-passlogfile', f'{log_path}'])
+    # Index of the input that audio and subtitles are taken from.
+    source_index = 0
+    input_count = 1
 
-    if codec == VideoCodec.VP9:
+    if video_source is not None and not video_only:
+        pass2_cmd.extend(['-i', f'{file_input}'])
+        source_index = input_count
+        input_count += 1
+
+    # Audio that has already been encoded (or needs no encoding) is muxed in
+    # as-is, rather than being encoded again with every attempt.
+    separate_audio = audio_source is not None and audio_source != file_input
+    audio_index = source_index
+
+    if separate_audio:
+        pass2_cmd.extend(['-i', f'{audio_source}'])
+        audio_index = input_count
+        input_count += 1
+
+    pass2_cmd.extend([
+        f'{preset_name}', f'{preset}',
+        '-vf', f'scale={width}:{height}{gpu_filters}',
+    ])
+
+    if log_path is not None:
+        pass2_cmd.extend(['-passlogfile', f'{log_path}'])
+
+    if codec == VideoCodec.VP9:
         pass2_cmd.extend([
             '-deadline', 'good',
             '-row-mt', '1',
@@ -431,19 +1076,33 @@ def transcode(
         '-b:v', str(video_bitrate) + '',
         '-pix_fmt', 'yuv420p',
         '-pass', '2',
-        '-c:a', 'libopus',
-        '-b:a', f'{audio_bitrate}',
-        '-ac', f'{audio_channels}',
-        '-map', '0:v:0',
-        '-map', '0:a:0?',
-        '-map_chapters', '-1'
     ])
 
-    for index in subtitle_streams:
-        pass2_cmd.extend(['-map', f'0:{index}'])
+    pass2_cmd.extend(get_thread_args(video_encoder, threads))
+
+    if video_only:
+        pass2_cmd.extend(['-an', '-sn'])
+    elif audio_source is None:
+        pass2_cmd.extend([
+            '-c:a', 'libopus',
+            '-b:a', f'{audio_bitrate}',
+            '-ac', f'{audio_channels}',
+        ])
+    else:
+        pass2_cmd.extend(['-c:a', 'copy'])
+
+    pass2_cmd.extend(['-map', '0:v:0'])
+
+    if not video_only:
+        pass2_cmd.extend(['-map', f'{audio_index}:a:0?'])
+
+        for index in subtitle_streams:
+            pass2_cmd.extend(['-map', f'{source_index}:{index}'])
+
+        pass2_cmd.extend(['-c:s', 'mov_text'])
 
     pass2_cmd.extend([
-        '-c:s', 'mov_text',
+        '-map_chapters', '-1',
         '-f', 'mp4',
         file_output
     ])
@@ -451,14 +1110,20 @@ def transcode(
     if cancel_event():
         return None
 
+    if on_second_pass is not None:
+        on_second_pass()
+
     avg_fps, progress_error = get_progress(
         file_input,
         pass2_cmd,
         output_fn,
-        frame_count,
-        None if codec == VideoCodec.VP9 and not use_ha else 1,
+        frame_count_getter,
+        None if (
+            codec == VideoCodec.VP9 and not use_ha
+        ) or skip_first_pass else 1,
         avg_fps,
-        cancel_event
+        cancel_event,
+        size_monitor
     )
 
     if progress_error != None:
@@ -467,138 +1132,283 @@ def transcode(
     return None
 
 
-def get_framerate(file_input: str) -> float:
-    """ Gets the framerate of a video at the passed file path. """
-    """ Returns -1 if no valid framerate is found """
-    cmd = [
-        'ffprobe',
-        '-v', '0',
-        '-of',
-        'default=noprint_wrappers=1:nokey=1',
-        '-select_streams', 'v:0',
-        '-show_entries',
-        'stream=avg_frame_rate',
-        file_input
-    ]
-    fps_bytes = subprocess.check_output(cmd)
-    fps_fraction = fps_bytes.decode('utf-8')
-    fps_fraction_split = fps_fraction.split('/')
-    fps_numerator = int(fps_fraction_split[0])
-    fps_denominator = int(fps_fraction_split[1])
+def transcode_chunked(
+    file_input: str,
+    file_output: str,
+    video_bitrate: int,
+    audio_bitrate: int,
+    width: int,
+    height: int,
+    rotation: int,
+    subtitle_streams: Sequence[int],
+    audio_channel_count: int,
+    framerate: float,
+    codec: int,
+    use_ha: bool,
+    extra_quality: bool,
+    output_fn: Callable[[float, Optional[int]], None],
+    duration: float,
+    log_path: Optional[str],
+    cancel_event: Callable[[], bool],
+    chunk_count: int,
+    skip_first_pass: bool = False,
+    audio_source: Optional[str] = None,
+    video_source: Optional[str] = None,
+    threads: Optional[int] = None,
+    chunk_workers: Optional[int] = None,
+    checkpoint: bool = False
+) -> Optional[str]:
+    """
+    Transcode a video like transcode(), but split into chunks of equal
+    duration that are encoded in parallel, then concatenated without
+    re-encoding. This lets encoders that don't scale well across many cores
+    make use of all of them on long videos.
 
-    if fps_denominator == 0:
-        return -1
+    Each chunk is encoded at the same average bitrate, so gets a share of the
+    bit budget in proportion to its duration. Every chunk starts on a new
+    keyframe, as each is encoded independently, so they can be joined
+    losslessly.
 
-    fps_float = fps_numerator / fps_denominator
-    return fps_float
+    Up to chunk_workers chunks are encoded at once (by default, all of them).
+    If threads is passed, it's shared between the chunks being encoded.
 
+    If checkpoint is set, finished chunks are kept until the transcode
+    completes, so that if it's interrupted, transcoding the same source with
+    the same settings again only encodes the chunks that weren't finished.
+    See chunk_checkpoint.
 
-def get_resolution(file_input: str) -> Tuple[int, int]:
-    """ Gets the resolution of a video at the passed file path. """
-    cmd = [
-        'ffprobe',
-        '-v', 'error',
-        '-select_streams', 'v:0',
-        '-show_entries', 'stream=width,height',
-        '-of', 'csv=s=x:p=0',
-        file_input
-    ]
+    Returns None if there's no problem with transcoding.
+    If there's an error while transcoding, it'll return with the details of the
+    error.
+    """
+    chunk_duration = duration / chunk_count
+    chunk_frames = max(int(chunk_duration * framerate), 1)
+
+    progress_lock = threading.Lock()
+    fractions = [0.0] * chunk_count
+    seconds_lefts: List[Optional[int]] = [None] * chunk_count
+    errors: List[str] = []
+
+    def chunk_cancel_event() -> bool:
+        return cancel_event() or bool(errors)
+
+    def report_progress(
+        index: int,
+        fraction: float,
+        seconds_left: Optional[int]
+    ) -> None:
+        with progress_lock:
+            fractions[index] = fraction
+            seconds_lefts[index] = seconds_left
+
+            known = [x for x in seconds_lefts if x is not None]
+            output_fn(
+                sum(fractions) / chunk_count,
+                max(known) if known else None
+            )
 
-    res_bytes = subprocess.check_output(cmd)
-    res = res_bytes.decode('utf-8')
-    res_array = res.split('x')
-    width = int(res_array[0])
-    height = int(res_array[1])
+    chunk_workers = min(chunk_workers or chunk_count, chunk_count)
 
-    return (width, height)
+    threads_per_chunk = None if threads is None else (
+        max(threads // chunk_workers, 1)
+    )
 
+    manifest = chunk_checkpoint.open_manifest(file_input, {
+        'video_bitrate': video_bitrate,
+        'width': width,
+        'height': height,
+        'rotation': rotation,
+        'framerate': framerate,
+        'codec': codec,
+        'use_ha': use_ha,
+        'extra_quality': extra_quality,
+        'chunk_count': chunk_count,
+        'duration': duration,
+        # Intermediates are remade in a new place every time.
+        'from_intermediate': video_source is not None
+    }) if checkpoint else None
+
+    temp_dir = None if manifest else (
+        TemporaryDirectory(prefix='constrict-chunks-')
+    )
+    chunk_dir = str(manifest.checkpoint_dir) if manifest else temp_dir.name
 
-def get_rotation(file_input: str) -> int:
-    """ Gets the rotation value of a video at the passed file path. """
-    cmd = [
-        'ffprobe',
-        '-v', 'error',
-        '-select_streams', 'v:0',
-        '-show_entries', 'stream_side_data=rotation',
-        '-of', 'default=noprint_wrappers=1:nokey=1',
-        file_input
-    ]
+    try:
+        chunk_paths = [
+            os.path.join(chunk_dir, f'chunk-{i}.mp4')
+            for i in range(chunk_count)
+        ]
 
-    rotation_bytes = subprocess.check_output(cmd)
+        # Chunks left to encode, in order.
+        queued_chunks = []
 
-    try:
-        rotation = int(rotation_bytes.decode('utf-8'))
-    except ValueError:
-        rotation = 0
+        for i in range(chunk_count):
+            if manifest and manifest.is_finished(i):
+                fractions[i] = 1.0
+            else:
+                queued_chunks.append(i)
 
-    return rotation
+        def encode_chunk(index: int) -> None:
+            chunk_log_path = None if log_path is None else (
+                f'{log_path}-chunk{index}'
+            )
 
-def get_frame_count(file_input: str) -> int:
-    """ Gets the total number of frames in a video at the passed file path """
-    cmd = [
-        'ffprobe',
-        '-v', 'error',
-        '-select_streams', 'v:0',
-        '-count_packets',
-        '-show_entries', 'stream=nb_read_packets',
-        '-of', 'default=noprint_wrappers=1:nokey=1',
-        file_input
-    ]
+            # Chunks are only renamed into place once fully written, so a
+            # chunk interrupted partway is never mistaken for a finished one.
+            part_path = f'{chunk_paths[index]}.part'
+
+            chunk_error = transcode(
+                file_input,
+                part_path,
+                video_bitrate,
+                audio_bitrate,
+                width,
+                height,
+                rotation,
+                subtitle_streams,
+                audio_channel_count,
+                framerate,
+                codec,
+                use_ha,
+                extra_quality,
+                lambda fraction, seconds_left: report_progress(
+                    index,
+                    fraction,
+                    seconds_left
+                ),
+                lambda: chunk_frames,
+                chunk_log_path,
+                chunk_cancel_event,
+                chunk_duration * index,
+                # The last chunk runs to the end, in case of rounding.
+                None if index == chunk_count - 1 else chunk_duration,
+                skip_first_pass,
+                video_only=True,
+                video_source=video_source,
+                threads=threads_per_chunk
+            )
 
-    frame_count_bytes = subprocess.check_output(cmd)
+            if chunk_error is not None:
+                with progress_lock:
+                    errors.append(chunk_error)
+                return
 
-    try:
-        frame_count = int(frame_count_bytes.decode('utf-8'))
-    except ValueError:
-        frame_count = 1
+            if chunk_cancel_event():
+                return
 
-    return frame_count
+            os.replace(part_path, chunk_paths[index])
 
-def get_audio_bitrate(file_input: str) -> int:
-    """ Gets the audio bitrate of the input file """
-    cmd = [
-        'ffprobe',
-        '-loglevel', 'error',
-        '-select_streams', 'a:0',
-        '-show_entries', 'stream=bit_rate',
-        '-of', 'csv=p=0',
-        file_input
-    ]
+            if manifest:
+                manifest.mark_finished(index)
 
-    bitrate_str = subprocess.check_output(cmd).decode('utf-8').strip()
+        def run_worker() -> None:
+            while not chunk_cancel_event():
+                with progress_lock:
+                    if not queued_chunks:
+                        return
+
+                    index = queued_chunks.pop(0)
+
+                encode_chunk(index)
+
+        chunk_threads = []
+
+        for i in range(min(chunk_workers, len(queued_chunks))):
+            # Chunks belong to the same process group as the whole video.
+            # See ffmpeg_supervisor.set_group().
+            chunk_thread = threading.Thread(
+                target=contextvars.copy_context().run,
+                args=[run_worker]
+            )
+            chunk_thread.daemon = True
+            chunk_thread.start()
+            chunk_threads.append(chunk_thread)
 
-    if bitrate_str == "":
-        # No audio stream found
-        return 0
-    elif bitrate_str == "N/A":
-        # Audio stream is using variable bitrate.
-        # Return a high bitrate to be safe.
-        return 128000
-    else:
         try:
-            return int(bitrate_str)
-        except ValueError:
-            # Error converting the bitrate to an integer.
-            # Return a high bitrate to be safe.
-            return 128000
+            for chunk_thread in chunk_threads:
+                chunk_thread.join()
+        except BaseException:
+            # e.g. KeyboardInterrupt in the CLI. Stop the other chunks before
+            # their directory is deleted.
+            ffmpeg_supervisor.get_supervisor().terminate_all()
+            raise
 
-def get_audio_channel_count(file_input: str) -> int:
-    """ Gets the audio channel-count of the input file """
-    cmd = [
-        'ffprobe',
-        '-loglevel', 'error',
-        '-select_streams', 'a:0',
-        '-show_entries', 'stream=channels',
-        '-of', 'csv=p=0',
-        file_input
-    ]
+        if errors:
+            return errors[0]
 
-    channel_count_str = subprocess.check_output(cmd).decode('utf-8').strip()
+        if cancel_event():
+            return None
+
+        list_path = os.path.join(chunk_dir, 'chunks.txt')
+
+        with open(list_path, 'w') as list_file:
+            for chunk_path in chunk_paths:
+                escaped_path = chunk_path.replace("'", "'\\''")
+                list_file.write(f"file '{escaped_path}'\n")
+
+        concat_cmd = [
+            'ffmpeg',
+            '-y',
+            '-progress', '-',
+            '-f', 'concat',
+            '-safe', '0',
+            '-i', f'{list_path}',
+            '-i', f'{file_input}',
+        ]
+
+        # Index of the input that subtitles (and audio, unless it's been
+        # encoded already) are taken from.
+        source_index = 1
+        audio_index = source_index
+
+        if audio_source is not None and audio_source != file_input:
+            concat_cmd.extend(['-i', f'{audio_source}'])
+            audio_index = 2
+
+        concat_cmd.extend([
+            '-map', '0:v:0',
+            '-map', f'{audio_index}:a:0?',
+        ])
+
+        for index in subtitle_streams:
+            concat_cmd.extend(['-map', f'{source_index}:{index}'])
+
+        concat_cmd.extend(['-c:v', 'copy'])
+
+        if audio_source is None:
+            concat_cmd.extend([
+                '-c:a', 'libopus',
+                '-b:a', f'{audio_bitrate}',
+                '-ac', f'{min(audio_channel_count, 2)}',
+            ])
+        else:
+            concat_cmd.extend(['-c:a', 'copy'])
+
+        concat_cmd.extend([
+            '-c:s', 'mov_text',
+            '-map_chapters', '-1',
+            '-f', 'mp4',
+            file_output
+        ])
+
+        avg_fps, progress_error = get_progress(
+            file_input,
+            concat_cmd,
+            lambda *_: None,
+            lambda: 1,
+            None,
+            None,
+            cancel_event
+        )
+
+        if manifest and progress_error is None and not cancel_event():
+            manifest.remove()
+
+        return progress_error
+    finally:
+        if temp_dir:
+            temp_dir.cleanup()
 
-    try:
-        return int(channel_count_str)
-    except ValueError:
-        return 1
 
 def get_encode_settings(
     target_size_MiB: float,
@@ -722,6 +1532,97 @@ def get_encode_settings(
         target_fps
     )
 
+def get_next_factor(
+    history: List[Tuple[float, float]],
+    tolerance: int,
+    strategy: int
+) -> float:
+    """ Return the bitrate factor to use for the next compression attempt,
+    from the (factor, percent of target size) results of every attempt so far,
+    oldest first.
+
+    The proportional strategy only looks at the last attempt, assuming file
+    size scales in proportion with bitrate. The secant strategy fits a line
+    through previous attempts instead, which accounts for the fixed overhead
+    of a file (audio, container, etc.) and for encoders that don't scale
+    proportionally. Once there are attempts both over and under the target,
+    it interpolates between the closest of them (regula falsi), so the
+    search can't step outside of the range already known to contain the
+    target.
+    """
+    last_factor, last_percent = history[-1]
+
+    # We multiply by 0.98 to prevent lots of attempts with sizes just
+    # bordering above the target.
+    proportional = last_factor * 0.98 * (100 / last_percent)
+
+    if strategy == RateSearch.PROPORTIONAL or len(history) < 2:
+        return proportional
+
+    # Aim just under the target, but not outside of the tolerance window.
+    aim = 100 - min(2.0, tolerance / 2)
+
+    over = [x for x in history if x[1] > aim]
+    under = [x for x in history if x[1] <= aim]
+    bracketed = bool(over and under)
+
+    if bracketed:
+        low = max(under, key=lambda x: x[1])
+        high = min(over, key=lambda x: x[1])
+    else:
+        low, high = history[-2], history[-1]
+
+    (low_factor, low_percent), (high_factor, high_percent) = low, high
+
+    if low_factor == high_factor:
+        return proportional
+
+    slope = (high_percent - low_percent) / (high_factor - low_factor)
+
+    # Size should always grow with bitrate. If it didn't (e.g. because the
+    # resolution changed between attempts), the line is meaningless.
+    if slope <= 0:
+        return proportional
+
+    next_factor = low_factor + (aim - low_percent) / slope
+
+    if bracketed:
+        return next_factor
+
+    # Don't extrapolate wildly further than the proportional guess.
+    return min(max(next_factor, proportional / 2), proportional * 2)
+
+def get_chunk_count(
+    duration_seconds: float,
+    input_mime_type: str,
+    chunk_workers: int,
+    checkpoint: bool,
+    can_ha: bool
+) -> int:
+    """ Returns how many chunks compress() splits a video into with the
+    passed chunk_workers and checkpoint options, where 1 means the video is
+    transcoded whole. See transcode_chunked().
+    """
+    if input_mime_type == "image/gif":
+        return 1
+
+    # Chunks must be long enough that the keyframes starting each of them
+    # don't waste much of the bit budget. Hardware encoders don't gain from
+    # running in parallel.
+    chunk_count = 1 if can_ha else min(
+        chunk_workers,
+        int(duration_seconds // MIN_CHUNK_SECONDS)
+    )
+
+    if checkpoint:
+        # No more than a chunk's worth of encoding is lost if interrupted.
+        chunk_count = max(
+            chunk_count,
+            math.ceil(duration_seconds / CHECKPOINT_CHUNK_SECONDS)
+        )
+
+    return max(chunk_count, 1)
+
 def will_ha_work(codec):
     """ Returns whether hardware acceleration for the given codec is supported
     by the GPU
@@ -757,34 +1658,543 @@ def will_ha_work(codec):
 
     return False
 
-def get_subtitle_streams(file_input: str) -> List[int]:
-    cmd = [
-        'ffprobe',
-        '-loglevel', 'error',
-        '-select_streams', 's',
-        '-show_entries', 'stream=index,codec_name',
-        '-of', 'csv=p=0',
-        f'{file_input}'
+
+def can_remux(media_info: MediaInfo, codec: int) -> bool:
+    """ Returns whether a video's stream can be copied into an MP4 as-is,
+    without re-encoding, for the passed requested codec. Besides the codec,
+    its pixel format and profile must match what transcoding would output.
+    """
+    return (
+        media_info.video_codec == REMUX_VIDEO_CODECS[codec]
+        and media_info.video_pix_fmt == 'yuv420p'
+        and media_info.video_profile in REMUX_VIDEO_PROFILES[codec]
+    )
+
+def remux(
+    file_input: str,
+    file_output: str,
+    media_info: MediaInfo,
+    audio_source: Optional[str],
+    output_fn: Callable[[float, Optional[int]], None],
+    cancel_event: Callable[[], bool]
+) -> Optional[str]:
+    """ Copy the video stream of a video into an MP4 at the passed destination
+    without re-encoding it, alongside the passed audio source (see
+    prepare_audio()) and compatible subtitles.
+
+    Returns None if there's no problem with remuxing.
+    If there's an error while remuxing, it'll return with the details of the
+    error.
+    """
+    remux_cmd = [
+        'ffmpeg',
+        '-y',
+        '-progress', '-',
+        '-i', f'{file_input}',
     ]
 
-    input_streams_str = subprocess.check_output(cmd).decode('utf-8').strip()
-    input_streams_list = input_streams_str.split('\n')
+    separate_audio = audio_source is not None and audio_source != file_input
 
-    compatible_codecs = ['subrip', 'webvtt', 'ass', 'mov_text']
-    accepted_streams = []
+    if separate_audio:
+        remux_cmd.extend(['-i', f'{audio_source}'])
+
+    remux_cmd.extend([
+        '-map', '0:v:0',
+        '-map', '1:a:0?' if separate_audio else '0:a:0?',
+        '-map_chapters', '-1'
+    ])
+
+    for index in media_info.subtitle_streams:
+        remux_cmd.extend(['-map', f'0:{index}'])
+
+    remux_cmd.extend(['-c:v', 'copy'])
+
+    if media_info.video_codec == 'hevc':
+        # Needed for HEVC in MP4 to play on Apple devices.
+        remux_cmd.extend(['-tag:v', 'hvc1'])
+
+    remux_cmd.extend([
+        '-c:a', 'copy',
+        '-c:s', 'mov_text',
+        '-f', 'mp4',
+        file_output
+    ])
+
+    if cancel_event():
+        return None
+
+    avg_fps, progress_error = get_progress(
+        file_input,
+        remux_cmd,
+        output_fn,
+        lambda: media_info.frame_count,
+        None,
+        None,
+        cancel_event
+    )
+
+    return progress_error
+
+def prepare_audio(
+    file_input: str,
+    media_info: MediaInfo,
+    audio_bitrate: int,
+    output_dir: str,
+    cancel_event: Callable[[], bool]
+) -> Tuple[Optional[str], Optional[str]]:
+    """ Prepare the audio of a video for muxing into compressed outputs, so it
+    needn't be encoded again with every attempt.
+
+    If the video's audio is already Opus or AAC, at or under the passed
+    bitrate, with no more than 2 channels, the video itself is returned as the
+    audio source to copy from. Otherwise, its audio is encoded to Opus in a
+    file in the passed directory, and that file is returned.
+
+    Returns (audio source, error details). If the video has no audio, or
+    encoding is cancelled, the audio source is None.
+    """
+    if media_info.audio_bitrate == 0:
+        return (None, None)
+
+    audio_channels = min(media_info.audio_channel_count, 2)
+
+    passthrough = (
+        media_info.audio_codec in PASSTHROUGH_AUDIO_CODECS
+        and media_info.audio_bitrate <= audio_bitrate
+        and media_info.audio_channel_count <= 2
+    )
+
+    if passthrough:
+        return (file_input, None)
+
+    audio_path = os.path.join(
+        output_dir,
+        f'audio-{audio_bitrate}-{audio_channels}.mka'
+    )
+
+    if os.path.exists(audio_path):
+        return (audio_path, None)
+
+    audio_cmd = [
+        'ffmpeg',
+        '-y',
+        '-progress', '-',
+        '-i', f'{file_input}',
+        '-map', '0:a:0',
+        '-c:a', 'libopus',
+        '-b:a', f'{audio_bitrate}',
+        '-ac', f'{audio_channels}',
+        '-f', 'matroska',
+        f'{audio_path}.part'
+    ]
+
+    avg_fps, progress_error = get_progress(
+        file_input,
+        audio_cmd,
+        lambda *_: None,
+        lambda: 1,
+        None,
+        None,
+        cancel_event
+    )
+
+    if progress_error is not None:
+        return (None, progress_error)
+
+    if cancel_event():
+        return (None, None)
+
+    # Only give the file its final name once complete, so a partial file is
+    # never reused.
+    os.replace(f'{audio_path}.part', audio_path)
+
+    return (audio_path, None)
+
+
+def make_intermediate(
+    file_input: str,
+    media_info: MediaInfo,
+    width: int,
+    height: int,
+    framerate: float,
+    output_dir: str,
+    max_bytes: int,
+    cancel_event: Callable[[], bool],
+    threads: Optional[int] = None
+) -> Tuple[Optional[str], Optional[str]]:
+    """ Decode and scale a video once into a visually lossless intermediate
+    at the passed resolution and framerate, in the passed directory, so that
+    later attempts at the same resolution needn't decode the full-resolution
+    source again. See transcode().
+
+    The intermediate is abandoned if it would take up more than max_bytes,
+    or more than the free space left in the directory.
+
+    Returns (intermediate path, error details). If the intermediate is
+    abandoned or cancelled, its path is None.
+    """
+    frame_count = media_info.frame_count or 1
+
+    if media_info.fps > 0 and framerate != -1:
+        frame_count = int(frame_count // (media_info.fps / framerate)) or 1
+
+    estimated_bytes = int(
+        width * height * frame_count * INTERMEDIATE_BITS_PER_PIXEL / 8
+    )
 
-    for stream in input_streams_list:
+    try:
+        free_bytes = shutil.disk_usage(output_dir).free
+    except OSError:
+        return (None, None)
+
+    max_bytes = min(max_bytes, free_bytes - INTERMEDIATE_FREE_SPACE_MARGIN)
+
+    if estimated_bytes > max_bytes:
+        return (None, None)
+
+    intermediate_path = os.path.join(
+        output_dir,
+        f'video-{width}x{height}-{framerate}.mkv'
+    )
+
+    if os.path.exists(intermediate_path):
+        return (intermediate_path, None)
+
+    intermediate_cmd = [
+        'ffmpeg',
+        '-y',
+        '-progress', '-',
+        '-noautorotate',
+        '-i', f'{file_input}',
+        '-map', '0:v:0',
+        '-vf', f'scale={width}:{height}',
+    ]
+
+    if framerate != -1:
+        intermediate_cmd.extend(['-r', f'{framerate}'])
+
+    intermediate_cmd.extend([
+        '-c:v', 'libx264',
+        '-preset', 'ultrafast',
+        '-crf', f'{INTERMEDIATE_CRF}',
+        '-pix_fmt', 'yuv420p',
+    ])
+
+    intermediate_cmd.extend(get_thread_args('libx264', threads))
+
+    intermediate_cmd.extend([
+        '-an',
+        '-sn',
+        '-f', 'matroska',
+        f'{intermediate_path}.part'
+    ])
+
+    oversized = False
+
+    def monitor_size(total_size: int, out_time: float) -> bool:
+        nonlocal oversized
+
+        oversized = total_size > max_bytes
+        return oversized
+
+    avg_fps, progress_error = get_progress(
+        file_input,
+        intermediate_cmd,
+        lambda *_: None,
+        lambda: frame_count,
+        None,
+        None,
+        cancel_event,
+        monitor_size
+    )
+
+    if progress_error is not None or oversized or cancel_event():
         try:
-            id, codec = stream.split(',')
-            if codec in compatible_codecs:
-                accepted_streams.append(int(id))
-        except ValueError:
-            continue
+            os.remove(f'{intermediate_path}.part')
+        except FileNotFoundError:
+            pass
+
+        return (None, progress_error)
+
+    # Only give the file its final name once complete, so a partial file is
+    # never reused.
+    os.replace(f'{intermediate_path}.part', intermediate_path)
+
+    return (intermediate_path, None)
+
+
+def get_target_dimensions(
+    width: int,
+    height: int,
+    preset_height: int
+) -> Tuple[int, int]:
+    """ Returns the width and height to scale a video of the passed resolution
+    to, for a resolution preset (i.e. 1080p, 720p, etc.). Dimensions are
+    rounded to even numbers, as required by most encoders.
+    """
+    if height > width:
+        target_width = preset_height
+        scaling_factor = width / target_width
+        target_height = int(((height / scaling_factor + 1) // 2) * 2)
+    else:
+        target_height = preset_height
+        scaling_factor = height / target_height
+        target_width = int(((width / scaling_factor + 1) // 2) * 2)
+
+    return (target_width, target_height)
+
+
+def estimate_size_from_samples(
+    file_input: str,
+    media_info: MediaInfo,
+    video_bitrate: int,
+    audio_bitrate: int,
+    width: int,
+    height: int,
+    framerate: float,
+    codec: int,
+    use_ha: bool,
+    extra_quality: bool,
+    cancel_event: Callable[[], bool],
+    threads: Optional[int] = None,
+    output_fn: Optional[Callable[[float, Optional[int]], None]] = None
+) -> Optional[int]:
+    """ Estimate the size of a full transcode of a video with the passed
+    settings, by transcoding a few short, evenly spaced samples of it and
+    extrapolating their bytes per second of content to the whole duration.
+
+    If output_fn is passed, the progress of transcoding all of the samples is
+    output to it, the same way as for compress().
+
+    Returns None if the samples couldn't be transcoded, or if cancelled.
+    """
+    sample_count = CALIBRATION_SAMPLES
+    sample_duration = CALIBRATION_SAMPLE_SECONDS
+    spacing = media_info.duration / sample_count
+
+    total_bytes = 0
+
+    with TemporaryDirectory() as tmp_dir:
+        for i in range(sample_count):
+            start_time = max(spacing * (i + 0.5) - sample_duration / 2, 0)
+            sample_path = os.path.join(tmp_dir, f'sample-{i}.mp4')
+
+            def output_sample_progress(
+                fraction: float,
+                seconds_left: Optional[int],
+                i: int = i
+            ) -> None:
+                if not output_fn:
+                    return
+
+                samples_left = sample_count - i - 1
+
+                # Later samples are assumed to take as long as this one.
+                if seconds_left is not None and fraction < 1:
+                    seconds_left = int(
+                        seconds_left + samples_left * seconds_left
+                        / (1 - fraction)
+                    )
+
+                output_fn((i + fraction) / sample_count, seconds_left)
+
+            transcode_error = transcode(
+                file_input,
+                sample_path,
+                video_bitrate,
+                audio_bitrate,
+                width,
+                height,
+                media_info.rotation,
+                media_info.subtitle_streams,
+                media_info.audio_channel_count,
+                framerate,
+                codec,
+                use_ha,
+                extra_quality,
+                output_sample_progress,
+                lambda: max(int(sample_duration * framerate), 1),
+                os.path.join(tmp_dir, 'calibration2pass'),
+                cancel_event,
+                start_time,
+                sample_duration,
+                threads=threads
+            )
+
+            if transcode_error is not None or cancel_event():
+                return None
+
+            try:
+                total_bytes += os.stat(sample_path).st_size
+            except FileNotFoundError:
+                return None
 
-    return accepted_streams
+    bytes_per_second = total_bytes / (sample_count * sample_duration)
 
+    return int(bytes_per_second * media_info.duration)
 
 
+def get_history_factor(
+    media_info: MediaInfo,
+    target_bytes: int,
+    framerate_option: int,
+    codec: int,
+    use_ha: bool,
+    extra_quality: bool,
+    basic_transcode: bool
+) -> float:
+    """ Returns the bitrate factor of the first attempt at compressing a
+    video, corrected by how far past attempts with the same encoder, preset,
+    resolution and framerate missed their requested bitrates. See
+    rate_history.get_correction().
+    """
+    source_fps = media_info.fps if media_info.fps != -1 else 60
+
+    encode_settings = get_encode_settings(
+        target_bytes / 1024 / 1024,
+        framerate_option,
+        media_info.width,
+        media_info.height,
+        source_fps,
+        media_info.duration,
+        media_info.audio_bitrate,
+        media_info.audio_channel_count,
+        basic_transcode=basic_transcode
+    )
+
+    first_video_bitrate, first_audio_bitrate, first_height, first_fps = (
+        encode_settings
+    )
+    first_width, first_height = get_target_dimensions(
+        media_info.width,
+        media_info.height,
+        first_height
+    )
+    first_encoder, first_preset, first_use_ha = get_encoder_settings(
+        first_video_bitrate,
+        first_width,
+        first_height,
+        codec,
+        use_ha,
+        extra_quality
+    )
+
+    correction = rate_history.get_correction(
+        first_encoder,
+        first_preset,
+        min(first_width, first_height),
+        first_fps
+    )
+
+    return correction if correction is not None else 1.0
+
+def prefetch_first_pass(
+    file_input: str,
+    target_size_MiB: int,
+    framerate_option: int,
+    extra_quality: bool,
+    codec: int,
+    use_ha: bool,
+    log_path: str,
+    cancel_event: Callable[[], bool],
+    media_info: Optional[MediaInfo] = None,
+    use_history: bool = True,
+    threads: Optional[int] = None
+) -> Optional[Tuple]:
+    """
+    Run the first pass of the first attempt compress() would make with the
+    passed settings ahead of time, so it can be run while something else is
+    still being compressed.
+
+    Returns the first pass key of the statistics written to log_path, to be
+    passed to compress() as prefetched_pass_key, or None if the first pass
+    can't be prefetched (e.g. the video will be remuxed, or its encoder's
+    statistics can't be reused).
+    """
+    try:
+        if media_info is None:
+            media_info = probe_media(file_input)
+
+        before_size_bytes = os.stat(file_input).st_size
+    except (OSError, subprocess.CalledProcessError, ValueError):
+        return None
+
+    target_bytes_limit = target_size_MiB * 1024 * 1024
+    do_basic_transcode = before_size_bytes <= target_bytes_limit
+    target_bytes = before_size_bytes if do_basic_transcode else target_bytes_limit
+
+    # Videos that already fit are usually remuxed rather than transcoded.
+    if do_basic_transcode and can_remux(media_info, codec):
+        return None
+
+    can_ha = use_ha and not extra_quality and will_ha_work(codec)
+    source_fps = media_info.fps if media_info.fps != -1 else 60
+
+    factor = get_history_factor(
+        media_info,
+        target_bytes,
+        framerate_option,
+        codec,
+        can_ha,
+        extra_quality,
+        do_basic_transcode
+    ) if use_history else 1.0
+
+    encode_settings = get_encode_settings(
+        target_bytes / 1024 / 1024,
+        framerate_option,
+        media_info.width,
+        media_info.height,
+        source_fps,
+        media_info.duration,
+        media_info.audio_bitrate,
+        media_info.audio_channel_count,
+        factor,
+        basic_transcode=do_basic_transcode
+    )
+
+    video_bitrate, audio_bitrate, target_height, target_fps = encode_settings
+    target_width, target_height = get_target_dimensions(
+        media_info.width,
+        media_info.height,
+        target_height
+    )
+
+    pass_key = get_first_pass_key(
+        video_bitrate,
+        target_width,
+        target_height,
+        target_fps,
+        codec,
+        can_ha,
+        extra_quality
+    )
+
+    if pass_key is None:
+        return None
+
+    pass_avg_fps, progress_error = run_first_pass(
+        file_input,
+        video_bitrate,
+        target_width,
+        target_height,
+        media_info.rotation,
+        target_fps,
+        codec,
+        can_ha,
+        extra_quality,
+        lambda *args: None,
+        lambda: media_info.frame_count or 1,
+        log_path,
+        cancel_event,
+        threads=threads
+    )
+
+    if progress_error is not None or cancel_event():
+        return None
+
+    return pass_key
+
 def compress(
     file_input: str,
     input_mime_type: str,
@@ -799,7 +2209,24 @@ def compress(
     log_path: Optional[str],
     cancel_event: Callable,
     on_new_attempt: Callable[[int, int, Optional[bool], int, float], None],
-    on_attempt_fail: Callable[[int, int, Optional[bool], int, float, int, int], None]
+    on_attempt_fail: Callable[[int, int, Optional[bool], int, float, int, int, bool], None],
+    media_info: Optional[MediaInfo] = None,
+    exact_frame_count: bool = False,
+    rate_search: int = RateSearch.SECANT,
+    calibrate: bool = False,
+    early_abort_margin: Optional[float] = EARLY_ABORT_MARGIN,
+    use_history: bool = True,
+    allow_remux: bool = True,
+    chunk_workers: int = 1,
+    prefetched_pass_key: Optional[Tuple] = None,
+    on_second_pass: Optional[Callable[[], None]] = None,
+    intermediate_budget_MiB: int = 0,
+    threads: Optional[int] = None,
+    resume_attempts: Sequence[Tuple[float, float]] = (),
+    on_attempt_done: Optional[Callable[[float, float, int], None]] = None,
+    resume_factor: Optional[float] = None,
+    on_attempt_start: Optional[Callable[[float], None]] = None,
+    checkpoint: bool = False
 ) -> Optional[int | str]:
     """
     Iteratively transcode a given video to the passed destination file path,
@@ -812,6 +2239,70 @@ def compress(
     details.
     - If compression ends for any other reason (like being cancelled), it'll
     return None.
+
+    If the source video has already been probed (e.g. by a sources row), its
+    MediaInfo can be passed to avoid probing it again.
+
+    If the source's frame count had to be estimated, it's counted exactly in
+    the background while transcoding starts, and progress is corrected once
+    the count is known. Pass exact_frame_count to count it before starting
+    instead.
+
+    rate_search is the RateSearch strategy used to pick the bitrate of each
+    attempt after the first. See get_next_factor().
+
+    If calibrate is set, short samples of long videos are encoded first to
+    correct the bitrate of the first attempt, with their progress output to
+    output_fn before the first attempt's. See estimate_size_from_samples().
+
+    While an attempt's second pass runs, its final size is projected from the
+    bytes written so far. If the projection falls outside of the tolerance
+    window by more than early_abort_margin (in percent of the target size),
+    the attempt is abandoned early and the next one starts with the projected
+    size as its result. The last argument passed to on_attempt_fail is whether
+    the size it's passed is such a projection. Pass None to always run
+    attempts to completion.
+
+    If use_history is set, every finished attempt is recorded, and the first
+    attempt's bitrate is corrected by how far past attempts with the same
+    encoder, preset, resolution and framerate missed their requested
+    bitrates. See rate_history.
+
+    If allow_remux is set and the source already fits within the target size
+    in the requested codec, its video stream is copied into the output without
+    re-encoding, falling back to transcoding only if the result doesn't fit.
+
+    If chunk_workers is more than 1, long videos are split into up to that
+    many chunks, encoded in parallel. See transcode_chunked(). Attempts can't
+    be abandoned early in this mode.
+
+    If the first pass has already been run by prefetch_first_pass(), pass the
+    key it returned as prefetched_pass_key to skip it. on_second_pass is
+    called whenever an attempt's second pass starts, if passed.
+
+    If intermediate_budget_MiB is more than 0, retries at a much lower
+    resolution or framerate than the source read from a downscaled
+    intermediate of up to that size, made once per resolution. See
+    make_intermediate().
+
+    If threads is passed, every encode is limited to that many threads. See
+    get_thread_args().
+
+    on_attempt_done is called with the bitrate factor, percent of target size
+    and video bitrate of every attempt once its size is known, if passed. To
+    carry on from attempts made before compression was interrupted, pass
+    their (bitrate factor, percent of target size) results as
+    resume_attempts, oldest first. See batch_journal.
+
+    on_attempt_start is called with the bitrate factor of every attempt as it
+    starts, if passed. To redo an attempt that was interrupted with the same
+    bitrate, pass its factor as resume_factor.
+
+    If checkpoint is set, long videos are transcoded in chunks that are kept
+    if compression is interrupted, so that compressing the video again with
+    the same settings carries on from the last finished chunk. See
+    transcode_chunked(). As with chunk_workers, attempts can't be abandoned
+    early in this mode.
     """
 
     output_fn(0, None)
@@ -823,27 +2314,52 @@ def compress(
     target_bytes_limit = target_size_MiB * 1024 * 1024
     before_size_bytes = os.stat(file_input).st_size
     after_size_bytes = 0
+    size_projected = False
 
     do_basic_transcode = before_size_bytes <= target_bytes_limit
 
     target_bytes = before_size_bytes if do_basic_transcode else target_bytes_limit
 
     try:
-        duration_seconds = get_duration(file_input)
-        source_fps = get_framerate(file_input)
-
-        if source_fps == -1:
-            source_fps = 60
-
-        width, height = get_resolution(file_input)
-        source_frame_count = get_frame_count(file_input)
-        rotation = get_rotation(file_input)
-        sub_streams = get_subtitle_streams(file_input)
-        audio_bitrate = get_audio_bitrate(file_input)
-        audio_channel_count = get_audio_channel_count(file_input)
-    except subprocess.CalledProcessError:
+        if media_info is None:
+            media_info = probe_media(file_input)
+    except (subprocess.CalledProcessError, ValueError):
         return _("Constrict: Could not retrieve video properties. Source video may be missing or corrupted.")
 
+    duration_seconds = media_info.duration
+    source_fps = media_info.fps if media_info.fps != -1 else 60
+    width, height = media_info.width, media_info.height
+    source_frame_count = media_info.frame_count
+
+    # Set once compress() returns, to stop counting frames in the background.
+    compression_over = threading.Event()
+
+    def refine_frame_count() -> None:
+        nonlocal source_frame_count
+
+        try:
+            frame_count = count_frames(
+                file_input,
+                lambda: cancel_event() or compression_over.is_set()
+            )
+        except subprocess.CalledProcessError:
+            frame_count = None
+
+        if frame_count is None:
+            # Keep using the estimate.
+            return
+
+        source_frame_count = frame_count
+
+        # Remember the exact count, so the file needn't be counted again.
+        cache_media_info(
+            file_input,
+            media_info._replace(
+                frame_count=source_frame_count,
+                frame_count_estimated=False
+            )
+        )
+
     try:
         Path(file_output).touch(exist_ok=False)
     except FileExistsError:
@@ -853,10 +2369,28 @@ def compress(
     except PermissionError:
         return _("Constrict: Could not create exported file. There are insufficient permissions to create a file at the requested export path.")
 
+    if media_info.frame_count_estimated:
+        if exact_frame_count:
+            refine_frame_count()
+        else:
+            # Counted in the same process group as the compression. See
+            # ffmpeg_supervisor.set_group().
+            refine_thread = threading.Thread(
+                target=contextvars.copy_context().run,
+                args=[refine_frame_count]
+            )
+            refine_thread.daemon = True
+            refine_thread.start()
+
     # initialise values
     factor = 1.0
     attempt = 0
     percent_of_target = 200.0
+    attempt_history = []
+
+    # Attempts are numbered after the remux, if there was one (see
+    # try_remux()).
+    remux_attempts = 0
 
     target_video_bitrate = 0
     target_audio_bitrate = 0
@@ -866,23 +2400,39 @@ def compress(
 
     force_crush = False
     lowest_res = None
+    last_pass_key = None
 
     can_ha = use_ha and not extra_quality and will_ha_work(codec)
 
-    while (percent_of_target < 100 - tolerance) or (percent_of_target > 100):
-        if attempt > 0:
-            on_attempt_fail(
-                attempt,
-                target_video_bitrate,
-                is_hq_audio,
-                displayed_res,
-                target_fps,
-                after_size_bytes,
-                target_bytes_limit
-            )
+    chunk_count = get_chunk_count(
+        duration_seconds,
+        input_mime_type,
+        chunk_workers,
+        checkpoint,
+        can_ha
+    )
+
+    calibration_worthwhile = (
+        duration_seconds >= CALIBRATION_MIN_DURATION
+        and not do_basic_transcode
+    )
+
+    if use_history:
+        factor = get_history_factor(
+            media_info,
+            target_bytes,
+            framerate_option,
+            codec,
+            can_ha,
+            extra_quality,
+            do_basic_transcode
+        )
 
-        attempt += 1
+    # Videos that already fit only need quick attempts, so they start over.
+    if do_basic_transcode:
+        resume_attempts = ()
 
+    if calibrate and calibration_worthwhile and not resume_attempts:
         encode_settings = get_encode_settings(
             target_bytes / 1024 / 1024,
             framerate_option,
@@ -890,105 +2440,513 @@ def compress(
             height,
             source_fps,
             duration_seconds,
-            audio_bitrate,
-            audio_channel_count,
-            factor,
+            media_info.audio_bitrate,
+            media_info.audio_channel_count,
+            factor
+        )
+
+        cal_video_bitrate, cal_audio_bitrate, cal_height, cal_fps = encode_settings
+        cal_width, cal_height = get_target_dimensions(width, height, cal_height)
+
+        estimated_size = estimate_size_from_samples(
+            file_input,
+            media_info,
+            cal_video_bitrate,
+            cal_audio_bitrate,
+            cal_width,
+            cal_height,
+            cal_fps,
+            codec,
+            can_ha,
+            extra_quality,
+            cancel_event,
+            threads,
+            output_fn
+        )
+
+        if cancel_event():
+            return None
+
+        if estimated_size:
+            estimated_percent = (100 / target_bytes_limit) * estimated_size
+            calibrated_factor = get_next_factor(
+                [(factor, estimated_percent)],
+                tolerance,
+                RateSearch.PROPORTIONAL
+            )
+
+            # Samples may not be representative of the whole video, so don't
+            # let them skew the first attempt too far.
+            factor = min(max(calibrated_factor, factor * 0.5), factor * 1.5)
+
+    for resumed_factor, resumed_percent in resume_attempts:
+        # Replay the constraints earlier attempts put on later ones. See
+        # below.
+        resumed_settings = get_encode_settings(
+            target_bytes / 1024 / 1024,
+            framerate_option,
+            width,
+            height,
+            source_fps,
+            duration_seconds,
+            media_info.audio_bitrate,
+            media_info.audio_channel_count,
+            resumed_factor,
             force_crush,
             lowest_res,
             do_basic_transcode
         )
 
-        target_video_bitrate, target_audio_bitrate, target_height, target_fps = encode_settings
+        (
+            resumed_video_bitrate,
+            resumed_audio_bitrate,
+            resumed_height,
+            resumed_fps
+        ) = resumed_settings
 
-        is_hq_audio = target_audio_bitrate > 12000 if target_audio_bitrate > 0 else None
-
-        if is_hq_audio == False:
+        if 0 < resumed_audio_bitrate <= 12000:
             force_crush = True
 
-        displayed_res = target_height
+        if resumed_percent > 50:
+            resumed_width, resumed_height = get_target_dimensions(
+                width,
+                height,
+                resumed_height
+            )
+            lowest_res = resumed_height if height < width else resumed_width
 
-        on_new_attempt(
-            attempt,
-            target_video_bitrate,
-            is_hq_audio,
-            displayed_res,
-            target_fps
+        attempt_history.append((resumed_factor, resumed_percent))
+
+    if attempt_history:
+        attempt = len(attempt_history)
+        factor = get_next_factor(attempt_history, tolerance, rate_search)
+
+    if resume_factor is not None and not do_basic_transcode:
+        factor = resume_factor
+
+    def try_remux() -> Optional[int | str]:
+        """ Copy the source's video stream into the output as-is. Returns the
+        output size if it fits within the target size, error details if there
+        was an error, or None to fall back to transcoding.
+        """
+        nonlocal remux_attempts
+
+        audio_settings = get_encode_settings(
+            target_bytes / 1024 / 1024,
+            framerate_option,
+            width,
+            height,
+            source_fps,
+            duration_seconds,
+            media_info.audio_bitrate,
+            media_info.audio_channel_count,
+            basic_transcode=True
         )
-        output_fn(0, None)
+        remux_audio_bitrate = audio_settings[1]
 
-        # Below 5 kbps, barely anything is perceptible in the video anymore.
-        if target_video_bitrate < 5000:
-            return _("Constrict: Video bitrate got too low (<5 kbps). The target size may be too low for this file.")
+        audio_source, audio_error = prepare_audio(
+            file_input,
+            media_info,
+            remux_audio_bitrate,
+            scratch_dir.name,
+            cancel_event
+        )
 
-        if height > width:
-            target_width = target_height
-            scaling_factor = width / target_width
-            target_height = int(((height / scaling_factor + 1) // 2) * 2)
-        else:
-            scaling_factor = height / target_height
-            target_width = int(((width / scaling_factor + 1) // 2) * 2)
+        if audio_error is not None:
+            return audio_error
 
-        if input_mime_type == "image/gif":
-            dest_frame_count = source_frame_count
-        else:
-            dest_frame_count = int(source_frame_count // (source_fps / target_fps))
+        if cancel_event():
+            return None
+
+        source_video_bitrate = max(
+            int(before_size_bytes * 8 / duration_seconds) - remux_audio_bitrate,
+            0
+        )
 
-        dest_frame_count = dest_frame_count or 1
+        remux_is_hq_audio = (
+            remux_audio_bitrate > 12000 if remux_audio_bitrate > 0 else None
+        )
+
+        remux_attempts = 1
 
-        transcode_error = transcode(
+        on_new_attempt(
+            remux_attempts,
+            source_video_bitrate,
+            remux_is_hq_audio,
+            min(width, height),
+            source_fps
+        )
+
+        remux_error = remux(
             file_input,
             file_output,
-            target_video_bitrate,
-            target_audio_bitrate,
-            target_width,
-            target_height,
-            rotation,
-            sub_streams,
-            target_fps,
-            codec,
-            can_ha,
-            extra_quality,
+            media_info,
+            audio_source,
             output_fn,
-            dest_frame_count,
-            log_path,
             cancel_event
         )
 
-        if transcode_error != None:
-            return transcode_error
-
         if cancel_event():
             return None
 
+        if remux_error is not None:
+            # Transcoding may still work if remuxing didn't.
+            print(f'Warning: could not remux, transcoding instead: {remux_error}')
+            return None
+
         try:
-            after_size_bytes = os.stat(file_output).st_size
+            remux_size_bytes = os.stat(file_output).st_size
         except FileNotFoundError:
             return _("Constrict: Cannot read output file. Was it moved or deleted mid-compression?")
-        percent_of_target = (100 / target_bytes_limit) * after_size_bytes
-
-        if target_video_bitrate >= MAX_VIDEO_BITRATE:
-            # No point ever repeating if the video bitrate is already at max.
-            break
-        elif percent_of_target < 100 and (do_basic_transcode or attempt > 1):
-            if do_basic_transcode:
-                percent_of_original = (100 / before_size_bytes) * after_size_bytes
-                if percent_of_original >= 100 - tolerance or attempt > 1:
-                    break
 
-                # Try to increase bitrate for 1 more attempt only.
-                percent_of_target = percent_of_original
+        if remux_size_bytes <= target_bytes_limit:
+            return remux_size_bytes
+
+        on_attempt_fail(
+            remux_attempts,
+            source_video_bitrate,
+            remux_is_hq_audio,
+            min(width, height),
+            source_fps,
+            remux_size_bytes,
+            target_bytes_limit,
+            False
+        )
+
+        return None
+
+    # Prefetched statistics are only written for unchunked transcodes.
+    if chunk_count == 1:
+        last_pass_key = prefetched_pass_key
+
+    # Holds audio encoded once for all attempts (see prepare_audio()), and
+    # the current intermediate, if any (see make_intermediate()).
+    scratch_dir = TemporaryDirectory(prefix='constrict-scratch-')
+    intermediate_path = None
+    last_intermediate_key = None
+
+    try:
+        if allow_remux and do_basic_transcode and can_remux(media_info, codec):
+            remux_result = try_remux()
+
+            if remux_result is not None:
+                return remux_result
+
+            if cancel_event():
+                return None
+
+        while (percent_of_target < 100 - tolerance) or (percent_of_target > 100):
+            # Resumed attempts already failed before the interruption.
+            if attempt > len(resume_attempts):
+                on_attempt_fail(
+                    remux_attempts + attempt,
+                    target_video_bitrate,
+                    is_hq_audio,
+                    displayed_res,
+                    target_fps,
+                    after_size_bytes,
+                    target_bytes_limit,
+                    size_projected
+                )
+
+            attempt += 1
+
+            encode_settings = get_encode_settings(
+                target_bytes / 1024 / 1024,
+                framerate_option,
+                width,
+                height,
+                source_fps,
+                duration_seconds,
+                media_info.audio_bitrate,
+                media_info.audio_channel_count,
+                factor,
+                force_crush,
+                lowest_res,
+                do_basic_transcode
+            )
+
+            target_video_bitrate, target_audio_bitrate, target_height, target_fps = encode_settings
+
+            is_hq_audio = target_audio_bitrate > 12000 if target_audio_bitrate > 0 else None
+
+            if is_hq_audio == False:
+                force_crush = True
+
+            displayed_res = target_height
+
+            on_new_attempt(
+                remux_attempts + attempt,
+                target_video_bitrate,
+                is_hq_audio,
+                displayed_res,
+                target_fps
+            )
+            output_fn(0, None)
+
+            if on_attempt_start:
+                on_attempt_start(factor)
+
+            # Below 5 kbps, barely anything is perceptible in the video anymore.
+            if target_video_bitrate < 5000:
+                return _("Constrict: Video bitrate got too low (<5 kbps). The target size may be too low for this file.")
+
+            target_width, target_height = get_target_dimensions(
+                width,
+                height,
+                target_height
+            )
+
+            def get_dest_frame_count() -> int:
+                if input_mime_type == "image/gif":
+                    dest_frame_count = source_frame_count
+                else:
+                    dest_frame_count = int(
+                        source_frame_count // (source_fps / target_fps)
+                    )
+
+                return dest_frame_count or 1
+
+            audio_source, audio_error = prepare_audio(
+                file_input,
+                media_info,
+                target_audio_bitrate,
+                scratch_dir.name,
+                cancel_event
+            )
+
+            if audio_error is not None:
+                return audio_error
+
+            if cancel_event():
+                return None
+
+            pass_key = get_first_pass_key(
+                target_video_bitrate,
+                target_width,
+                target_height,
+                target_fps,
+                codec,
+                can_ha,
+                extra_quality
+            )
+
+            # The first attempt may well be the only one, so an intermediate
+            # is only worth making for retries.
+            output_fps = target_fps if target_fps > 0 else source_fps
+            use_intermediate = (
+                intermediate_budget_MiB > 0
+                and attempt > 1
+                and input_mime_type != "image/gif"
+                and width * height * source_fps >= (
+                    target_width * target_height * output_fps
+                    * INTERMEDIATE_MIN_SCALE
+                )
+            )
+
+            intermediate_key = (target_width, target_height, target_fps)
+
+            if intermediate_path is not None and (
+                not use_intermediate
+                or intermediate_key != last_intermediate_key
+            ):
+                # Only keep one intermediate within the scratch budget.
+                os.remove(intermediate_path)
+                intermediate_path = None
+
+            if use_intermediate and intermediate_path is None:
+                intermediate_path, intermediate_error = make_intermediate(
+                    file_input,
+                    media_info,
+                    target_width,
+                    target_height,
+                    target_fps,
+                    scratch_dir.name,
+                    intermediate_budget_MiB * 1024 * 1024,
+                    cancel_event,
+                    threads
+                )
+                last_intermediate_key = intermediate_key
+
+                if intermediate_error is not None:
+                    # Reading from the source still works.
+                    print(f'Warning: could not make intermediate: {intermediate_error}')
+
+                if cancel_event():
+                    return None
+
+            projected_size = None
+
+            def monitor_size(total_size: int, out_time: float) -> bool:
+                nonlocal projected_size
+
+                if early_abort_margin is None:
+                    return False
+
+                if out_time < duration_seconds * EARLY_ABORT_MIN_PROGRESS:
+                    return False
+
+                # No point aborting if the bitrate can't go any higher.
+                if target_video_bitrate >= MAX_VIDEO_BITRATE:
+                    return False
+
+                projection = total_size * duration_seconds / out_time
+                projected_percent = (100 / target_bytes_limit) * projection
+
+                overshooting = projected_percent > 100 + early_abort_margin
+
+                # Undershooting is only retried on the first attempt of a video
+                # that doesn't already fit. See below.
+                undershooting = (
+                    projected_percent < 100 - tolerance - early_abort_margin
+                    and attempt == 1
+                    and not do_basic_transcode
+                )
+
+                if overshooting or undershooting:
+                    projected_size = int(projection)
+                    return True
+
+                return False
+
+            # Retries with the same video geometry can reuse the last attempt's
+            # first pass, as only the bitrate has changed.
+            reuse_first_pass = (
+                pass_key is not None
+                and pass_key == last_pass_key
+                and log_path is not None
+            )
+
+            if chunk_count > 1:
+                transcode_error = transcode_chunked(
+                    file_input,
+                    file_output,
+                    target_video_bitrate,
+                    target_audio_bitrate,
+                    target_width,
+                    target_height,
+                    media_info.rotation,
+                    media_info.subtitle_streams,
+                    media_info.audio_channel_count,
+                    target_fps,
+                    codec,
+                    can_ha,
+                    extra_quality,
+                    output_fn,
+                    duration_seconds,
+                    log_path,
+                    cancel_event,
+                    chunk_count,
+                    skip_first_pass=reuse_first_pass,
+                    audio_source=audio_source,
+                    video_source=intermediate_path,
+                    threads=threads,
+                    chunk_workers=1 if can_ha else chunk_workers,
+                    checkpoint=checkpoint
+                )
+            else:
+                transcode_error = transcode(
+                    file_input,
+                    file_output,
+                    target_video_bitrate,
+                    target_audio_bitrate,
+                    target_width,
+                    target_height,
+                    media_info.rotation,
+                    media_info.subtitle_streams,
+                    media_info.audio_channel_count,
+                    target_fps,
+                    codec,
+                    can_ha,
+                    extra_quality,
+                    output_fn,
+                    get_dest_frame_count,
+                    log_path,
+                    cancel_event,
+                    skip_first_pass=reuse_first_pass,
+                    size_monitor=monitor_size,
+                    audio_source=audio_source,
+                    on_second_pass=on_second_pass,
+                    video_source=intermediate_path,
+                    threads=threads
+                )
+
+            if transcode_error != None:
+                return transcode_error
+
+            last_pass_key = pass_key
+
+            if cancel_event():
+                return None
+
+            if projected_size is not None:
+                # The attempt was abandoned early. Go straight to the next one.
+                after_size_bytes = projected_size
+                size_projected = True
             else:
-                # The quality's not likely to get better than this, so quit
-                # now. Another attempt would be pointless.
+                size_projected = False
+
+                try:
+                    after_size_bytes = os.stat(file_output).st_size
+                except FileNotFoundError:
+                    return _("Constrict: Cannot read output file. Was it moved or deleted mid-compression?")
+
+                if use_history:
+                    attempt_encoder, attempt_preset, attempt_use_ha = get_encoder_settings(
+                        target_video_bitrate,
+                        target_width,
+                        target_height,
+                        codec,
+                        can_ha,
+                        extra_quality
+                    )
+
+                    rate_history.record_attempt(
+                        attempt_encoder,
+                        attempt_preset,
+                        min(target_width, target_height),
+                        target_fps,
+                        target_video_bitrate,
+                        target_audio_bitrate,
+                        after_size_bytes,
+                        duration_seconds
+                    )
+
+            percent_of_target = (100 / target_bytes_limit) * after_size_bytes
+
+            if on_attempt_done:
+                on_attempt_done(factor, percent_of_target, target_video_bitrate)
+
+            if target_video_bitrate >= MAX_VIDEO_BITRATE:
+                # No point ever repeating if the video bitrate is already at max.
                 break
+            elif percent_of_target < 100 and (do_basic_transcode or attempt > 1):
+                if do_basic_transcode:
+                    percent_of_original = (100 / before_size_bytes) * after_size_bytes
+                    if percent_of_original >= 100 - tolerance or attempt > 1:
+                        break
+
+                    # Try to increase bitrate for 1 more attempt only.
+                    percent_of_target = percent_of_original
+                else:
+                    # The quality's not likely to get better than this, so quit
+                    # now. Another attempt would be pointless.
+                    break
+
+            if percent_of_target > 50:
+                # Don't transcode to higher resolutions in future attempts
+                lowest_res = target_height if height < width else target_width
 
-        if percent_of_target > 50:
-            # Don't transcode to higher resolutions in future attempts
-            lowest_res = target_height if height < width else target_width
+            attempt_history.append((factor, percent_of_target))
 
-        # We multiply by 0.98 to prevent lots of attempts with sizes just
-        # bordering above the target.
-        factor *= 0.98 * (100 / percent_of_target)
+            factor = get_next_factor(
+                attempt_history,
+                tolerance,
+                RateSearch.PROPORTIONAL if do_basic_transcode else rate_search
+            )
 
-    return after_size_bytes
+        return after_size_bytes
+    finally:
+        compression_over.set()
+        scratch_dir.cleanup()
 
@@ -0,0 +1,422 @@
+# encode_scheduler.py
+#
+# Copyright 2025 Wartybix
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+try:
+    from constrict.enums import QueueOrder
+except ModuleNotFoundError:
+    from enums import QueueOrder
+from typing import (
+    Any, Callable, Dict, FrozenSet, List, NamedTuple, Optional, Sequence
+)
+from pathlib import Path
+import threading
+import os
+
+# Number of CPU cores shared between every video being compressed, in every
+# window.
+THREAD_BUDGET = os.cpu_count() or 1
+
+# Upper bound on videos compressed at the same time, to limit memory usage.
+MAX_CONCURRENT_JOBS = 4
+
+# Where the kernel lists the CPUs of each NUMA node.
+NUMA_NODE_DIR = '/sys/devices/system/node'
+
+
+class JobPlacement(NamedTuple):
+    """ The share of the CPU a job was given: how many threads its encoder
+    should use, and the CPUs it's confined to (None if it may use any)
+    """
+    threads: int
+    cpus: Optional[FrozenSet[int]]
+
+
+def parse_cpu_list(cpu_list: str) -> FrozenSet[int]:
+    """ Return the CPUs in a kernel CPU list, like '0-3,8-11' """
+    cpus = set()
+
+    for cpu_range in cpu_list.strip().split(','):
+        if not cpu_range:
+            continue
+
+        first, _, last = cpu_range.partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+
+    return frozenset(cpus)
+
+
+def get_usable_cpus() -> FrozenSet[int]:
+    """ Return the CPUs this process may run on """
+    try:
+        return frozenset(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        return frozenset(range(os.cpu_count() or 1))
+
+
+def get_numa_nodes() -> List[FrozenSet[int]]:
+    """ Return the usable CPUs of each NUMA node. On systems without NUMA
+    information, every usable CPU is treated as being on one node.
+    """
+    usable_cpus = get_usable_cpus()
+    nodes = []
+
+    try:
+        for node_dir in sorted(Path(NUMA_NODE_DIR).glob('node[0-9]*')):
+            node_cpus = parse_cpu_list(
+                (node_dir / 'cpulist').read_text()
+            ) & usable_cpus
+
+            if node_cpus:
+                nodes.append(node_cpus)
+    except (OSError, ValueError):
+        nodes = []
+
+    return nodes or [usable_cpus]
+
+
+def order_jobs(
+    costs: Sequence[float],
+    queue_order: int,
+    slot_count: int
+) -> List[int]:
+    """ Return the indices of jobs with the passed estimated costs, in the
+    order they should be started.
+
+    With QueueOrder.SHORTEST_FIRST, cheaper jobs go first, which minimizes the
+    average time until a video is done. With QueueOrder.BALANCED, the most
+    expensive jobs go first if several run at once (slot_count), so that no
+    long job is left running alone at the end of the batch. With
+    QueueOrder.STRICT, jobs are started in the order they were passed.
+    """
+    indices = list(range(len(costs)))
+
+    if queue_order == QueueOrder.SHORTEST_FIRST or (
+        queue_order == QueueOrder.BALANCED and slot_count <= 1
+    ):
+        # Only running jobs one at a time, balancing has nothing to gain.
+        indices.sort(key=lambda x: costs[x])
+    elif queue_order == QueueOrder.BALANCED:
+        indices.sort(key=lambda x: costs[x], reverse=True)
+
+    return indices
+
+
+class EncodeBatch:
+    """ Videos submitted to the scheduler together, by one owner (like a
+    window)
+    """
+    def __init__(
+        self,
+        owner: Any,
+        jobs: Sequence[Callable[[JobPlacement], None]],
+        threads_per_job: int,
+        max_jobs: Optional[int]
+    ) -> None:
+        self.owner = owner
+        self.pending = list(jobs)
+        self.threads_per_job = threads_per_job
+        self.max_jobs = max_jobs or MAX_CONCURRENT_JOBS
+        self.running = 0
+
+    def can_start(self) -> bool:
+        """ Whether the batch has a job waiting, and room to start it """
+        return bool(self.pending) and self.running < self.max_jobs
+
+
+class CorePartitioner:
+    """ Hands out disjoint sets of CPUs to jobs, keeping each job on as few
+    NUMA nodes as possible so that its threads share caches and memory.
+
+    No more than limit CPUs are handed out at once, if passed (e.g. to match
+    a thread budget smaller than the machine). See set_limit().
+    """
+    def __init__(
+        self,
+        nodes: Optional[List[FrozenSet[int]]] = None,
+        limit: Optional[int] = None
+    ) -> None:
+        self.nodes = nodes or get_numa_nodes()
+        self.free_cpus = [set(x) for x in self.nodes]
+        self.limit = limit
+        self.allocated = 0
+
+    def set_limit(self, limit: Optional[int]) -> None:
+        """ Change how many CPUs may be handed out at once. CPUs already
+        handed out are unaffected.
+        """
+        self.limit = limit
+
+    def allocate(self, count: int) -> Optional[FrozenSet[int]]:
+        """ Reserve the passed number of CPUs, or return None if that many
+        aren't free
+        """
+        if sum(len(x) for x in self.free_cpus) < count:
+            return None
+
+        if self.limit is not None and self.allocated + count > self.limit:
+            return None
+
+        # The node with the fewest free CPUs that still fits the whole job,
+        # to leave bigger nodes for bigger jobs.
+        fitting_nodes = [x for x in self.free_cpus if len(x) >= count]
+
+        if fitting_nodes:
+            nodes = [min(fitting_nodes, key=len)]
+        else:
+            nodes = sorted(self.free_cpus, key=len, reverse=True)
+
+        cpus = set()
+
+        for node in nodes:
+            taken = sorted(node)[:count - len(cpus)]
+            node.difference_update(taken)
+            cpus.update(taken)
+
+            if len(cpus) == count:
+                break
+
+        self.allocated += count
+
+        return frozenset(cpus)
+
+    def release(self, cpus: FrozenSet[int]) -> None:
+        """ Give back CPUs reserved by allocate() """
+        for node, node_cpus in zip(self.free_cpus, self.nodes):
+            node.update(cpus & node_cpus)
+
+        self.allocated -= len(cpus)
+
+
+class EncodeScheduler:
+    """ Runs compression jobs from every window of the application, so that
+    windows compressing at the same time share the CPU instead of fighting
+    over it.
+
+    Jobs only start while the CPU cores they need fit in the thread budget,
+    and never more than MAX_CONCURRENT_JOBS at once. Batches take turns
+    starting jobs, so every window makes progress. A job that needs more
+    than the whole budget still runs, but only on its own.
+
+    Each job is passed a JobPlacement saying how many threads it may use.
+    Idle cores are split between the jobs of a batch, so a batch running
+    fewer jobs than fit gives each more threads. If cores are pinned (see
+    set_pin_cores()), each job is also given its own CPUs.
+    """
+    def __init__(self, thread_budget: int = THREAD_BUDGET) -> None:
+        self.thread_budget = max(thread_budget, 1)
+        self.threads_used = 0
+        self.running = 0
+        self.batches: List[EncodeBatch] = []
+        self.condition = threading.Condition()
+        self.pin_cores = False
+        self.partitioner = CorePartitioner(limit=self.thread_budget)
+
+    def set_thread_budget(self, thread_budget: int) -> None:
+        """ Change the number of CPU cores shared between jobs. Jobs already
+        running are unaffected.
+        """
+        with self.condition:
+            self.thread_budget = max(thread_budget, 1)
+            self.partitioner.set_limit(self.thread_budget)
+
+            self.dispatch()
+            self.condition.notify_all()
+
+    def set_pin_cores(self, pin_cores: bool) -> None:
+        """ Set whether jobs started from now on are confined to their own
+        CPUs
+        """
+        with self.condition:
+            self.pin_cores = pin_cores
+
+    def get_slot_count(self, threads_per_job: int) -> int:
+        """ Return how many jobs that each keep the passed number of CPU cores
+        busy can run at once, if nothing else is running
+        """
+        slot_count = self.thread_budget // max(threads_per_job, 1)
+
+        return min(max(slot_count, 1), MAX_CONCURRENT_JOBS)
+
+    def run_batch(
+        self,
+        owner: Any,
+        jobs: Sequence[Callable[[JobPlacement], None]],
+        threads_per_job: int,
+        max_jobs: Optional[int] = None
+    ) -> None:
+        """ Run the passed jobs, each of which keeps at least threads_per_job
+        CPU cores busy, and wait for all of them to finish. No more than
+        max_jobs of them run at once, if passed. To be run in a separate
+        thread.
+        """
+        batch = EncodeBatch(
+            owner,
+            jobs,
+            min(max(threads_per_job, 1), self.thread_budget),
+            max_jobs
+        )
+
+        with self.condition:
+            self.batches.append(batch)
+            self.dispatch()
+
+            while batch.pending or batch.running:
+                self.condition.wait()
+
+            self.batches.remove(batch)
+
+    def cancel(self, owner: Any) -> None:
+        """ Drop the jobs of the passed owner that haven't started yet.
+        Running jobs are left to notice cancellation themselves.
+        """
+        with self.condition:
+            for batch in self.batches:
+                if batch.owner is owner:
+                    batch.pending.clear()
+
+            self.condition.notify_all()
+
+    def run_prefetch(
+        self,
+        job: Callable[[], None],
+        threads: int,
+        overlap_percent: int
+    ) -> bool:
+        """ Run a job that prepares work ahead of time (like the first pass of
+        the next video), if it fits in the thread budget plus an overlap of
+        overlap_percent of it. Returns whether the job was started.
+        """
+        overlap_threads = self.thread_budget * overlap_percent // 100
+
+        with self.condition:
+            fits = self.threads_used + threads <= (
+                self.thread_budget + overlap_threads
+            )
+
+            if overlap_threads <= 0 or not fits:
+                return False
+
+            self.threads_used += threads
+
+        prefetch_thread = threading.Thread(
+            target=self.run_prefetch_job,
+            args=[job, threads]
+        )
+        prefetch_thread.daemon = True
+        prefetch_thread.start()
+
+        return True
+
+    def run_prefetch_job(self, job: Callable[[], None], threads: int) -> None:
+        """ Run a prefetch job, then give its share of the budget back """
+        try:
+            job()
+        except Exception as e:
+            print(f'Warning: prefetch job failed: {e}')
+        finally:
+            with self.condition:
+                self.threads_used -= threads
+
+                self.dispatch()
+                self.condition.notify_all()
+
+    def dispatch(self) -> None:
+        """ Start as many waiting jobs as the budget allows. Must be called
+        with the condition held.
+        """
+        while self.running < MAX_CONCURRENT_JOBS:
+            # The batch that started a job least recently goes first. If its
+            # job doesn't fit yet, nothing else starts, so that batches with
+            # cheaper jobs can't starve it.
+            batch = next((x for x in self.batches if x.can_start()), None)
+
+            if batch is None:
+                return
+
+            placement = self.place_job(batch)
+
+            fits = self.threads_used + placement.threads <= self.thread_budget
+
+            if self.running and not fits:
+                if placement.cpus:
+                    self.partitioner.release(placement.cpus)
+                return
+
+            if self.pin_cores and placement.cpus is None:
+                print(
+                    f'Warning: {placement.threads} CPUs are not free to pin '
+                    f'a job to, so it runs unpinned'
+                )
+
+            job = batch.pending.pop(0)
+            batch.running += 1
+            self.running += 1
+            self.threads_used += placement.threads
+
+            self.batches.remove(batch)
+            self.batches.append(batch)
+
+            job_thread = threading.Thread(
+                target=self.run_job,
+                args=[batch, job, placement]
+            )
+            job_thread.daemon = True
+            job_thread.start()
+
+    def place_job(self, batch: EncodeBatch) -> JobPlacement:
+        """ Return the share of the CPU the next job of the passed batch
+        would get if started now. Must be called with the condition held.
+        """
+        slot_count = min(
+            self.get_slot_count(batch.threads_per_job),
+            batch.max_jobs
+        )
+        threads_free = self.thread_budget - self.threads_used
+
+        threads = max(
+            min(self.thread_budget // slot_count, threads_free),
+            batch.threads_per_job
+        )
+
+        cpus = self.partitioner.allocate(threads) if self.pin_cores else None
+
+        return JobPlacement(threads, cpus)
+
+    def run_job(
+        self,
+        batch: EncodeBatch,
+        job: Callable[[JobPlacement], None],
+        placement: JobPlacement
+    ) -> None:
+        """ Run a job, then give its share of the budget back """
+        try:
+            job(placement)
+        except Exception as e:
+            print(f'Warning: compression job failed: {e}')
+        finally:
+            with self.condition:
+                batch.running -= 1
+                self.running -= 1
+                self.threads_used -= placement.threads
+
+                if placement.cpus:
+                    self.partitioner.release(placement.cpus)
+
+                self.dispatch()
+                self.condition.notify_all()
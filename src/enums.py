@@ -41,3 +41,13 @@ class SourceState:
     INCOMPATIBLE = 5
     WARN = 6
 
+
+class RateSearch:
+    PROPORTIONAL = 0
+    SECANT = 1
+
+
+class QueueOrder:
+    STRICT = 0
+    SHORTEST_FIRST = 1
+    BALANCED = 2
@@ -0,0 +1,497 @@
+# ffmpeg_supervisor.py
+#
+# Copyright 2025 Wartybix
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import asyncio
+import atexit
+import contextvars
+import os
+import shutil
+import signal
+import threading
+import time
+from typing import (
+    Any, Callable, Dict, FrozenSet, IO, List, Optional, Sequence, Set, Tuple
+)
+
+
+# Module responsible for running ffmpeg processes. Every process is watched
+# by a task on a single asyncio event loop, rather than by a thread blocked
+# on its output, so any number of encodes can run at once. In the
+# application, this is the GLib-integrated loop from main.py. Elsewhere (like
+# the CLI), a loop is started in a background thread when first needed.
+
+# Seconds a process is given to exit after SIGTERM before it gets SIGKILL.
+TERMINATE_TIMEOUT = 3.0
+
+# Seconds between checks of whether a process should be cancelled.
+CANCEL_POLL_INTERVAL = 0.1
+
+# Niceness of processes while in background mode.
+BACKGROUND_NICENESS = 10
+
+# Seconds in each cycle of running and stopping processes to enforce a CPU
+# quota in background mode.
+QUOTA_PERIOD = 0.5
+
+# The group processes started by the current thread belong to. Groups (like
+# a window) can be paused and resumed as one. See set_group().
+current_group = contextvars.ContextVar('current_group', default=None)
+
+def set_group(group: Any) -> None:
+    """ Make processes started by the current thread belong to the passed
+    group. Threads don't inherit this, so copy the context into any threads
+    started for the same work (see contextvars.copy_context()).
+    """
+    current_group.set(group)
+
+# The CPUs processes started by the current thread are confined to, or None
+# to let them run on any CPU. See set_cpu_affinity().
+current_cpus = contextvars.ContextVar('current_cpus', default=None)
+
+def set_cpu_affinity(cpus: Optional[FrozenSet[int]]) -> None:
+    """ Confine processes started by the current thread to the passed CPUs,
+    or let them run on any CPU if None. Like set_group(), threads don't
+    inherit this.
+    """
+    current_cpus.set(cpus)
+
+
+class ProcessSupervisor:
+    """ Runs subprocesses as tasks on an asyncio event loop, passing each
+    line of their output to a callback as it arrives, and stopping them
+    gracefully (SIGTERM, then SIGKILL) when cancelled.
+    """
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop] = None) -> None:
+        self.loop = loop
+        self.lock = threading.Lock()
+
+        # Running processes by group, the groups that are paused, and the
+        # state of background mode. Only used from the loop.
+        self.processes: Dict[Any, Set[asyncio.subprocess.Process]] = {}
+        self.paused_groups: Set[Any] = set()
+        self.background = False
+        self.cpu_quota = 100
+        self.quota_task: Optional[asyncio.Future] = None
+
+        # IDs of the running processes (and so of their process groups),
+        # usable from any thread. See terminate_all().
+        self.pids: Set[int] = set()
+
+        # Processes run in their own sessions, so they don't get the
+        # interrupts of a terminal (e.g. Ctrl+C in the CLI) and could
+        # outlive us.
+        atexit.register(self.terminate_all)
+
+    def get_loop(self) -> asyncio.AbstractEventLoop:
+        """ Return the loop processes are run on, starting one in a
+        background thread if no loop was passed
+        """
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+
+                loop_thread = threading.Thread(target=self.loop.run_forever)
+                loop_thread.daemon = True
+                loop_thread.start()
+
+            return self.loop
+
+    async def supervise(
+        self,
+        cmd: Sequence[str],
+        on_line: Callable[[str], bool],
+        cancel_event: Callable[[], bool],
+        stderr: Optional[IO[Any]] = None,
+        group: Any = None,
+        cpus: Optional[FrozenSet[int]] = None
+    ) -> Tuple[Optional[int], bool]:
+        """ Run a command, passing each line of its standard output to
+        on_line. The process is stopped if on_line returns True, if
+        cancel_event returns True, or if this task is cancelled. Standard
+        error is written to the passed file, if any.
+
+        The process belongs to the passed group, and starts paused if the
+        group is paused. It runs in its own session, so that pausing it
+        pauses anything it starts too. If cpus is passed, the process and
+        every thread it starts only run on those CPUs.
+
+        Returns the process' return code, and whether it was stopped early
+        (in which case the return code is None).
+        """
+        if self.background:
+            # Deprioritized from the start, without another process to do it.
+            cmd = [*get_background_prefix(), *cmd]
+
+        taskset = shutil.which('taskset') if cpus else None
+
+        if taskset:
+            # Set before ffmpeg starts, so every thread it creates inherits
+            # it.
+            cpu_list = ','.join(str(x) for x in sorted(cpus))
+            cmd = [taskset, '-c', cpu_list, *cmd]
+
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=stderr if stderr is not None else (
+                asyncio.subprocess.DEVNULL
+            ),
+            start_new_session=True
+        )
+
+        if cpus and not taskset:
+            # Only threads ffmpeg creates from now on inherit this, but it
+            # creates its encoding threads after reading its input.
+            try:
+                os.sched_setaffinity(proc.pid, cpus)
+            except OSError as e:
+                print(f'Warning: could not set CPU affinity: {e}')
+
+        self.processes.setdefault(group, set()).add(proc)
+
+        with self.lock:
+            self.pids.add(proc.pid)
+
+        if group in self.paused_groups:
+            self.signal(proc, signal.SIGSTOP)
+
+        stop_requested = False
+
+        async def read_output() -> None:
+            nonlocal stop_requested
+
+            assert proc.stdout is not None
+
+            async for line in proc.stdout:
+                if on_line(line.decode('utf-8', errors='replace')):
+                    stop_requested = True
+                    return
+
+        async def watch_cancel() -> None:
+            while not cancel_event():
+                await asyncio.sleep(CANCEL_POLL_INTERVAL)
+
+        reader = asyncio.ensure_future(read_output())
+        watcher = asyncio.ensure_future(watch_cancel())
+
+        try:
+            done, pending = await asyncio.wait(
+                [reader, watcher],
+                return_when=asyncio.FIRST_COMPLETED
+            )
+
+            for task in pending:
+                task.cancel()
+
+            if reader in done and not stop_requested:
+                reader.result()
+                await proc.wait()
+                return (proc.returncode, False)
+
+            await self.stop(proc)
+            return (None, True)
+        except asyncio.CancelledError:
+            reader.cancel()
+            watcher.cancel()
+            await self.stop(proc)
+            raise
+        finally:
+            with self.lock:
+                self.pids.discard(proc.pid)
+
+            group_processes = self.processes.get(group, set())
+            group_processes.discard(proc)
+
+            if not group_processes:
+                self.processes.pop(group, None)
+
+    async def stop(self, proc: asyncio.subprocess.Process) -> None:
+        """ Ask a process to exit, killing it if it doesn't in time """
+        if proc.returncode is not None:
+            return
+
+        try:
+            proc.terminate()
+            # A paused process can't exit until it's resumed.
+            self.signal(proc, signal.SIGCONT)
+            await asyncio.wait_for(proc.wait(), TERMINATE_TIMEOUT)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+        except ProcessLookupError:
+            # Already exited.
+            pass
+
+    def run(
+        self,
+        cmd: Sequence[str],
+        on_line: Callable[[str], bool],
+        cancel_event: Callable[[], bool],
+        stderr: Optional[IO[Any]] = None
+    ) -> Tuple[Optional[int], bool]:
+        """ Run supervise() on the loop and wait for the result, in the
+        current thread's group and on its CPUs (see set_group() and
+        set_cpu_affinity()). Must not be called from the loop's own thread.
+        """
+        future = asyncio.run_coroutine_threadsafe(
+            self.supervise(
+                cmd,
+                on_line,
+                cancel_event,
+                stderr,
+                current_group.get(),
+                current_cpus.get()
+            ),
+            self.get_loop()
+        )
+
+        try:
+            return future.result()
+        except BaseException as e:
+            future.cancel()
+
+            if not isinstance(e, Exception):
+                # e.g. KeyboardInterrupt in the CLI. The interpreter may exit
+                # before the loop gets to stop the process, so stop every
+                # process now.
+                self.terminate_all()
+
+            raise
+
+    def terminate_all(self) -> None:
+        """ Stop every running process and anything it started, waiting for
+        them to exit (SIGTERM, then SIGKILL). Unlike stop(), this blocks and
+        can be called from any thread, even if the loop isn't running.
+        """
+        with self.lock:
+            pids = list(self.pids)
+
+        if not pids:
+            return
+
+        for pid in pids:
+            for signum in [signal.SIGTERM, signal.SIGCONT]:
+                try:
+                    os.killpg(pid, signum)
+                except ProcessLookupError:
+                    pass
+
+        deadline = time.monotonic() + TERMINATE_TIMEOUT
+
+        while pids and time.monotonic() < deadline:
+            time.sleep(CANCEL_POLL_INTERVAL)
+
+            with self.lock:
+                pids = [x for x in pids if x in self.pids and is_running(x)]
+
+        for pid in pids:
+            try:
+                os.killpg(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    def signal(self, proc: asyncio.subprocess.Process, signum: int) -> None:
+        """ Send a signal to a process and anything it started """
+        if proc.returncode is not None:
+            return
+
+        try:
+            os.killpg(proc.pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def call_in_loop(self, function: Callable, *args: Any) -> None:
+        """ Run a function on the loop, from any thread """
+        self.get_loop().call_soon_threadsafe(function, *args)
+
+    def pause(self, group: Any) -> None:
+        """ Stop the processes of a group (SIGSTOP) until resumed. Processes
+        started in the group meanwhile start paused.
+        """
+        self.call_in_loop(self.set_paused, group, True)
+
+    def resume(self, group: Any) -> None:
+        """ Continue the processes of a paused group (SIGCONT) """
+        self.call_in_loop(self.set_paused, group, False)
+
+    def set_paused(self, group: Any, paused: bool) -> None:
+        """ Pause or resume the processes of a group. Must be called from the
+        loop.
+        """
+        if paused:
+            self.paused_groups.add(group)
+        else:
+            self.paused_groups.discard(group)
+
+        for proc in self.processes.get(group, set()):
+            self.signal(proc, signal.SIGSTOP if paused else signal.SIGCONT)
+
+    def set_background(self, background: bool, cpu_quota: int = 100) -> None:
+        """ Switch background mode on or off, for running processes and those
+        started later. In background mode, processes get a lower CPU and I/O
+        priority, and if cpu_quota is under 100, they're stopped for part of
+        every QUOTA_PERIOD so they use no more than cpu_quota percent of the
+        time they'd otherwise get.
+        """
+        self.call_in_loop(self.apply_background, background, cpu_quota)
+
+    def apply_background(self, background: bool, cpu_quota: int) -> None:
+        """ Apply background mode. Must be called from the loop. """
+        was_background = self.background
+        self.background = background
+        self.cpu_quota = min(max(cpu_quota, 1), 100)
+
+        if background and not was_background:
+            for group_processes in self.processes.values():
+                for proc in group_processes:
+                    self.deprioritize(proc)
+        elif was_background and not background:
+            for group_processes in self.processes.values():
+                for proc in group_processes:
+                    self.reprioritize(proc)
+
+        throttle = background and self.cpu_quota < 100
+
+        if throttle and self.quota_task is None:
+            self.quota_task = asyncio.ensure_future(self.enforce_quota())
+        elif not throttle and self.quota_task is not None:
+            self.quota_task.cancel()
+            self.quota_task = None
+
+    def deprioritize(self, proc: asyncio.subprocess.Process) -> None:
+        """ Lower the CPU and I/O priority of a running process. Must be
+        called from the loop.
+        """
+        try:
+            os.setpriority(os.PRIO_PROCESS, proc.pid, BACKGROUND_NICENESS)
+        except OSError:
+            pass
+
+        asyncio.ensure_future(self.set_io_class(proc, 'idle'))
+
+    def reprioritize(self, proc: asyncio.subprocess.Process) -> None:
+        """ Restore the CPU and I/O priority of a process, as far as allowed.
+        Unprivileged users usually can't lower a process' niceness again, in
+        which case it stays in the background until it exits. Must be called
+        from the loop.
+        """
+        try:
+            os.setpriority(os.PRIO_PROCESS, proc.pid, 0)
+        except OSError:
+            pass
+
+        asyncio.ensure_future(self.set_io_class(proc, 'best-effort'))
+
+    async def set_io_class(
+        self,
+        proc: asyncio.subprocess.Process,
+        io_class: str
+    ) -> None:
+        """ Set the I/O scheduling class of a process, if ionice is
+        available
+        """
+        ionice = shutil.which('ionice')
+
+        if ionice is None or proc.returncode is not None:
+            return
+
+        try:
+            ionice_proc = await asyncio.create_subprocess_exec(
+                ionice, '-c', io_class, '-p', str(proc.pid),
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL
+            )
+            await ionice_proc.wait()
+        except OSError:
+            pass
+
+    async def enforce_quota(self) -> None:
+        """ Stop and continue unpaused processes in cycles, to keep them
+        within the CPU quota
+        """
+        try:
+            while True:
+                run_time = QUOTA_PERIOD * self.cpu_quota / 100
+                await asyncio.sleep(run_time)
+
+                self.signal_unpaused(signal.SIGSTOP)
+                await asyncio.sleep(QUOTA_PERIOD - run_time)
+                self.signal_unpaused(signal.SIGCONT)
+        except asyncio.CancelledError:
+            self.signal_unpaused(signal.SIGCONT)
+            raise
+
+    def signal_unpaused(self, signum: int) -> None:
+        """ Send a signal to every process of every group not paused """
+        for group, group_processes in self.processes.items():
+            if group in self.paused_groups:
+                continue
+
+            for proc in group_processes:
+                self.signal(proc, signum)
+
+
+def get_background_prefix() -> List[str]:
+    """ Return the command that runs a command after it with the CPU and I/O
+    priority of background mode, as far as the tools for it are available
+    """
+    prefix = []
+    nice = shutil.which('nice')
+    ionice = shutil.which('ionice')
+
+    if nice:
+        prefix.extend([nice, '-n', str(BACKGROUND_NICENESS)])
+
+    if ionice:
+        prefix.extend([ionice, '-c', 'idle'])
+
+    return prefix
+
+
+def is_running(pid: int) -> bool:
+    """ Whether anything in the process group with the passed ID is still
+    running
+    """
+    try:
+        os.killpg(pid, 0)
+    except ProcessLookupError:
+        return False
+
+    return True
+
+
+supervisor: Optional[ProcessSupervisor] = None
+
+def set_event_loop(loop: asyncio.AbstractEventLoop) -> None:
+    """ Run all processes on the passed loop from now on. Must be called
+    before any process is run.
+    """
+    global supervisor
+
+    supervisor = ProcessSupervisor(loop)
+
+def get_supervisor() -> ProcessSupervisor:
+    """ Return the supervisor every ffmpeg process is run with """
+    global supervisor
+
+    if supervisor is None:
+        supervisor = ProcessSupervisor()
+
+    return supervisor
@@ -27,6 +27,8 @@ gi.require_version('Adw', '1')
 from gi.repository import Gtk, Gio, Adw, GLib
 from .window import ConstrictWindow
 from constrict.preferences_dialog import PreferencesDialog
+from constrict.encode_scheduler import EncodeScheduler, THREAD_BUDGET
+from constrict import ffmpeg_supervisor, batch_journal
 from constrict import APPLICATION_ID, VERSION, PREFIX
 from typing import List, Sequence, Callable, Any
 import asyncio
@@ -56,6 +58,10 @@ class ConstrictApplication(Adw.Application):
 
         self.loop = policy.get_event_loop()
 
+        # Run ffmpeg processes on the main loop, rather than with a thread
+        # blocked on each one's output.
+        ffmpeg_supervisor.set_event_loop(self.loop)
+
         self.create_action('new-window', lambda *_: self.new_window(), ['<primary>n'])
         self.create_action('quit', lambda *_: self.quit(), ['<primary>q'])
         self.create_action('about', self.on_about_action)
@@ -83,6 +89,26 @@ class ConstrictApplication(Adw.Application):
 
         self.settings = Gio.Settings(schema_id=self.get_application_id())
 
+        # Shared by every window, so that they don't oversubscribe the CPU
+        # when compressing at the same time.
+        self.encode_scheduler = EncodeScheduler()
+
+        self.settings.connect(
+            'changed::background-mode',
+            self.update_background_mode
+        )
+        self.settings.connect(
+            'changed::background-cpu-quota',
+            self.update_background_mode
+        )
+        self.update_background_mode()
+
+        self.settings.connect(
+            'changed::pin-cpu-cores',
+            self.update_pin_cpu_cores
+        )
+        self.update_pin_cpu_cores()
+
         # TRANSLATORS: used in parentheses for the default suffix of exported
         # files.
         self.default_suffix = f" ({_('compressed')})"
@@ -91,6 +117,33 @@ class ConstrictApplication(Adw.Application):
         """ Get the application's settings """
         return self.settings
 
+    def update_background_mode(self, *args: Any) -> None:
+        """ Apply the background mode settings to running and future
+        compressions
+        """
+        background = self.settings.get_boolean('background-mode')
+        cpu_quota = self.settings.get_int('background-cpu-quota')
+
+        ffmpeg_supervisor.get_supervisor().set_background(
+            background,
+            cpu_quota
+        )
+
+        # Leave half of the CPU to whatever else is running.
+        self.encode_scheduler.set_thread_budget(
+            THREAD_BUDGET // 2 if background else THREAD_BUDGET
+        )
+
+    def update_pin_cpu_cores(self, *args: Any) -> None:
+        """ Apply the CPU pinning setting to future compressions """
+        self.encode_scheduler.set_pin_cores(
+            self.settings.get_boolean('pin-cpu-cores')
+        )
+
+    def get_encode_scheduler(self) -> EncodeScheduler:
+        """ Get the scheduler that runs compression jobs for all windows """
+        return self.encode_scheduler
+
     def open_dir(
         self,
         widget: Gtk.Widget,
@@ -143,12 +196,21 @@ class ConstrictApplication(Adw.Application):
         if active_window:
             active_window.save_window_state()
 
+        first_window = not self.get_windows()
+
         win = ConstrictWindow(application=self)
         if self.get_application_id() == "io.github.wartybix.Constrict.Devel":
             win.get_style_context().add_class("devel")
 
         if gfiles:
             self.loop.create_task(win.stage_videos(gfiles))
+        elif first_window:
+            # Offer to carry on with the most recent batch that was
+            # interrupted, e.g. by a crash.
+            unfinished_journals = batch_journal.get_unfinished_journals()
+
+            if unfinished_journals:
+                win.offer_resume(unfinished_journals[0])
 
         win.present()
 
@@ -30,6 +30,16 @@ class PreferencesDialog(Adw.PreferencesDialog):
 
     suffix_entry_row = Gtk.Template.Child()
     gpu_encoding_row = Gtk.Template.Child()
+    calibrate_row = Gtk.Template.Child()
+    parallel_encoding_row = Gtk.Template.Child()
+    concurrent_compression_row = Gtk.Template.Child()
+    queue_order_row = Gtk.Template.Child()
+    first_pass_overlap_row = Gtk.Template.Child()
+    intermediate_budget_row = Gtk.Template.Child()
+    background_mode_row = Gtk.Template.Child()
+    background_cpu_quota_row = Gtk.Template.Child()
+    pin_cpu_cores_row = Gtk.Template.Child()
+    resumable_encoding_row = Gtk.Template.Child()
     hw_accel_group = Gtk.Template.Child()
     suffix_group = Gtk.Template.Child()
 
@@ -58,6 +68,73 @@ class PreferencesDialog(Adw.PreferencesDialog):
             'active',
             Gio.SettingsBindFlags.DEFAULT
         )
+        self.settings.bind(
+            'calibrate-bitrate',
+            self.calibrate_row,
+            'active',
+            Gio.SettingsBindFlags.DEFAULT
+        )
+        self.settings.bind(
+            'parallel-encoding',
+            self.parallel_encoding_row,
+            'active',
+            Gio.SettingsBindFlags.DEFAULT
+        )
+        self.settings.bind(
+            'concurrent-compression',
+            self.concurrent_compression_row,
+            'active',
+            Gio.SettingsBindFlags.DEFAULT
+        )
+
+        self.settings.bind(
+            'first-pass-overlap',
+            self.first_pass_overlap_row,
+            'value',
+            Gio.SettingsBindFlags.DEFAULT
+        )
+        self.settings.bind(
+            'intermediate-budget',
+            self.intermediate_budget_row,
+            'value',
+            Gio.SettingsBindFlags.DEFAULT
+        )
+        self.settings.bind(
+            'background-mode',
+            self.background_mode_row,
+            'active',
+            Gio.SettingsBindFlags.DEFAULT
+        )
+        self.settings.bind(
+            'background-cpu-quota',
+            self.background_cpu_quota_row,
+            'value',
+            Gio.SettingsBindFlags.DEFAULT
+        )
+        self.settings.bind(
+            'background-mode',
+            self.background_cpu_quota_row,
+            'sensitive',
+            Gio.SettingsBindFlags.GET
+        )
+        self.settings.bind(
+            'resumable-encoding',
+            self.resumable_encoding_row,
+            'active',
+            Gio.SettingsBindFlags.DEFAULT
+        )
+        self.settings.bind(
+            'pin-cpu-cores',
+            self.pin_cpu_cores_row,
+            'active',
+            Gio.SettingsBindFlags.DEFAULT
+        )
+
+        self.queue_order_row.set_selected(self.settings.get_enum('queue-order'))
+        self.queue_order_row.connect(
+            'notify::selected',
+            self.update_queue_order
+        )
 
         export_suffix_value = self.settings.get_string('custom-export-suffix')
         self.suffix_entry_row.set_text(export_suffix_value)
@@ -70,3 +147,7 @@ class PreferencesDialog(Adw.PreferencesDialog):
 
         toast = Adw.Toast.new(_('Changes applied'))
         self.add_toast(toast)
+
+    def update_queue_order(self, widget: Gtk.Widget, *args: Any) -> None:
+        """ Set the selected queue order to the application's settings """
+        self.settings.set_enum('queue-order', widget.get_selected())
@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+
+# probe_cache.py
+#
+# Copyright 2025 Wartybix
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import os
+import json
+import sqlite3
+import time
+from pathlib import Path
+from typing import Optional, Tuple, Any
+
+
+# Module responsible for persisting ffprobe results between sessions, so that
+# videos that have been seen before (by the GUI or the CLI) don't need to be
+# probed again. Entries are keyed by the identity of the file on disk, so an
+# entry stops matching as soon as the file is modified or replaced.
+
+# Bump whenever the format of stored entries changes, to discard old entries.
+CACHE_VERSION = 2
+
+# Least recently used entries are evicted above this many entries.
+MAX_ENTRIES = 20000
+
+
+def get_cache_dir() -> Optional[Path]:
+    """ Return the path of Constrict's directory in the user's cache
+    directory, creating it if needed. Returns None if it cannot be created.
+    """
+    xdg_cache_home = os.environ.get('XDG_CACHE_HOME')
+    cache_home = Path(xdg_cache_home) if xdg_cache_home else (
+        Path.home() / '.cache'
+    )
+    cache_dir = cache_home / 'constrict'
+
+    try:
+        cache_dir.mkdir(mode=0o755, parents=True, exist_ok=True)
+    except OSError:
+        print('Warning: could not get cache directory')
+        return None
+
+    return cache_dir
+
+
+def get_file_key(file_path: str) -> Tuple[int, int, int, int]:
+    """ Return a key identifying the current version of a file on disk, in
+    the form (device, inode, size, modification time in ns).
+    """
+    stat = os.stat(file_path)
+    return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def connect() -> Optional[sqlite3.Connection]:
+    """ Open the probe cache database, creating or resetting it if needed.
+    Returns None if the cache is unavailable.
+    """
+    cache_dir = get_cache_dir()
+
+    if not cache_dir:
+        return None
+
+    try:
+        connection = sqlite3.connect(str(cache_dir / 'probes.db'), timeout=5)
+
+        version = connection.execute('PRAGMA user_version').fetchone()[0]
+        if version != CACHE_VERSION:
+            with connection:
+                connection.execute('DROP TABLE IF EXISTS probes')
+                connection.execute(f'PRAGMA user_version = {CACHE_VERSION}')
+
+        with connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS probes ('
+                'device INTEGER, inode INTEGER, size INTEGER, '
+                'mtime_ns INTEGER, data TEXT, last_used REAL, '
+                'PRIMARY KEY (device, inode, size, mtime_ns))'
+            )
+    except sqlite3.Error as e:
+        print(f'Warning: could not open probe cache: {e}')
+        return None
+
+    return connection
+
+
+def lookup(file_path: str) -> Optional[Any]:
+    """ Return the cached probe data of the passed file, or None if there is
+    no valid entry for its current version.
+    """
+    try:
+        key = get_file_key(file_path)
+    except OSError:
+        return None
+
+    connection = connect()
+
+    if not connection:
+        return None
+
+    try:
+        with connection:
+            row = connection.execute(
+                'SELECT data FROM probes WHERE '
+                'device = ? AND inode = ? AND size = ? AND mtime_ns = ?',
+                key
+            ).fetchone()
+
+            if row is None:
+                return None
+
+            connection.execute(
+                'UPDATE probes SET last_used = ? WHERE '
+                'device = ? AND inode = ? AND size = ? AND mtime_ns = ?',
+                (time.time(), *key)
+            )
+
+        return json.loads(row[0])
+    except (sqlite3.Error, ValueError):
+        return None
+    finally:
+        connection.close()
+
+
+def store(file_path: str, data: Any) -> None:
+    """ Cache the probe data (any JSON-serializable value) of the passed file,
+    evicting the least recently used entries if the cache is full.
+    """
+    try:
+        key = get_file_key(file_path)
+    except OSError:
+        return
+
+    connection = connect()
+
+    if not connection:
+        return
+
+    try:
+        with connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?, ?, ?)',
+                (*key, json.dumps(data), time.time())
+            )
+            connection.execute(
+                'DELETE FROM probes WHERE rowid IN ('
+                'SELECT rowid FROM probes ORDER BY last_used DESC '
+                'LIMIT -1 OFFSET ?)',
+                (MAX_ENTRIES,)
+            )
+    except sqlite3.Error as e:
+        print(f'Warning: could not write to probe cache: {e}')
+    finally:
+        connection.close()
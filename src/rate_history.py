@@ -0,0 +1,207 @@
+#!/usr/bin/python3
+
+# rate_history.py
+#
+# Copyright 2025 Wartybix
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import os
+import sqlite3
+import time
+from pathlib import Path
+from statistics import median
+from typing import Optional
+
+
+# Module responsible for remembering how close past compression attempts came
+# to their requested bitrates. Encoders consistently over- or undershoot
+# depending on the codec, preset, resolution and framerate, so the first
+# attempt of a new video can be corrected using what happened to similar
+# videos before.
+
+# Oldest attempts are deleted above this many attempts.
+MAX_ATTEMPTS = 5000
+
+# How many of the most recent similar attempts a correction is based on, and
+# how many are needed before one is trusted.
+SAMPLE_SIZE = 50
+MIN_SAMPLES = 3
+
+# Framerates within this fraction of each other count as similar, so that
+# e.g. 29.97 and 30 FPS attempts are matched together.
+FPS_TOLERANCE = 0.05
+
+# Corrections are kept within these bounds, in case of unusual history.
+MIN_CORRECTION = 0.7
+MAX_CORRECTION = 1.3
+
+
+def get_data_dir() -> Optional[Path]:
+    """ Return the path of Constrict's directory in the user's data
+    directory, creating it if needed. Returns None if it cannot be created.
+    """
+    xdg_data_home = os.environ.get('XDG_DATA_HOME')
+    data_home = Path(xdg_data_home) if xdg_data_home else (
+        Path.home() / '.local' / 'share'
+    )
+    data_dir = data_home / 'constrict'
+
+    try:
+        data_dir.mkdir(mode=0o755, parents=True, exist_ok=True)
+    except OSError:
+        print('Warning: could not get data directory')
+        return None
+
+    return data_dir
+
+
+def connect() -> Optional[sqlite3.Connection]:
+    """ Open the attempt history database, creating it if needed. Returns
+    None if the history is unavailable.
+    """
+    data_dir = get_data_dir()
+
+    if not data_dir:
+        return None
+
+    try:
+        connection = sqlite3.connect(str(data_dir / 'history.db'), timeout=5)
+
+        with connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS attempts ('
+                'id INTEGER PRIMARY KEY, time REAL, encoder TEXT, '
+                'preset TEXT, height INTEGER, fps REAL, '
+                'video_bitrate INTEGER, audio_bitrate INTEGER, '
+                'size INTEGER, duration REAL)'
+            )
+    except sqlite3.Error as e:
+        print(f'Warning: could not open attempt history: {e}')
+        return None
+
+    return connection
+
+
+def record_attempt(
+    encoder: str,
+    preset: str,
+    height: int,
+    fps: float,
+    video_bitrate: int,
+    audio_bitrate: int,
+    size: int,
+    duration: float
+) -> None:
+    """ Add the outcome of a finished compression attempt to the history.
+    height is the short side of the output resolution (i.e. 1080 for 1080p).
+    """
+    connection = connect()
+
+    if not connection:
+        return
+
+    try:
+        with connection:
+            connection.execute(
+                'INSERT INTO attempts VALUES '
+                '(NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (
+                    time.time(),
+                    encoder,
+                    preset,
+                    height,
+                    fps,
+                    video_bitrate,
+                    audio_bitrate,
+                    size,
+                    duration
+                )
+            )
+            connection.execute(
+                'DELETE FROM attempts WHERE id IN ('
+                'SELECT id FROM attempts ORDER BY id DESC '
+                'LIMIT -1 OFFSET ?)',
+                (MAX_ATTEMPTS,)
+            )
+    except sqlite3.Error as e:
+        print(f'Warning: could not write to attempt history: {e}')
+    finally:
+        connection.close()
+
+
+def get_correction(
+    encoder: str,
+    preset: str,
+    height: int,
+    fps: float
+) -> Optional[float]:
+    """ Return a factor to multiply a requested bitrate by so that, going by
+    past attempts, the achieved bitrate lands on the one originally wanted.
+
+    Attempts with the same encoder, preset, resolution and a similar
+    framerate are used if there are enough of them. Otherwise, matches are
+    loosened one at a time: first ignoring framerate, then resolution, then
+    preset. Returns None if there's not enough history.
+    """
+    connection = connect()
+
+    if not connection:
+        return None
+
+    query = (
+        'SELECT size * 8.0 / duration / (video_bitrate + audio_bitrate) '
+        'FROM attempts WHERE encoder = ? {} AND duration > 0 '
+        'AND video_bitrate + audio_bitrate > 0 '
+        'ORDER BY id DESC LIMIT ?'
+    )
+
+    fps_low = fps / (1 + FPS_TOLERANCE)
+    fps_high = fps * (1 + FPS_TOLERANCE)
+
+    # From the most to the least specific.
+    matches = [
+        (
+            'AND preset = ? AND height = ? AND fps BETWEEN ? AND ?',
+            (preset, height, fps_low, fps_high)
+        ),
+        ('AND preset = ? AND height = ?', (preset, height)),
+        ('AND preset = ?', (preset,)),
+        ('', ())
+    ]
+
+    ratios = []
+
+    try:
+        for condition, params in matches:
+            ratios = [x[0] for x in connection.execute(
+                query.format(condition),
+                (encoder, *params, SAMPLE_SIZE)
+            ) if x[0] and x[0] > 0]
+
+            if len(ratios) >= MIN_SAMPLES:
+                break
+    except sqlite3.Error:
+        return None
+    finally:
+        connection.close()
+
+    if len(ratios) < MIN_SAMPLES:
+        return None
+
+    correction = 1 / median(ratios)
+
+    return min(max(correction, MIN_CORRECTION), MAX_CORRECTION)
@@ -19,12 +19,14 @@
 
 from gi.repository import GLib
 from pathlib import Path
-from typing import Optional, Any, Callable
+from typing import Optional, Any, Callable, Iterable, List, Tuple
+import threading
+import os
 
 def get_tmp_dir() -> Optional[Path]:
     """ Return the path of system temp directory, to store temporary files like
-    ffmpeg log files and video thumbnails. If the temp directory cannot be
-    located, None will be returned.
+    ffmpeg log files. If the temp directory cannot be located, None will be
+    returned.
     """
     tmp_dir = GLib.get_tmp_dir()
     constrict_tmp_dir = Path(tmp_dir) / 'constrict'
@@ -37,24 +39,241 @@ def get_tmp_dir() -> Optional[Path]:
 
     return constrict_tmp_dir if successful else None
 
+# Milliseconds between applying queued UI updates from other threads. About
+# the frame rate of most displays, so updates are never visibly late.
+UI_FLUSH_INTERVAL = 16
+
+# Setters whose queued updates are coalesced by the UI dispatcher. Only ones
+# that just show progress or text belong here, where skipping an
+# intermediate value is harmless. State changes must all be applied, in
+# order.
+COALESCED_SETTERS = frozenset([
+    'set_fraction',
+    'set_label',
+    'set_text',
+    'set_title',
+    'set_subtitle'
+])
+
+
+class UiDispatcher:
+    """ Queues UI updates from other threads, and applies them in order from
+    the main thread, at most once every UI_FLUSH_INTERVAL milliseconds.
+
+    Updates through progress and text setters (see COALESCED_SETTERS) are
+    coalesced. If the same setter of the same widget is called again before
+    the queue is applied, only the latest value is kept. So progress
+    reported many times a second, by several videos at once, doesn't flood
+    the main loop. Every other update is applied, in order.
+    """
+    def __init__(self) -> None:
+        self.pending = {}
+        self.counter = 0
+        self.flush_scheduled = False
+        self.lock = threading.Lock()
+
+    def get_key(self, function: Callable) -> Any:
+        """ Return the key updates through the passed function are coalesced
+        under, or a unique key if they shouldn't be coalesced
+        """
+        owner = getattr(function, '__self__', None)
+        name = getattr(function, '__name__', '')
+
+        if owner is not None and name in COALESCED_SETTERS:
+            return (owner, name)
+
+        self.counter += 1
+        return self.counter
+
+    def queue(self, function: Callable, arg: Any) -> None:
+        """ Queue a function to be run from the main thread, with the passed
+        argument if it isn't None
+        """
+        with self.lock:
+            key = self.get_key(function)
+
+            # Moved to the end, so updates stay in the order they were last
+            # requested in.
+            self.pending.pop(key, None)
+            self.pending[key] = (function, arg)
+
+            if not self.flush_scheduled:
+                self.flush_scheduled = True
+                GLib.timeout_add(UI_FLUSH_INTERVAL, self.flush)
+
+    def flush(self) -> bool:
+        """ Apply every queued update """
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+            self.flush_scheduled = False
+
+        for function, arg in pending.values():
+            if arg is not None:
+                function(arg)
+            else:
+                function()
+
+        return GLib.SOURCE_REMOVE
+
+
+ui_dispatcher = UiDispatcher()
+
 def update_ui(function: Callable, arg: Any, daemon: bool) -> None:
     """ A helper function to determine whether to run a passed function
-    directly, or through GLib.idle_add if running in a separate, daemonic
+    directly, or through the UI dispatcher if running in a separate, daemonic
     thread (like UI updates while videos are being compressed).
 
-    Without using GLib.idle_add, the UI can freeze when the window is inactive,
-    stopping compression progress being shown from the daemon thread. It can
-    also cause the UI to glitch out or disappear sometimes. But running
-    GLib.idle_add functions from the main thread also seems to cause bugs.
-    This just prevented me from writing too much boilerplate code.
+    Without going through the main loop, the UI can freeze when the window is
+    inactive, stopping compression progress being shown from the daemon
+    thread. It can also cause the UI to glitch out or disappear sometimes. But
+    running GLib.idle_add functions from the main thread also seems to cause
+    bugs. This just prevented me from writing too much boilerplate code.
     """
     if daemon:
-        if arg is not None:
-            GLib.idle_add(function, arg)
-        else:
-            GLib.idle_add(function)
+        ui_dispatcher.queue(function, arg)
     else:
         if arg is not None:
             function(arg)
         else:
             function()
+
+
+class WorkerPool:
+    """ A bounded pool of daemon threads for running background work, like
+    probing videos or generating thumbnails, without starting a new thread
+    (and so new subprocesses) for every video at once.
+
+    Tasks are submitted with a key (e.g. the row they're for). Tasks whose
+    keys have been prioritized, like rows currently visible on screen, are
+    run first. Otherwise, tasks run in the order they were submitted.
+    """
+    def __init__(self, max_workers: int) -> None:
+        self.max_workers = max(max_workers, 1)
+        self.worker_count = 0
+        self.pending: List[Tuple[Any, Callable, Tuple]] = []
+        self.prioritized = set()
+        self.condition = threading.Condition()
+
+    def submit(self, key: Any, function: Callable, *args: Any) -> None:
+        """ Queue a function to be run with the passed arguments """
+        with self.condition:
+            self.pending.append((key, function, args))
+
+            if self.worker_count < self.max_workers:
+                self.worker_count += 1
+                worker = threading.Thread(target=self.run_worker)
+                worker.daemon = True
+                worker.start()
+            else:
+                self.condition.notify()
+
+    def cancel(self, key: Any) -> None:
+        """ Remove any queued tasks with the passed key that haven't started
+        yet
+        """
+        with self.condition:
+            self.pending = [x for x in self.pending if x[0] is not key]
+            self.prioritized.discard(key)
+
+    def set_prioritized(self, keys: Iterable[Any]) -> None:
+        """ Set the keys whose queued tasks should be run first """
+        with self.condition:
+            self.prioritized = set(keys)
+
+    def take_next(self) -> Tuple[Any, Callable, Tuple]:
+        """ Wait for, then remove and return the next task to run """
+        with self.condition:
+            while not self.pending:
+                self.condition.wait()
+
+            for i, task in enumerate(self.pending):
+                if task[0] in self.prioritized:
+                    return self.pending.pop(i)
+
+            return self.pending.pop(0)
+
+    def run_worker(self) -> None:
+        """ Run queued tasks, forever """
+        while True:
+            key, function, args = self.take_next()
+
+            try:
+                function(*args)
+            except Exception as e:
+                print(f'Warning: background task failed: {e}')
+
+
+class BatchWorkerPool(WorkerPool):
+    """ A worker pool that runs tasks in batches, for work with a high cost
+    per call, like starting a subprocess.
+
+    Each worker takes up to batch_size queued tasks for the same function at
+    once (prioritized ones first), and calls the function once with a list
+    of the tasks' argument tuples.
+    """
+    def __init__(self, max_workers: int, batch_size: int) -> None:
+        super().__init__(max_workers)
+        self.batch_size = max(batch_size, 1)
+
+    def take_batch(self) -> Tuple[Callable, List[Tuple]]:
+        """ Wait for, then remove and return the next batch of tasks to run,
+        as their function and their arguments
+        """
+        with self.condition:
+            key, function, args = self.take_next()
+            batch = [args]
+
+            candidates = sorted(
+                (x for x in self.pending if x[1] == function),
+                key=lambda x: x[0] not in self.prioritized
+            )
+
+            for task in candidates[:self.batch_size - 1]:
+                self.pending.remove(task)
+                batch.append(task[2])
+
+            return (function, batch)
+
+    def run_worker(self) -> None:
+        """ Run batches of queued tasks, forever """
+        while True:
+            function, batch = self.take_batch()
+
+            try:
+                function(batch)
+            except Exception as e:
+                print(f'Warning: background task failed: {e}')
+
+
+# Concurrency limits of the application-wide worker pools. Probing is mostly
+# I/O bound, so a few can run at once. Thumbnailing decodes video, so fewer.
+PROBE_WORKERS = min(os.cpu_count() or 1, 4)
+THUMBNAIL_WORKERS = min(os.cpu_count() or 1, 2)
+
+# Most videos thumbnailed by one ffmpeg process. See thumbnail_cache.
+THUMBNAIL_BATCH_SIZE = 8
+
+probe_pool: Optional[WorkerPool] = None
+thumbnail_pool: Optional[BatchWorkerPool] = None
+
+def get_probe_pool() -> WorkerPool:
+    """ Return the application-wide worker pool for probing videos """
+    global probe_pool
+
+    if probe_pool is None:
+        probe_pool = WorkerPool(PROBE_WORKERS)
+
+    return probe_pool
+
+def get_thumbnail_pool() -> BatchWorkerPool:
+    """ Return the application-wide worker pool for generating thumbnails """
+    global thumbnail_pool
+
+    if thumbnail_pool is None:
+        thumbnail_pool = BatchWorkerPool(
+            THUMBNAIL_WORKERS,
+            THUMBNAIL_BATCH_SIZE
+        )
+
+    return thumbnail_pool
@@ -18,7 +18,7 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 from gi.repository import Adw, Gtk, GLib
-from constrict.shared import update_ui
+from constrict.shared import update_ui, get_probe_pool, get_thumbnail_pool
 from constrict.sources_row import SourcesRow
 from constrict import PREFIX
 from typing import Any, List
@@ -35,14 +35,64 @@ class SourcesListBox(Gtk.ListBox):
     def __init__(self, **kwargs: Any) -> None:
         super().__init__(**kwargs)
         self.locked = False
+        self.scrolled_window = None
+
+        self.connect('map', self.on_map)
+
+    def on_map(self, widget: Gtk.Widget) -> None:
+        """ Start tracking which rows are scrolled into view, once the list
+        box has been placed in its scrolled window
+        """
+        if self.scrolled_window:
+            return
+
+        self.scrolled_window = self.get_ancestor(Gtk.ScrolledWindow)
+
+        if self.scrolled_window:
+            self.scrolled_window.get_vadjustment().connect(
+                'value-changed',
+                lambda *_: self.prioritize_visible_rows()
+            )
+
+    def prioritize_visible_rows(self) -> None:
+        """ Have background probing and thumbnailing serve the rows currently
+        scrolled into view before the rest
+        """
+        if not self.scrolled_window:
+            return
+
+        viewport_height = self.scrolled_window.get_height()
+        visible_rows = []
+
+        for row in self.get_all():
+            is_valid, bounds = row.compute_bounds(self.scrolled_window)
+
+            if not is_valid:
+                continue
+
+            top = bounds.get_y()
+            bottom = top + bounds.get_height()
+
+            if bottom >= 0 and top <= viewport_height:
+                visible_rows.append(row)
+
+        get_probe_pool().set_prioritized(visible_rows)
+        get_thumbnail_pool().set_prioritized(visible_rows)
 
     def remove(self, child: Gtk.Widget) -> None:
         """ Remove a child from the list box """
+        get_probe_pool().cancel(child)
+        get_thumbnail_pool().cancel(child)
+
         super().remove(child)
         self.update_rows(False)
 
     def remove_all(self) -> None:
         """ Remove every child the list box, bar the add videos button """
+        for row in self.get_all():
+            get_probe_pool().cancel(row)
+            get_thumbnail_pool().cancel(row)
+
         super().remove_all()
         self.append(self.add_videos_button)
 
@@ -76,6 +126,9 @@ class SourcesListBox(Gtk.ListBox):
 
         self.update_rows(False)
 
+        # Rows only have bounds once they've been allocated.
+        GLib.idle_add(self.prioritize_visible_rows)
+
     def get_all(self) -> List[SourcesRow]:
         """ Get all rows of the list box, bar the 'add videos' button row """
         length = self.get_length()
@@ -91,7 +144,9 @@ class SourcesListBox(Gtk.ListBox):
         """ Move a row to a new destination """
         dest_index = dest_row.get_index()
 
-        self.remove(source_row)
+        # Don't use self.remove(), which would cancel the row's pending
+        # background work.
+        super().remove(source_row)
         self.insert(source_row, dest_index)
 
         self.update_rows(False)
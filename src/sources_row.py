@@ -30,17 +30,16 @@ gi.require_version('Gly', '2')
 gi.require_version('GlyGtk4', '2')
 from gi.repository import Adw, Gtk, Gio, GLib, Gdk, Gly, GlyGtk4
 from pathlib import Path
-from constrict.shared import get_tmp_dir, update_ui
-from constrict.constrict_utils import get_encode_settings, get_resolution, get_framerate, get_duration, get_audio_bitrate, get_audio_channel_count
+from constrict.shared import update_ui, get_probe_pool, get_thumbnail_pool
+from constrict.constrict_utils import get_encode_settings, probe_media, MediaInfo
 from constrict.enums import SourceState
 from constrict.progress_pie import ProgressPie
 from constrict.attempt_fail_box import AttemptFailBox
 from constrict.progress_popover_box import ProgressPopoverBox
-from constrict import PREFIX
-import threading
+from constrict import PREFIX, thumbnail_cache
 import subprocess
 import os
-from typing import Optional, Any, Callable, Tuple
+from typing import Optional, Any, Callable, List, Tuple
 
 
 @Gtk.Template(resource_path=f'{PREFIX}/sources_row.ui')
@@ -73,7 +72,7 @@ class SourcesRow(Adw.ActionRow):
         video_path: str,
         display_name: str,
         mime_type: Optional[str] = None,
-        file_hash: Optional[int] = None,
+        load_thumbnail: bool = False,
         target_size_getter: Optional[Callable[[], int]] = None,
         fps_mode_getter: Optional[Callable[[], int]] = None,
         error_action: Callable[[str, str], None] = lambda x, y: None,
@@ -87,12 +86,7 @@ class SourcesRow(Adw.ActionRow):
         self.display_name = display_name
         self.mime_type = mime_type
 
-        self.height = None
-        self.width = None
-        self.fps = None
-        self.duration = None
-        self.audio_bitrate = None
-        self.audio_channel_count = None
+        self.media_info = None
         self.state = SourceState.PENDING
         self.error_details = ""
         self.error_action = error_action
@@ -130,21 +124,19 @@ class SourcesRow(Adw.ActionRow):
             self.read_progress_popover
         )
 
-        if file_hash:
-            thumb_thread = threading.Thread(
-                target=self.set_thumbnail,
-                args=[file_hash, True]
-            )
-            thumb_thread.daemon = True
-            thumb_thread.start()
+        # Rows made just to be dragged copy their thumbnail instead. See
+        # on_drag_prepare().
+        if load_thumbnail:
+            get_thumbnail_pool().submit(self, set_thumbnails, self)
 
         if target_size_getter and fps_mode_getter:
-            preview_thread = threading.Thread(
-                target=self.set_preview,
-                args=[target_size_getter, fps_mode_getter, True]
+            get_probe_pool().submit(
+                self,
+                self.set_preview,
+                target_size_getter,
+                fps_mode_getter,
+                True
             )
-            preview_thread.daemon = True
-            preview_thread.start()
 
         self.drag_widget = None
 
@@ -204,6 +196,7 @@ class SourcesRow(Adw.ActionRow):
         vid_fps: float,
         compressed_size_bytes: int,
         target_size_bytes: int,
+        is_size_projected: bool,
         daemon: bool
     ) -> None:
         """ Add attempt failure details to the source row's popover box. """
@@ -217,7 +210,8 @@ class SourcesRow(Adw.ActionRow):
             vid_height,
             vid_fps,
             compressed_size_bytes,
-            target_size_bytes
+            target_size_bytes,
+            is_size_projected
         )
         self.popover_box.add_fail_widget(fail_box, daemon)
 
@@ -337,86 +331,33 @@ class SourcesRow(Adw.ActionRow):
         """ Run the function responsible for displaying error details """
         row.error_action(row.display_name, row.error_details)
 
-    def get_resolution(self) -> Tuple[int, int]:
-        """ Get the resolution of the video represented by the row. This
-        resolution is cached within the object after first fetching it.
-        """
-        if not self.width or not self.height:
-            self.width, self.height = get_resolution(self.video_path)
-
-        return (self.width, self.height)
-
-    def get_fps(self) -> float:
-        """ Get the framerate of the video represented by the row. This
-        framerate is cached within the object after first fetching it.
-        """
-        if not self.fps:
-            self.fps = get_framerate(self.video_path)
-
-        return self.fps
-
-    def get_duration(self) -> float:
-        """ Get the duration of the video represented by the row. This
-        duration is cached within the object after first fetching it.
-        """
-        if not self.duration:
-            self.duration = get_duration(self.video_path)
-
-        return self.duration
-
-    def get_audio_bitrate(self) -> int:
-        """ Get the audio bitrate of the video represented by the row. This
-        value is cached within the object after first fetching it.
-        """
-        if self.audio_bitrate is None:
-            self.audio_bitrate = get_audio_bitrate(self.video_path)
-
-        return self.audio_bitrate
-
-    def get_audio_channel_count(self) -> int:
-        """ Get the audio-channel-count of the video represented by the row. This
-        value is cached within the object after first fetching it.
+    def get_media_info(self) -> MediaInfo:
+        """ Get the properties of the video represented by the row. These
+        properties are cached within the object after first fetching them.
         """
-        if self.audio_channel_count is None:
-            self.audio_channel_count = get_audio_channel_count(self.video_path)
+        if self.media_info is None:
+            self.media_info = probe_media(self.video_path)
 
-        return self.audio_channel_count
+        return self.media_info
 
-    def set_thumbnail(self, file_hash: int, daemon: bool) -> None:
-        """ Set a thumbnail for the row, by running a thumbnailer on the video
-        this row represents, and storing it named with the video's file hash
-        in a temp directory
+    def set_thumbnail(
+        self,
+        thumbnail_path: Optional[str],
+        daemon: bool
+    ) -> None:
+        """ Set the row's thumbnail to the image at the passed path, or a
+        generic icon if there is none or it can't be loaded
         """
-        bin_gst_thumbnailer = 'gst-video-thumbnailer'
         generic_icon = 'image-x-generic' if self.mime_type == 'image/gif' else 'video-x-generic'
 
-        gst_thumbnailer_exists = GLib.find_program_in_path(bin_gst_thumbnailer)
-
-        if not gst_thumbnailer_exists:
-            update_ui(self.thumbnail.set_from_icon_name, generic_icon, daemon)
-            return
-
-        # Check tmp directory is available to write.
-        tmp_dir = get_tmp_dir()
-
-        if not tmp_dir:
-            update_ui(self.thumbnail.set_from_icon_name, generic_icon, daemon)
-            return
-
-        thumb_filepath = str(tmp_dir / f'{file_hash}.jpg')
-
-        subprocess.run([
-            bin_gst_thumbnailer,
-            '-p', self.video_path,
-            '-s', '128',
-            '-o', thumb_filepath
-        ])
-
-        thumb_file = Gio.File.new_for_path(thumb_filepath)
-
-        if thumb_file.query_exists():
+        if thumbnail_path:
+            thumb_file = Gio.File.new_for_path(thumbnail_path)
             loader = Gly.Loader.new(thumb_file)
-            image = loader.load()
+
+            try:
+                image = loader.load()
+            except GLib.Error:
+                image = None
 
             if image:
                 frame = image.next_frame()
@@ -572,16 +513,14 @@ class SourcesRow(Adw.ActionRow):
             return
 
         try:
-            width, height = self.get_resolution()
+            media_info = self.get_media_info()
             original_size_mib = self.get_size() / 1024 / 1024
-            fps = self.get_fps()
-            duration = self.get_duration()
-            audio_bitrate = self.get_audio_bitrate()
-            audio_channel_count = self.get_audio_channel_count()
-        except subprocess.CalledProcessError:
+        except (subprocess.CalledProcessError, ValueError):
             self.set_state(SourceState.BROKEN, daemon)
             return
 
+        width, height = media_info.width, media_info.height
+        fps = media_info.fps
         assumed_fps = fps if fps != -1 else 60
 
         target_size_mib = target_size_getter()
@@ -596,9 +535,9 @@ class SourcesRow(Adw.ActionRow):
             width,
             height,
             assumed_fps,
-            duration,
-            audio_bitrate,
-            audio_channel_count,
+            media_info.duration,
+            media_info.audio_bitrate,
+            media_info.audio_channel_count,
             1.0,
             False,
             None,
@@ -613,8 +552,8 @@ class SourcesRow(Adw.ActionRow):
             update_ui(self.set_subtitle, '', daemon)
             return
 
-        src_pixels = self.height if self.height < self.width else self.width
-        src_fps = int(round(self.fps, 0)) if self.fps != -1 else '?'
+        src_pixels = height if height < width else width
+        src_fps = int(round(fps, 0)) if fps != -1 else '?'
 
         src_label = f'{src_pixels}p@{src_fps}'
         dest_label = f'{target_pixels}p@{int(round(target_fps, 0))}'
@@ -727,4 +666,13 @@ class SourcesRow(Adw.ActionRow):
         list_box.move(row, next_row)
 
 
+def set_thumbnails(requests: List[Tuple[SourcesRow]]) -> None:
+    """ Set the thumbnails of a batch of rows, extracting any that aren't
+    cached yet with a single thumbnailer process. Run by the thumbnail worker
+    pool (see BatchWorkerPool).
+    """
+    rows = [x[0] for x in requests]
+    thumbnails = thumbnail_cache.get_thumbnails([x.video_path for x in rows])
 
+    for row in rows:
+        row.set_thumbnail(thumbnails.get(row.video_path), True)
@@ -0,0 +1,202 @@
+#!/usr/bin/python3
+
+# thumbnail_cache.py
+#
+# Copyright 2025 Wartybix
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import os
+import subprocess
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+try:
+    from constrict import probe_cache
+except ModuleNotFoundError:
+    import probe_cache
+
+
+# Module responsible for making thumbnails of videos, and keeping them between
+# sessions. Like probe results (see probe_cache), thumbnails are keyed by the
+# identity of the file on disk, so a thumbnail stops matching as soon as its
+# video is modified or replaced. Thumbnails for many videos are extracted by
+# a single ffmpeg process, rather than one process per video.
+
+# Bump whenever the format of thumbnails changes, to discard old ones.
+CACHE_VERSION = 1
+
+# Least recently used thumbnails are evicted above this many thumbnails.
+MAX_ENTRIES = 2000
+
+# Width and height thumbnails are scaled to fit within, in pixels.
+THUMBNAIL_SIZE = 128
+
+# Thumbnails are taken from the keyframe at or before this many seconds into
+# each video, to skip past fades from black at the very start.
+THUMBNAIL_SEEK_SECONDS = 1.0
+
+
+def get_thumbnail_dir() -> Optional[Path]:
+    """ Return the directory thumbnails are stored in, creating it if needed.
+    Returns None if it cannot be created.
+    """
+    cache_dir = probe_cache.get_cache_dir()
+
+    if not cache_dir:
+        return None
+
+    thumbnail_dir = cache_dir / f'thumbnails-{CACHE_VERSION}'
+
+    try:
+        thumbnail_dir.mkdir(mode=0o755, exist_ok=True)
+    except OSError:
+        print('Warning: could not get thumbnail directory')
+        return None
+
+    return thumbnail_dir
+
+
+def get_thumbnail_path(thumbnail_dir: Path, file_path: str) -> Optional[Path]:
+    """ Return where the thumbnail of the current version of a file is
+    stored, or None if the file can't be read
+    """
+    try:
+        file_key = probe_cache.get_file_key(file_path)
+    except OSError:
+        return None
+
+    return thumbnail_dir / ('-'.join(str(x) for x in file_key) + '.jpg')
+
+
+def run_ffmpeg(
+    file_paths: Sequence[str],
+    thumbnail_paths: Sequence[Path],
+    seek_seconds: float
+) -> None:
+    """ Extract the thumbnail of each of the passed videos to the path at
+    the same index, in one ffmpeg process. Only keyframes are decoded.
+    Thumbnails that couldn't be extracted are left missing.
+    """
+    ffmpeg_cmd = ['ffmpeg', '-y', '-v', 'error']
+
+    for file_path in file_paths:
+        ffmpeg_cmd.extend([
+            '-skip_frame', 'nokey',
+            '-ss', f'{seek_seconds:.3f}',
+            '-noaccurate_seek',
+            '-i', file_path
+        ])
+
+    for index, thumbnail_path in enumerate(thumbnail_paths):
+        ffmpeg_cmd.extend([
+            '-map', f'{index}:v:0',
+            '-frames:v', '1',
+            '-vf', (
+                f'scale={THUMBNAIL_SIZE}:{THUMBNAIL_SIZE}'
+                ':force_original_aspect_ratio=decrease'
+            ),
+            '-q:v', '5',
+            '-update', '1',
+            '-f', 'image2',
+            f'{thumbnail_path}.part'
+        ])
+
+    try:
+        subprocess.run(
+            ffmpeg_cmd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+    except OSError as e:
+        print(f'Warning: could not extract thumbnails: {e}')
+
+    for thumbnail_path in thumbnail_paths:
+        part_path = Path(f'{thumbnail_path}.part')
+
+        try:
+            if part_path.stat().st_size > 0:
+                os.replace(part_path, thumbnail_path)
+            else:
+                part_path.unlink()
+        except OSError:
+            pass
+
+
+def get_thumbnails(file_paths: Sequence[str]) -> Dict[str, Optional[str]]:
+    """ Return the paths of thumbnails of the passed videos, keyed by video
+    path, extracting any that aren't cached yet. Videos without a thumbnail
+    (e.g. if they're broken) map to None.
+    """
+    thumbnail_dir = get_thumbnail_dir()
+
+    if not thumbnail_dir:
+        return {x: None for x in file_paths}
+
+    thumbnail_paths = {
+        x: get_thumbnail_path(thumbnail_dir, x) for x in file_paths
+    }
+
+    def get_missing() -> List[str]:
+        return [
+            x for x in file_paths
+            if thumbnail_paths[x] and not thumbnail_paths[x].is_file()
+        ]
+
+    missing = get_missing()
+
+    if missing:
+        run_ffmpeg(
+            missing,
+            [thumbnail_paths[x] for x in missing],
+            THUMBNAIL_SEEK_SECONDS
+        )
+
+        # One unreadable video fails the whole batch, and videos shorter
+        # than the seek have no frame there, so retry each on its own from
+        # the start.
+        for file_path in get_missing():
+            run_ffmpeg([file_path], [thumbnail_paths[file_path]], 0)
+
+        evict(thumbnail_dir)
+
+    thumbnails = {}
+
+    for file_path, thumbnail_path in thumbnail_paths.items():
+        try:
+            # Marks the thumbnail as recently used. See evict().
+            os.utime(thumbnail_path)
+            thumbnails[file_path] = str(thumbnail_path)
+        except (OSError, TypeError):
+            thumbnails[file_path] = None
+
+    return thumbnails
+
+
+def evict(thumbnail_dir: Path) -> None:
+    """ Delete the least recently used thumbnails above MAX_ENTRIES """
+    try:
+        entries = []
+
+        for thumbnail_path in thumbnail_dir.glob('*.jpg'):
+            entries.append((thumbnail_path.stat().st_mtime, thumbnail_path))
+    except OSError:
+        return
+
+    entries.sort(reverse=True)
+
+    for mtime, thumbnail_path in entries[MAX_ENTRIES:]:
+        thumbnail_path.unlink(missing_ok=True)
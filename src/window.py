@@ -18,7 +18,8 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 from gi.repository import Adw, Gtk, Gdk, Gio, GLib, GObject, Pango
-from constrict.constrict_utils import compress
+from constrict.constrict_utils import compress, prefetch_first_pass, get_job_threads, estimate_job_cost, get_chunk_count, will_ha_work, DEFAULT_CHUNK_WORKERS
+from constrict.encode_scheduler import order_jobs
 from constrict.shared import get_tmp_dir, update_ui
 from constrict.enums import FpsMode, VideoCodec, SourceState
 from constrict.sources_row import SourcesRow
@@ -26,15 +27,15 @@ from constrict.sources_list_box import SourcesListBox
 from constrict.error_dialog import ErrorDialog
 from constrict.current_attempt_box import CurrentAttemptBox
 from constrict.drag_overlay import DragOverlay
-from constrict import PREFIX
+from constrict import PREFIX, ffmpeg_supervisor, batch_journal
 import threading
 import subprocess
+from functools import partial
 from pathlib import Path
 import os
-from typing import Any, List
+from typing import Any, List, Optional, Tuple, Callable
 from gettext import ngettext
 
-# TODO: future feature -- add pause button?
 # TODO: test symlinks?
 
 async def flatten_files(file_list: List[Gio.File]) -> List[Gio.File]:
@@ -93,6 +94,7 @@ class ConstrictWindow(Adw.ApplicationWindow):
     export_button = Gtk.Template.Child()
     cancel_bar = Gtk.Template.Child()
     cancel_button = Gtk.Template.Child()
+    pause_button = Gtk.Template.Child()
     sources_list_box = Gtk.Template.Child()
     target_size_row = Gtk.Template.Child()
     target_size_input = Gtk.Template.Child()
@@ -124,7 +126,10 @@ class ConstrictWindow(Adw.ApplicationWindow):
         super().__init__(**kwargs)
 
         self.compressing = False
-        self.currently_processed = ''
+        self.currently_processed = []
+        self.currently_processed_lock = threading.Lock()
+        self.reserved_paths = set()
+        self.reserved_paths_lock = threading.Lock()
         self.main_view_title.set_title(self.get_title())
         self.videos_to_stage = []
 
@@ -152,6 +157,14 @@ class ConstrictWindow(Adw.ApplicationWindow):
         self.cancel_action.connect("activate", self.on_cancel)
         self.add_action(self.cancel_action)
 
+        self.pause_action = Gio.SimpleAction.new_stateful(
+            "pause",
+            None,
+            GLib.Variant.new_boolean(False)
+        )
+        self.pause_action.connect("change-state", self.on_pause)
+        self.add_action(self.pause_action)
+
         self.clear_all_action = Gio.SimpleAction(name="clear_all")
         self.clear_all_action.connect("activate", self.delist_all)
         self.add_action(self.clear_all_action)
@@ -487,6 +500,33 @@ class ConstrictWindow(Adw.ApplicationWindow):
         """
         return int(self.tolerance_input.get_value())
 
+    def get_settings_snapshot(self) -> dict:
+        """ Get the settings of the window and application that affect how
+        videos are compressed, for journaling. See batch_journal.
+        """
+        custom_suffix = self.settings.get_string('custom-export-suffix')
+
+        return {
+            'target_size': self.get_target_size(),
+            'fps_mode': self.get_fps_mode(),
+            'codec': self.get_video_codec(),
+            'extra_quality': self.get_extra_quality(),
+            'tolerance': self.get_tolerance(),
+            'use_ha': self.settings.get_boolean('use-gpu-encoding'),
+            'calibrate': self.settings.get_boolean('calibrate-bitrate'),
+            'suffix': custom_suffix or self.get_application().default_suffix
+        }
+
+    def apply_settings_snapshot(self, snapshot: dict) -> None:
+        """ Set the window's compression settings to those of a snapshot
+        from get_settings_snapshot()
+        """
+        self.target_size_input.set_value(snapshot['target_size'])
+        self.set_fps_mode(snapshot['fps_mode'])
+        self.set_video_codec(snapshot['codec'])
+        self.extra_quality_toggle.set_active(snapshot['extra_quality'])
+        self.tolerance_input.set_value(snapshot['tolerance'])
+
     def toggle_sidebar(self, action: Gio.Action, _) -> None:
         """ Toggle whether the compression settings sidebar is shown when queue
         page is open. """
@@ -543,18 +583,38 @@ class ConstrictWindow(Adw.ApplicationWindow):
         thread.daemon = True
         thread.start()
 
+    def on_pause(self, action: Gio.Action, state: GLib.Variant) -> None:
+        """ Pause or resume the window's compression, keeping its progress """
+        self.set_paused(state.get_boolean())
+
+    def set_paused(self, paused: bool) -> None:
+        """ Pause or resume the ffmpeg processes of this window's compression.
+        See ffmpeg_supervisor.
+        """
+        self.pause_action.set_state(GLib.Variant.new_boolean(paused))
+
+        if paused:
+            ffmpeg_supervisor.get_supervisor().pause(self)
+        else:
+            ffmpeg_supervisor.get_supervisor().resume(self)
+
+        self.pause_button.set_label(_('_Resume') if paused else _('_Pause'))
+
     def on_cancel(self, action: Gio.Action, parameter: GLib.Variant) -> None:
         """ Show the window's cancel dialog """
         self.show_cancel_dialog(False)
 
     def show_cancel_dialog(self, quit_on_stop: bool) -> None:
         """ Display a cancel dialog to stop the current compression """
+        with self.currently_processed_lock:
+            currently_processed = list(self.currently_processed)
+
         dialog = Adw.AlertDialog.new(
             _('Stop Compression?'),
             # TRANSLATORS: {} represents the filename of the video currently
             # being compressed.
             _('Progress made compressing “{}” will be permanently lost')
-                .format(self.currently_processed)
+                .format('”, “'.join(currently_processed))
         )
 
         dialog.quit_on_stop = quit_on_stop
@@ -579,6 +639,8 @@ class ConstrictWindow(Adw.ApplicationWindow):
 
         if choice == 'stop':
             self.compressing = False
+            self.get_application().get_encode_scheduler().cancel(self)
+            self.set_paused(False)
             if dialog.quit_on_stop:
                 self.close()
 
@@ -594,6 +656,71 @@ class ConstrictWindow(Adw.ApplicationWindow):
          """
         self.error_dialog(toast.video.display_name, toast.video.error_details)
 
+    def offer_resume(self, journal: batch_journal.BatchJournal) -> None:
+        """ Show a toast offering to resume an interrupted batch """
+        toast = Adw.Toast.new(_('Compression was interrupted'))
+        toast.set_button_label(_('_Resume'))
+        toast.set_timeout(0)
+        toast.journal = journal
+
+        toast.connect('button-clicked', self.resume_from_toast)
+
+        self.toast_overlay.add_toast(toast)
+
+    def resume_from_toast(self, toast: Adw.Toast) -> None:
+        """ Resume a batch from clicking a toast's "Resume" button """
+        self.get_application().loop.create_task(
+            self.resume_batch(toast.journal)
+        )
+
+    async def resume_batch(self, journal: batch_journal.BatchJournal) -> None:
+        """ Resume compressing an interrupted batch with the settings it was
+        started with, skipping videos that were already compressed
+        """
+        if self.compressing or not journal.lock():
+            return
+
+        destination_dir = journal.get_destination_dir()
+
+        if not os.path.isdir(destination_dir):
+            journal.unlock()
+
+            # TRANSLATORS: {} represents the path of a directory.
+            toast = Adw.Toast.new(_('Could not find “{}”').format(
+                destination_dir
+            ))
+            toast.set_use_markup(False)
+            self.toast_overlay.add_toast(toast)
+            return
+
+        self.apply_settings_snapshot(journal.get_settings())
+
+        await self.stage_videos([
+            Gio.File.new_for_path(x) for x in journal.get_video_paths()
+        ])
+
+        for video in self.sources_list_box.get_all():
+            entry = journal.get_video(video.video_path)
+
+            finished = entry is not None and (
+                entry['state'] == SourceState.COMPLETE
+                and entry['output']
+                and os.path.exists(entry['output'])
+            )
+
+            if finished:
+                end_size_mb = round(entry['size'] / 1024 / 1024, 1)
+                video.set_complete(entry['output'], end_size_mb, False)
+
+        self.refresh_can_export(False)
+
+        thread = threading.Thread(
+            target=self.bulk_compress,
+            args=[destination_dir, journal]
+        )
+        thread.daemon = True
+        thread.start()
+
     def get_complete_notification_id(self) -> str:
         """ Get a unique notification ID for communicating compression is
         complete, for this window
@@ -661,19 +788,37 @@ class ConstrictWindow(Adw.ApplicationWindow):
         final_path = file_path
         root_ext = os.path.splitext(file_path)
 
-        counter = 0
-        while os.path.exists(final_path):
-            counter += 1
-            final_path = f'{root_ext[0]}-{counter}{root_ext[1]}'
+        # Paths handed out are reserved for the rest of the compression run,
+        # so that videos compressed at the same time never share a path.
+        with self.reserved_paths_lock:
+            counter = 0
+            while os.path.exists(final_path) or final_path in self.reserved_paths:
+                counter += 1
+                final_path = f'{root_ext[0]}-{counter}{root_ext[1]}'
+
+            self.reserved_paths.add(final_path)
 
         return final_path
 
     # TODO: get rid of all this daemon argument stuff and write some code that
     # makes a bit more sense?
 
-    def bulk_compress(self, destination_dir: str) -> None:
+    def bulk_compress(
+        self,
+        destination_dir: str,
+        journal: Optional[batch_journal.BatchJournal] = None
+    ) -> None:
         """ Compress all videos in the sources list box, exporting to the
         passed destination directory. To be run in a separate thread.
+
+        Several videos may be compressed at once, depending on the number of
+        CPU cores, how well the chosen codec makes use of them, and what
+        other windows are compressing.
+
+        Progress is journaled, so the batch can be resumed if interrupted. To
+        resume a batch, pass its (locked) journal. Settings that aren't shown
+        in the window (see apply_settings_snapshot()) are then taken from the
+        journal, rather than the current preferences.
         """
         daemon = True
 
@@ -681,11 +826,13 @@ class ConstrictWindow(Adw.ApplicationWindow):
         self.show_cancel_button(True, daemon)
         self.compressing = True
 
-        target_size = self.get_target_size()
-        fps_mode = self.get_fps_mode()
         codec = self.get_video_codec()
-        extra_quality = self.get_extra_quality()
-        tolerance = self.get_tolerance()
+
+        # The settings the whole batch is compressed with.
+        snapshot = self.get_settings_snapshot()
+
+        if journal:
+            snapshot.update(journal.get_settings())
 
         dest_file = Gio.File.new_for_path(destination_dir)
 
@@ -717,150 +864,180 @@ class ConstrictWindow(Adw.ApplicationWindow):
             _('Videos are being compressed')
         )
 
-        for i in range(len(source_list)):
-            self.set_compressing_title(i, displayed_dest_path)
-
-            video = source_list[i]
-
-            if video.state == SourceState.COMPLETE:
-                continue
-
-            self.currently_processed = video.display_name
+        use_ha = snapshot['use_ha']
+        parallel = self.settings.get_boolean('parallel-encoding')
+        concurrent = self.settings.get_boolean('concurrent-compression')
+        resumable = self.settings.get_boolean('resumable-encoding')
 
-            progress_box = CurrentAttemptBox()
-            video.initiate_popover_box(progress_box, daemon)
+        pending = [x for x in source_list if x.state != SourceState.COMPLETE]
+        count_lock = threading.Lock()
+        processed_count = len(source_list) - len(pending)
 
-            use_ha = self.settings.get_boolean('use-gpu-encoding')
+        with self.currently_processed_lock:
+            self.currently_processed = []
 
-            def update_progress(fraction, seconds_left):
-                if fraction == 0.0 and codec == VideoCodec.VP9:
-                    progress_box.set_progress_text(_('Analyzing…'), daemon)
-                    video.enable_spinner(True, daemon)
-                    progress_box.pulse_progress(daemon)
-                else:
-                    video.enable_spinner(False, daemon)
-                    progress_box.set_progress(fraction, seconds_left, daemon)
-                    update_ui(video.progress_pie.set_fraction, fraction, daemon)
+        self.reserved_paths = set()
 
-            def set_attempt_details(
-                attempt,
-                target_vid_bitrate,
-                hq_audio,
-                target_height,
-                target_fps
-            ):
-                progress_box.set_attempt_details(
-                    attempt,
-                    target_vid_bitrate,
-                    hq_audio,
-                    target_height,
-                    target_fps,
-                    daemon
-                )
-
-            def add_attempt_fail(
-                attempt,
-                target_vid_bitrate,
-                hq_audio,
-                target_height,
-                target_fps,
-                after_size_bytes,
-                target_size_bytes
-            ):
-                video.add_attempt_fail(
-                    attempt,
-                    target_vid_bitrate,
-                    hq_audio,
-                    target_height,
-                    target_fps,
-                    after_size_bytes,
-                    target_size_bytes,
-                    daemon
-                )
-
-            video.set_state(SourceState.COMPRESSING, daemon)
+        if journal is None:
+            journal = batch_journal.create_journal(
+                destination_dir,
+                snapshot,
+                [x.video_path for x in pending]
+            )
+        else:
+            for video in pending:
+                journal.add_video(video.video_path)
 
-            tmp_dir = get_tmp_dir()
-            log_filename = f'constrict2pass-{self.get_id()}'
+        GLib.idle_add(
+            self.set_compressing_title,
+            processed_count,
+            displayed_dest_path
+        )
 
-            log_path = str(tmp_dir / log_filename) if (
-                tmp_dir
-            ) else str(Path(destination_dir) / log_filename)
+        scheduler = self.get_application().get_encode_scheduler()
+        threads_per_job = get_job_threads(codec, use_ha, parallel)
+        max_jobs = None if concurrent else 1
 
-            input_basename = os.path.basename(video.video_path)
-            merged = os.path.join(destination_dir, input_basename)
-            root_ext = os.path.splitext(merged)
+        extra_quality = self.get_extra_quality()
+        costs = [
+            estimate_job_cost(x.media_info, codec, extra_quality)
+            for x in pending
+        ]
+        job_order = order_jobs(
+            costs,
+            self.settings.get_enum('queue-order'),
+            scheduler.get_slot_count(threads_per_job) if concurrent else 1
+        )
 
-            custom_suffix = self.settings.get_string('custom-export-suffix')
-            suffix = custom_suffix or self.get_application().default_suffix
+        # Jobs not started yet, in order, and first passes run ahead of time
+        # for them, by job ID. See prefetch_next().
+        queued = [(pending[i], i) for i in job_order]
+        prefetches = {}
+        overlap = self.settings.get_int('first-pass-overlap')
+        can_ha = (
+            overlap > 0
+            and use_ha
+            and not extra_quality
+            and will_ha_work(codec)
+        )
 
-            output_path = f'{root_ext[0]}{suffix}.mp4'
-            output_path_unique = self.get_unique_path(output_path)
+        def will_chunk(video):
+            if video.media_info is None:
+                # Unknown until probed, so assume it might be.
+                return parallel or resumable
 
-            compression_result = compress(
-                video.video_path,
+            return get_chunk_count(
+                video.media_info.duration,
                 video.mime_type,
-                output_path_unique,
-                target_size,
-                fps_mode,
-                extra_quality,
-                codec,
-                use_ha,
-                tolerance,
-                update_progress,
-                log_path,
-                lambda: not self.compressing,
-                set_attempt_details,
-                add_attempt_fail
-            )
+                DEFAULT_CHUNK_WORKERS if parallel else 1,
+                resumable,
+                can_ha
+            ) > 1
+
+        def prefetch(video, job_id, event, result):
+            ffmpeg_supervisor.set_group(self)
+
+            try:
+                result.append(prefetch_first_pass(
+                    video.video_path,
+                    self.get_target_size(),
+                    self.get_fps_mode(),
+                    extra_quality,
+                    codec,
+                    use_ha,
+                    self.get_log_path(job_id, destination_dir),
+                    lambda: not self.compressing,
+                    video.media_info,
+                    threads=threads_per_job
+                ))
+            finally:
+                event.set()
+
+        def prefetch_next():
+            if overlap <= 0:
+                return
 
-            def trash_video():
-                # Move video to wastebasket. This is a compromise in case the
-                # user wants to keep their semi-processed file for any reason.
-                # But also doesn't clutter their export folder automatically
-                # with junk files.
+            with count_lock:
+                if not queued or not self.compressing:
+                    return
 
-                output_file = Gio.File.new_for_path(output_path_unique)
-                output_file.trash_async(GLib.PRIORITY_LOW, None, None, None)
+                video, job_id = queued[0]
 
-            if type(compression_result) is str:
-                video.set_error(compression_result, daemon)
+                # Chunked transcodes write their statistics per chunk, so
+                # they can't use a prefetched first pass.
+                if job_id in prefetches or will_chunk(video):
+                    return
+
+                event = threading.Event()
+                result = []
 
-                toast = Adw.Toast.new(
-                    # TRANSLATORS: {} represents the filename of the video with
-                    # the error.
-                    _('Error compressing “{}”').format(video.display_name)
+                started = scheduler.run_prefetch(
+                    partial(prefetch, video, job_id, event, result),
+                    threads_per_job,
+                    overlap
                 )
-                toast.set_use_markup(False)
-                toast.set_button_label(_('View _Details'))
-                toast.video = video
 
-                toast.connect('button-clicked', self.show_error_from_toast)
+                if started:
+                    prefetches[job_id] = (event, result)
 
-                update_ui(self.toast_overlay.add_toast, toast, daemon)
+        def run_job(video, job_id, placement):
+            nonlocal processed_count
 
-                trash_video()
+            # So this window's processes can be paused together.
+            ffmpeg_supervisor.set_group(self)
+            ffmpeg_supervisor.set_cpu_affinity(placement.cpus)
 
-                continue
+            with count_lock:
+                queued.remove((video, job_id))
+                prefetched = prefetches.pop(job_id, None)
 
             if not self.compressing:
-                video.set_preview(
-                    self.get_target_size,
-                    self.get_fps_mode,
-                    daemon
-                )
+                return
 
-                trash_video()
+            prefetched_pass_key = None
+
+            if prefetched:
+                event, result = prefetched
+                event.wait()
+                prefetched_pass_key = result[0] if result else None
+
+            self.compress_video(
+                video,
+                job_id,
+                destination_dir,
+                prefetched_pass_key,
+                prefetch_next,
+                placement.threads,
+                journal,
+                snapshot
+            )
 
-                break
+            with count_lock:
+                processed_count += 1
 
+                GLib.idle_add(
+                    self.set_compressing_title,
+                    processed_count,
+                    displayed_dest_path
+                )
+
+        # Jobs are run by the application, alongside those of other windows.
+        scheduler.run_batch(
+            self,
+            [partial(run_job, video, job_id) for video, job_id in queued],
+            threads_per_job,
+            max_jobs
+        )
 
-            if type(compression_result) is int:
-                end_size_bytes = compression_result
-                end_size_mb = round(end_size_bytes / 1024 / 1024, 1)
-                video.set_complete(output_path_unique, end_size_mb, daemon)
+        if journal:
+            if self.compressing:
+                journal.remove()
+            else:
+                # Stopped early. Keep the journal for resuming later.
+                journal.unlock()
 
         def finish():
+            self.set_paused(False)
             self.set_controls_lock(False, False)
             self.show_cancel_button(False, False)
             self.refresh_can_export(False)
@@ -880,6 +1057,244 @@ class ConstrictWindow(Adw.ApplicationWindow):
 
         GLib.idle_add(finish)
 
+    def get_log_path(self, job_id: int, destination_dir: str) -> str:
+        """ Get the path of the pass log file for the passed compression job
+        of this window
+        """
+        tmp_dir = get_tmp_dir()
+        # Each video compressed at the same time needs its own pass log.
+        log_filename = f'constrict2pass-{self.get_id()}-{job_id}'
+
+        return str(tmp_dir / log_filename) if (
+            tmp_dir
+        ) else str(Path(destination_dir) / log_filename)
+
+    def compress_video(
+        self,
+        video: SourcesRow,
+        job_id: int,
+        destination_dir: str,
+        prefetched_pass_key: Optional[Tuple] = None,
+        on_second_pass: Optional[Callable[[], None]] = None,
+        threads: Optional[int] = None,
+        journal: Optional[batch_journal.BatchJournal] = None,
+        snapshot: Optional[dict] = None
+    ) -> None:
+        """ Compress the video of a source row, exporting it to the passed
+        destination directory and showing progress in the row. job_id must be
+        unique among videos compressed at the same time. To be run in a
+        separate thread.
+
+        See compress() for prefetched_pass_key, on_second_pass and threads.
+        If a batch journal is passed, the video's progress is recorded in it,
+        and the video carries on from any attempts recorded before.
+
+        The GPU encoding, calibration and export suffix settings are taken
+        from the passed settings snapshot (see get_settings_snapshot()), so
+        that they stay the same for the whole batch.
+        """
+        if snapshot is None:
+            snapshot = self.get_settings_snapshot()
+
+        daemon = True
+
+        target_size = self.get_target_size()
+        fps_mode = self.get_fps_mode()
+        codec = self.get_video_codec()
+        extra_quality = self.get_extra_quality()
+        tolerance = self.get_tolerance()
+
+        with self.currently_processed_lock:
+            self.currently_processed.append(video.display_name)
+
+        progress_box = CurrentAttemptBox()
+        video.initiate_popover_box(progress_box, daemon)
+
+        use_ha = snapshot['use_ha']
+        calibrate = snapshot['calibrate']
+        parallel = self.settings.get_boolean('parallel-encoding')
+        intermediate_budget = self.settings.get_int('intermediate-budget')
+        resumable = self.settings.get_boolean('resumable-encoding')
+
+        def update_progress(fraction, seconds_left):
+            if fraction == 0.0 and codec == VideoCodec.VP9:
+                progress_box.set_progress_text(_('Analyzing…'), daemon)
+                video.enable_spinner(True, daemon)
+                progress_box.pulse_progress(daemon)
+            else:
+                video.enable_spinner(False, daemon)
+                progress_box.set_progress(fraction, seconds_left, daemon)
+                update_ui(video.progress_pie.set_fraction, fraction, daemon)
+
+        def set_attempt_details(
+            attempt,
+            target_vid_bitrate,
+            hq_audio,
+            target_height,
+            target_fps
+        ):
+            progress_box.set_attempt_details(
+                attempt,
+                target_vid_bitrate,
+                hq_audio,
+                target_height,
+                target_fps,
+                daemon
+            )
+
+        def add_attempt_fail(
+            attempt,
+            target_vid_bitrate,
+            hq_audio,
+            target_height,
+            target_fps,
+            after_size_bytes,
+            target_size_bytes,
+            size_projected
+        ):
+            video.add_attempt_fail(
+                attempt,
+                target_vid_bitrate,
+                hq_audio,
+                target_height,
+                target_fps,
+                after_size_bytes,
+                target_size_bytes,
+                size_projected,
+                daemon
+            )
+
+        video.set_state(SourceState.COMPRESSING, daemon)
+
+        log_path = self.get_log_path(job_id, destination_dir)
+
+        input_basename = os.path.basename(video.video_path)
+        merged = os.path.join(destination_dir, input_basename)
+        root_ext = os.path.splitext(merged)
+
+        suffix = snapshot['suffix']
+
+        output_path = f'{root_ext[0]}{suffix}.mp4'
+        resume_attempts = []
+
+        if journal:
+            entry = journal.get_video(video.video_path)
+
+            if entry and entry['state'] == SourceState.COMPRESSING:
+                # Left behind by a compression that was interrupted.
+                try:
+                    os.remove(entry['output'])
+                except (OSError, TypeError):
+                    pass
+
+            resume_attempts = journal.get_attempts(video.video_path)
+
+        output_path_unique = self.get_unique_path(output_path)
+
+        if journal:
+            journal.start_video(video.video_path, output_path_unique)
+
+        compression_result = compress(
+            video.video_path,
+            video.mime_type,
+            output_path_unique,
+            target_size,
+            fps_mode,
+            extra_quality,
+            codec,
+            use_ha,
+            tolerance,
+            update_progress,
+            log_path,
+            lambda: not self.compressing,
+            set_attempt_details,
+            add_attempt_fail,
+            video.media_info,
+            calibrate=calibrate,
+            chunk_workers=DEFAULT_CHUNK_WORKERS if parallel else 1,
+            prefetched_pass_key=prefetched_pass_key,
+            on_second_pass=on_second_pass,
+            intermediate_budget_MiB=intermediate_budget,
+            threads=threads,
+            resume_attempts=resume_attempts,
+            on_attempt_done=partial(
+                journal.add_attempt,
+                video.video_path
+            ) if journal else None,
+            resume_factor=journal.get_resume_factor(
+                video.video_path
+            ) if journal else None,
+            on_attempt_start=partial(
+                journal.start_attempt,
+                video.video_path
+            ) if journal else None,
+            checkpoint=resumable
+        )
+
+        with self.currently_processed_lock:
+            self.currently_processed.remove(video.display_name)
+
+        if journal:
+            if type(compression_result) is str:
+                journal_state = SourceState.ERROR
+            elif type(compression_result) is int and self.compressing:
+                journal_state = SourceState.COMPLETE
+            else:
+                journal_state = SourceState.PENDING
+
+            journal.finish_video(
+                video.video_path,
+                journal_state,
+                compression_result if (
+                    journal_state == SourceState.COMPLETE
+                ) else None
+            )
+
+        def trash_video():
+            # Move video to wastebasket. This is a compromise in case the
+            # user wants to keep their semi-processed file for any reason.
+            # But also doesn't clutter their export folder automatically
+            # with junk files.
+
+            output_file = Gio.File.new_for_path(output_path_unique)
+            output_file.trash_async(GLib.PRIORITY_LOW, None, None, None)
+
+        if type(compression_result) is str:
+            video.set_error(compression_result, daemon)
+
+            toast = Adw.Toast.new(
+                # TRANSLATORS: {} represents the filename of the video with
+                # the error.
+                _('Error compressing “{}”').format(video.display_name)
+            )
+            toast.set_use_markup(False)
+            toast.set_button_label(_('View _Details'))
+            toast.video = video
+
+            toast.connect('button-clicked', self.show_error_from_toast)
+
+            update_ui(self.toast_overlay.add_toast, toast, daemon)
+
+            trash_video()
+
+            return
+
+        if not self.compressing:
+            video.set_preview(
+                self.get_target_size,
+                self.get_fps_mode,
+                daemon
+            )
+
+            trash_video()
+
+            return
+
+        if type(compression_result) is int:
+            end_size_bytes = compression_result
+            end_size_mb = round(end_size_bytes / 1024 / 1024, 1)
+            video.set_complete(output_path_unique, end_size_mb, daemon)
+
 
     def remove_row(self, row: SourcesRow) -> None:
         """ Remove a row from the window's sources list box. Refresh the
@@ -964,7 +1379,7 @@ class ConstrictWindow(Adw.ApplicationWindow):
                 video.get_path(),
                 display_name,
                 mime_type,
-                video.hash(),
+                True,
                 self.get_target_size,
                 self.get_fps_mode,
                 self.error_dialog,